@@ -0,0 +1,112 @@
+import json
+import os
+import time
+
+import utils
+from scoring import ScoreTable, default_score_file, render_previews, score_corpus
+from worldcatalog import WorldCatalog, default_catalog_file
+
+
+class ActiveLearner:
+    # Runs labeling in rounds. Each round scores only new or changed worlds, renders previews of the unlabeled worlds
+    # the model is least sure about into round_dir\unsorted and, once they are sorted by hand into round_dir\pro and
+    # round_dir\notpro, merges just those labels into the label file. Rounds are tracked in active_learning.json.
+
+    def __init__(self, res_dir, label_name, work_dir, world_directory=None):
+        self.res_dir = res_dir
+        self.label_name = label_name
+        self.work_dir = work_dir
+        self.world_directory = world_directory if world_directory is not None else f'{res_dir}\\worlds\\'
+        self.state_file = os.path.join(work_dir, 'active_learning.json')
+
+        self.state = {'round': 0, 'rounds': {}}
+        if os.path.exists(self.state_file):
+            with open(self.state_file, 'r') as fp:
+                self.state = json.load(fp)
+
+        self.label_dict = utils.load_label_dict(res_dir, label_name)
+
+    def save_state(self):
+        with open(f'{self.state_file}.tmp', 'w') as fp:
+            json.dump(self.state, fp, indent=2)
+        os.replace(f'{self.state_file}.tmp', self.state_file)
+
+    def get_round_dir(self, round_num):
+        return utils.check_or_create_local_path(f'round{round_num}', self.work_dir)
+
+    def score(self, classifier, model, gen_size, block_forward, batch_size=256, world_cache=None):
+        score_table = ScoreTable(default_score_file(self.world_directory))
+        try:
+            return score_corpus(classifier, model, self.world_directory, score_table, gen_size, block_forward,
+                                batch_size=batch_size, world_cache=world_cache)
+        finally:
+            score_table.close()
+
+    def select(self, model, count, column='score_max'):
+        # Unlabeled worlds closest to the decision boundary, skipping worlds already picked in an earlier round
+        picked = set()
+        for round_state in self.state['rounds'].values():
+            picked.update(round_state['selected'])
+
+        score_table = ScoreTable(default_score_file(self.world_directory))
+        rows = score_table.get_scores(model, column=column)
+        score_table.close()
+
+        rows = [row for row in rows if row[0] not in self.label_dict and row[0] not in picked]
+        rows.sort(key=lambda row: abs(row[2] - 0.5))
+        return rows[:count]
+
+    def start_round(self, model, count, block_images, world_cache=None):
+        round_num = self.state['round'] + 1
+        round_dir = self.get_round_dir(round_num)
+        unsorted_dir = utils.check_or_create_local_path('unsorted', round_dir)
+        utils.check_or_create_local_path('pro', round_dir)
+        utils.check_or_create_local_path('notpro', round_dir)
+
+        rows = self.select(model, count)
+        print(f'Rendering {len(rows)} uncertain worlds for round {round_num}...')
+        jobs = [(os.path.join(self.world_directory, filename), f'{unsorted_dir}{world_id}.png')
+                for world_id, filename, _ in rows]
+        render_previews(jobs, block_images, world_cache)
+
+        self.state['round'] = round_num
+        self.state['rounds'][str(round_num)] = {'model': model, 'started': time.time(), 'collected': None,
+                                                'selected': [world_id for world_id, _, _ in rows],
+                                                'scores': {world_id: score for world_id, _, score in rows}}
+        self.save_state()
+        return round_dir
+
+    def collect_round(self, round_num=None):
+        # Reads the previews sorted into pro and notpro and merges them into the label file
+        if round_num is None:
+            round_num = self.state['round']
+        round_dir = self.get_round_dir(round_num)
+
+        new_labels = {}
+        for label, label_dir in [(1, 'pro'), (0, 'notpro')]:
+            for name in os.listdir(utils.check_or_create_local_path(label_dir, round_dir)):
+                new_labels[utils.get_world_id(name)] = label
+
+        changed = [world_id for world_id, label in new_labels.items()
+                   if world_id in self.label_dict and self.label_dict[world_id] != label]
+        added = [world_id for world_id in new_labels if world_id not in self.label_dict]
+        self.label_dict.update(new_labels)
+
+        if len(changed) > 0:
+            utils.save_label_dict(self.res_dir, self.label_name, self.label_dict)
+        else:
+            # Only new worlds, so they can be appended instead of rewriting the whole file
+            with open(f'{self.res_dir}\\{self.label_name}.txt', 'a') as fp:
+                for world_id in added:
+                    fp.write(f'{world_id} {new_labels[world_id]}\n')
+
+        catalog_file = default_catalog_file(self.world_directory)
+        if os.path.exists(catalog_file):
+            catalog = WorldCatalog(catalog_file)
+            catalog.set_labels(self.label_name, new_labels)
+            catalog.close()
+
+        self.state['rounds'][str(round_num)]['collected'] = time.time()
+        self.save_state()
+        print(f'Round {round_num} added {len(added)} labels and changed {len(changed)} labels.')
+        return new_labels
@@ -1,7 +1,6 @@
 import os
 
 import keras
-import numpy as np
 from keras.layers.advanced_activations import LeakyReLU
 from keras.layers.convolutional import Conv2D
 from keras.layers.core import Activation
@@ -9,6 +8,10 @@ from keras.models import Input
 from keras.models import Model, Sequential, load_model
 
 import utils
+from batcher import BatchAssembler
+from checkpoints import CheckpointManager
+from exporter import PreviewExporter
+from profiler import StepProfiler
 from loadworker import load_minimaps
 from tbmanager import TensorboardManager
 
@@ -30,7 +33,7 @@ def build_basic_animator(size):
     return animator_model
 
 
-def train(epochs, batch_size, world_count, sz=64, version_name=None):
+def train(epochs, batch_size, world_count, sz=64, version_name=None, profile=False):
     cur_dir = os.getcwd()
     res_dir = os.path.abspath(os.path.join(cur_dir, '..', 'res'))
     all_models_dir = os.path.abspath(os.path.join(cur_dir, '..', 'models'))
@@ -79,54 +82,64 @@ def train(epochs, batch_size, world_count, sz=64, version_name=None):
     print('Loading worlds...')
     x_train = load_minimaps(world_count, f'{res_dir}\\worlds\\', (sz, sz), block_forward, mm_values)
 
-    world_count = x_train.shape[0]
-    batch_cnt = (world_count - (world_count % batch_size)) // batch_size
+    batcher = BatchAssembler(x_train, batch_size)
+    batch_cnt = batcher.batch_count
 
     # Set up tensorboard
     print('Setting up tensorboard...')
     tb_manager = TensorboardManager(graph_version_dir, batch_cnt)
+    exporter = PreviewExporter(block_images, block_backward, mm_values)
+    checkpoints = CheckpointManager(model_save_dir)
+    profiler = StepProfiler(profile, f'{version_dir}\\profile.json')
 
     for epoch in range(epochs):
 
         # Create directories for current epoch
         cur_previews_dir = utils.check_or_create_local_path(f'epoch{epoch}', previews_dir)
-        cur_models_dir = utils.check_or_create_local_path(f'epoch{epoch}', model_save_dir)
 
         print('Shuffling data...')
-        np.random.shuffle(x_train)
+        batcher.shuffle()
 
+        epoch_loss = 0.0
         for batch in range(batch_cnt):
-            minimaps = x_train[batch * batch_size:(batch + 1) * batch_size]
+            with profiler.phase('data'):
+                minimaps = batcher.get_batch(batch)
             # actual = y_train[minibatch_index * batch_size:(minibatch_index + 1) * batch_size]
 
             # Train animator
             # world_loss = animator.train_on_batch(minimaps, actual)
-            minimap_loss = animator_minimap.train_on_batch(minimaps, minimaps)
-            tb_manager.log_var('mm_loss', epoch, batch, minimap_loss)
+            with profiler.phase('train'):
+                minimap_loss = animator_minimap.train_on_batch(minimaps, minimaps)
+            epoch_loss += minimap_loss
 
-            print(f"Epoch = {epoch}/{epochs} :: Batch = {batch}/{batch_cnt} "
-                  f":: MMLoss = {minimap_loss}")
+            with profiler.phase('logging'):
+                tb_manager.log_var('mm_loss', epoch, batch, minimap_loss)
+                tb_manager.log_step_time(epoch, batch)
+
+                print(f"Epoch = {epoch}/{epochs} :: Batch = {batch}/{batch_cnt} "
+                      f":: MMLoss = {minimap_loss}")
 
             # Save previews and models
             if batch == batch_cnt - 1:
                 print('Saving previews...')
-                worlds = animator.predict(minimaps)
-                trained = animator_minimap.predict(minimaps)
-                for i in range(batch_size):
-                    world_decoded = utils.decode_world_sigmoid(block_backward, worlds[i])
-                    utils.save_world_preview(block_images, world_decoded, f'{cur_previews_dir}\\animated{i}.png')
-                    utils.save_world_minimap(mm_values, world_decoded, f'{cur_previews_dir}\\actual{i}.png')
-                    utils.save_rgb_map(utils.decode_world_minimap(trained[i]), f'{cur_previews_dir}\\trained{i}.png')
-
-                    mm_decoded = utils.decode_world_minimap(minimaps[i])
-                    utils.save_rgb_map(mm_decoded, f'{cur_previews_dir}\\target{i}.png')
+                with profiler.phase('preview'):
+                    worlds = animator.predict(minimaps)
+                    trained = animator_minimap.predict(minimaps)
+                    for i in range(batch_size):
+                        exporter.export_world(worlds[i], f'{cur_previews_dir}\\animated{i}.png',
+                                              minimap_file=f'{cur_previews_dir}\\actual{i}.png')
+                        exporter.export_minimap(trained[i], f'{cur_previews_dir}\\trained{i}.png')
+                        exporter.export_minimap(minimaps[i], f'{cur_previews_dir}\\target{i}.png')
 
                 print('Saving models...')
-                try:
-                    animator.save(f'{cur_models_dir}\\animator.h5')
-                    animator.save_weights(f'{cur_models_dir}\\animator.weights')
-                except ImportError:
-                    print('Failed to save data.')
+                with profiler.phase('checkpoint'):
+                    checkpoints.save(epoch, {'animator': animator}, metric=epoch_loss / batch_cnt, full_models=True)
+
+        profiler.end_epoch(epoch, tb_manager, batch_cnt - 1)
+
+    exporter.close()
+    checkpoints.close()
+    tb_manager.close()
 
 
 def main():
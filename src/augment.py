@@ -0,0 +1,185 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import blocks
+import maskgen
+import utils
+
+bits = 10
+bit_values = 1 << np.arange(bits - 1, -1, -1)
+
+
+def get_block_cycle(block_id, convert_func):
+    # Every block the conversion passes through before it comes back to block_id
+    cycle = [block_id]
+    converted = convert_func(block_id)
+    while converted != block_id and len(cycle) < 4:
+        cycle.append(converted)
+        converted = convert_func(converted)
+    return cycle
+
+
+def build_block_lut(block_forward, block_backward, convert_func, turns=2):
+    # Maps an encoded block index to the encoded index of the converted block. A block only converts when every
+    # block of its cycle is in the encoding, otherwise the lut would no longer be a permutation.
+    lut = np.arange(1 << bits)
+    for code, block_id in block_backward.items():
+        cycle = get_block_cycle(block_id, convert_func)
+        if all(cycle_id in block_forward for cycle_id in cycle):
+            lut[code] = block_forward[convert_func(block_id)]
+
+    # Applying the conversion turns times has to give back every block, e.g. four rotations or two flips
+    assert np.array_equal(np.sort(lut), np.arange(1 << bits)), 'Block conversion is not a bijection'
+    identity = np.arange(1 << bits)
+    for _ in range(turns):
+        identity = lut[identity]
+    assert np.array_equal(identity, np.arange(1 << bits)), f'Block conversion is not undone by {turns} turns'
+    return lut
+
+
+def remap_encoded(batch, lut):
+    # Works directly on sigmoid encoded batches, (N, w, h, 10) bits -> block index -> lut -> bits
+    codes = np.tensordot(batch, bit_values, axes=([3], [0])).astype(int)
+    remapped = lut[codes]
+    return ((remapped[..., None] & bit_values) > 0).astype(batch.dtype)
+
+
+class RandomRotate:
+    # Rotates each crop by a random multiple of 90 degrees, the same direction as utils.rotate_world90
+
+    def __init__(self, block_forward, block_backward):
+        lut = build_block_lut(block_forward, block_backward, blocks.rotate_block, turns=4)
+        self.luts = [np.arange(1 << bits), lut, lut[lut], lut[lut[lut]]]
+
+    def __call__(self, batch, random):
+        turns = random.randint(0, 4, size=batch.shape[0])
+        result = np.copy(batch)
+        for k in range(1, 4):
+            selected = turns == k
+            if np.any(selected):
+                rotated = np.rot90(batch[selected], k, axes=(1, 2))
+                result[selected] = remap_encoded(rotated, self.luts[k])
+        return result
+
+
+class RandomFlip:
+    # Mirrors crops along either axis, swapping directional blocks to match
+
+    def __init__(self, block_forward, block_backward):
+        self.lut_x = build_block_lut(block_forward, block_backward, blocks.flip_block_x)
+        self.lut_y = build_block_lut(block_forward, block_backward, blocks.flip_block_y)
+
+    def __call__(self, batch, random):
+        result = np.copy(batch)
+
+        flip_x = random.rand(batch.shape[0]) < 0.5
+        if np.any(flip_x):
+            result[flip_x] = remap_encoded(result[flip_x, ::-1, :, :], self.lut_x)
+
+        flip_y = random.rand(batch.shape[0]) < 0.5
+        if np.any(flip_y):
+            result[flip_y] = remap_encoded(result[flip_y, :, ::-1, :], self.lut_y)
+
+        return result
+
+
+class RandomJitter:
+    # Shifts each crop by up to max_shift blocks, uncovered space is filled with empty blocks
+
+    def __init__(self, block_forward, max_shift=4):
+        self.max_shift = max_shift
+        empty_code = block_forward.get(0, 0)
+        self.empty = ((empty_code & bit_values) > 0).astype(np.int8)
+
+    def __call__(self, batch, random):
+        count, width, height = batch.shape[0], batch.shape[1], batch.shape[2]
+        shift_x = random.randint(-self.max_shift, self.max_shift + 1, size=(count, 1))
+        shift_y = random.randint(-self.max_shift, self.max_shift + 1, size=(count, 1))
+
+        rows = np.arange(width)[None, :] - shift_x
+        cols = np.arange(height)[None, :] - shift_y
+        valid = ((rows >= 0) & (rows < width))[:, :, None] & ((cols >= 0) & (cols < height))[:, None, :]
+
+        result = batch[np.arange(count)[:, None, None], np.clip(rows, 0, width - 1)[:, :, None],
+                       np.clip(cols, 0, height - 1)[:, None, :]]
+        result[~valid] = self.empty.astype(batch.dtype)
+        return result
+
+
+class HighMasks:
+
+    def __init__(self, mask_bank=None):
+        self.mask_bank = mask_bank
+
+    def __call__(self, shape, random):
+        if self.mask_bank is not None:
+            return self.mask_bank.sample(shape[0], random)
+        return maskgen.random_masks_high(shape[0], shape[1], shape[2], random=random)
+
+
+class LowMasks:
+
+    def __call__(self, shape, random):
+        return maskgen.random_masks_low(shape[0], shape[1], shape[2], random=random)
+
+
+class AugmentStage:
+    # Runs the transforms and masking for upcoming batches on a thread pool while the current batch trains.
+    # Every batch gets its own generator seeded from (seed, epoch, batch) so results do not depend on
+    # thread scheduling, and at most max_in_flight batches are prepared ahead of the training loop.
+
+    def __init__(self, batcher, transforms=None, masks=None, workers=2, max_in_flight=4, seed=0):
+        self.batcher = batcher
+        self.transforms = transforms if transforms is not None else []
+        self.masks = masks
+        self.seed = seed
+        self.max_in_flight = max_in_flight
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+
+        # One output slot per batch that can be in flight or held by the training loop
+        self.slot_count = max_in_flight + 1
+        shape = (batcher.batch_size,) + batcher.arrays[0].shape[1:]
+        self.world_slots = [np.empty(shape, dtype=batcher.arrays[0].dtype) for _ in range(self.slot_count)]
+        self.masked_slots = [np.empty(shape, dtype=batcher.arrays[0].dtype) for _ in range(self.slot_count)]
+
+    def prepare(self, epoch, batch, batch_indices):
+        random = np.random.RandomState([self.seed, epoch, batch])
+        slot = batch % self.slot_count
+
+        world_batch = self.world_slots[slot][:len(batch_indices)]
+        np.take(self.batcher.arrays[0], batch_indices, axis=0, out=world_batch)
+
+        for transform in self.transforms:
+            world_batch = transform(world_batch, random)
+
+        if self.masks is None:
+            return world_batch
+
+        masks = self.masks(world_batch.shape, random)
+        masked = utils.apply_masks(world_batch, masks, self.masked_slots[slot][:len(batch_indices)])
+        return world_batch, masked, masks
+
+    def epoch(self, epoch):
+        # Indices are read on submit, so the batcher must not be reshuffled while an epoch is running
+        batch_cnt = self.batcher.batch_count
+        pending = deque()
+        next_batch = 0
+
+        while next_batch < batch_cnt and len(pending) < self.max_in_flight:
+            pending.append(self.pool.submit(self.prepare, epoch, next_batch,
+                                            self.batcher.get_batch_indices(next_batch)))
+            next_batch += 1
+
+        while len(pending) > 0:
+            yield pending.popleft().result()
+
+            # The training loop is done with the previous batch, so its slot can be refilled
+            if next_batch < batch_cnt:
+                pending.append(self.pool.submit(self.prepare, epoch, next_batch,
+                                                self.batcher.get_batch_indices(next_batch)))
+                next_batch += 1
+
+    def close(self):
+        self.pool.shutdown(wait=True)
@@ -12,8 +12,14 @@ from keras.models import Sequential, load_model
 from keras.optimizers import Adam
 
 import utils
+from batcher import BatchAssembler
+from checkpoints import CheckpointManager, capture_training_state, load_dataset_snapshot, restore_optimizer, \
+    restore_training_state, save_dataset_snapshot
+from exporter import PreviewExporter
 from loadworker import load_worlds, load_world
+from profiler import StepProfiler
 from tbmanager import TensorboardManager
+from worldcache import WorldCache, default_cache_dir
 
 
 def autoencoder_model(size):
@@ -60,7 +66,7 @@ def autoencoder_model(size):
     return model
 
 
-def train(epochs, batch_size, world_count, version_name=None):
+def train(epochs, batch_size, world_count, version_name=None, profile=False):
     cur_dir = os.getcwd()
     res_dir = os.path.abspath(os.path.join(cur_dir, '..', 'res'))
     all_models_dir = os.path.abspath(os.path.join(cur_dir, '..', 'models'))
@@ -80,6 +86,7 @@ def train(epochs, batch_size, world_count, version_name=None):
     previews_dir = utils.check_or_create_local_path('previews', version_dir)
     model_save_dir = utils.check_or_create_local_path('models', version_dir)
 
+    checkpoints = CheckpointManager(model_save_dir)
     latest_epoch = utils.get_latest_epoch(model_save_dir)
     initial_epoch = latest_epoch + 1
 
@@ -111,6 +118,7 @@ def train(epochs, batch_size, world_count, version_name=None):
             print('Compiling model...')
             ae_optim = Adam(lr=0.0001)
             ae.compile(loss='binary_crossentropy', optimizer=ae_optim)
+            restore_optimizer(ae, f'{version_dir}\\models\\epoch{latest_epoch}\\autoencoder.optimizer.npz')
             loaded_model = True
 
     # Model was not loaded, compile new one
@@ -130,70 +138,94 @@ def train(epochs, batch_size, world_count, version_name=None):
     print('Saving model images...')
     keras.utils.plot_model(ae, to_file=f'{version_dir}\\autoencoder.png', show_shapes=True, show_layer_names=True)
 
-    # Load Data
-    print('Loading worlds...')
-    x_train = load_worlds(world_count, f'{res_dir}\\worlds\\', (112, 112), block_forward)
+    # Load Data, a resumed version trains on the same crops as before
+    x_train = None if no_version else load_dataset_snapshot(version_dir)
+    resume_data = x_train is not None
+    if resume_data:
+        print('Loaded dataset snapshot.')
+    else:
+        print('Loading worlds...')
+        x_train = load_worlds(world_count, f'{res_dir}\\worlds\\', (112, 112), block_forward, use_dataset_cache=True)
+        save_dataset_snapshot(version_dir, x_train)
 
     # Start Training loop
-    world_count = x_train.shape[0]
-    batch_cnt = (world_count - (world_count % batch_size)) // batch_size
+    batcher = BatchAssembler(x_train, batch_size)
+    batch_cnt = batcher.batch_count
+
+    start_batch = 0
+    resume_loss = 0.0
+    training_state = checkpoints.load_training_state(checkpoints.get_latest_checkpoint())
+    if resume_data and training_state is not None:
+        initial_epoch, start_batch, resume_loss = restore_training_state(training_state, batcher)
+        print(f'Resuming at epoch {initial_epoch}, batch {start_batch}')
 
     # Set up tensorboard
     print('Setting up tensorboard...')
     tb_manager = TensorboardManager(graph_version_dir, batch_cnt)
+    exporter = PreviewExporter(block_images, block_backward)
+    profiler = StepProfiler(profile, f'{version_dir}\\profile.json')
 
     for epoch in range(initial_epoch, epochs):
 
         # Create directories for current epoch
         cur_worlds_cur = utils.check_or_create_local_path(f'epoch{epoch}', worlds_dir)
         cur_previews_dir = utils.check_or_create_local_path(f'epoch{epoch}', previews_dir)
-        cur_models_dir = utils.check_or_create_local_path(f'epoch{epoch}', model_save_dir)
 
-        print('Shuffling data...')
-        np.random.shuffle(x_train)
+        # A resumed epoch continues in its saved order
+        first_batch = start_batch if epoch == initial_epoch else 0
+        if first_batch == 0:
+            print('Shuffling data...')
+            batcher.shuffle()
 
-        for batch in range(batch_cnt):
+        epoch_loss = resume_loss if epoch == initial_epoch else 0.0
+        for batch in range(first_batch, batch_cnt):
 
             # Get real set of images
-            world_batch = x_train[batch * batch_size:(batch + 1) * batch_size]
+            with profiler.phase('data'):
+                world_batch = batcher.get_batch(batch)
 
             # Train
-            loss = ae.train_on_batch(world_batch, world_batch)
+            with profiler.phase('train'):
+                loss = ae.train_on_batch(world_batch, world_batch)
 
             # Save snapshot of generated images on last batch
             if batch == batch_cnt - 1:
+                with profiler.phase('preview'):
 
-                # Generate samples
-                generated = ae.predict(world_batch)
+                    # Generate samples
+                    generated = ae.predict(world_batch)
+                    tb_manager.log_histogram('generated', epoch, batch, generated)
 
-                # Save samples
-                for image_num in range(batch_size):
-                    generated_world = generated[image_num]
-                    decoded_world = utils.decode_world_sigmoid(block_backward, generated_world)
-                    utils.save_world_data(decoded_world, f'{cur_worlds_cur}\\world{image_num}.world')
-                    utils.save_world_preview(block_images, decoded_world,
-                                             f'{cur_previews_dir}\\preview{image_num}.png')
+                    # Save samples
+                    for image_num in range(batch_size):
+                        exporter.export_world(generated[image_num], f'{cur_previews_dir}\\preview{image_num}.png',
+                                              f'{cur_worlds_cur}\\world{image_num}.world')
 
-                # Save actual worlds
-                for image_num in range(batch_size):
-                    actual_world = world_batch[image_num]
-                    decoded_world = utils.decode_world_sigmoid(block_backward, actual_world)
-                    utils.save_world_preview(block_images, decoded_world,
-                                             f'{cur_previews_dir}\\actual{image_num}.png')
+                    # Save actual worlds
+                    for image_num in range(batch_size):
+                        exporter.export_world(world_batch[image_num], f'{cur_previews_dir}\\actual{image_num}.png')
 
             # Write loss
-            tb_manager.log_var('ae_loss', epoch, batch, loss)
+            with profiler.phase('logging'):
+                tb_manager.log_var('ae_loss', epoch, batch, loss)
+                tb_manager.log_step_time(epoch, batch)
+                epoch_loss += loss
 
-            print(f'epoch [{epoch}/{epochs}] :: batch [{batch}/{batch_cnt}] :: loss = {loss}')
+                print(f'epoch [{epoch}/{epochs}] :: batch [{batch}/{batch_cnt}] :: loss = {loss}')
 
             # Save models
             if batch % 100 == 99 or batch == batch_cnt - 1:
                 print('Saving models...')
-                try:
-                    ae.save(f'{cur_models_dir}\\autoencoder.h5')
-                    ae.save_weights(f'{cur_models_dir}\\autoencoder.weights')
-                except ImportError:
-                    print('Failed to save data.')
+                with profiler.phase('checkpoint'):
+                    training_state = capture_training_state(epoch, batch, batch_cnt, batcher, epoch_loss)
+                    checkpoints.save(epoch, {'autoencoder': ae}, metric=epoch_loss / (batch + 1),
+                                     full_models=batch == batch_cnt - 1, batch=batch, training_state=training_state)
+
+        profiler.end_epoch(epoch, tb_manager, batch_cnt - 1)
+
+    exporter.close()
+    checkpoints.close()
+    tb_manager.close()
 
 
 def predict_sample_matlab(network_ver, samples):
@@ -209,7 +241,13 @@ def predict_sample_matlab(network_ver, samples):
 
     print('Loading model...')
     latest_epoch = utils.get_latest_epoch(model_save_dir)
-    auto_encoder = load_model(f'{model_save_dir}\\epoch{latest_epoch}\\autoencoder.h5')
+
+    # Checkpoints saved mid epoch only hold weights, the full model is written at the end of an epoch
+    if os.path.exists(f'{model_save_dir}\\epoch{latest_epoch}\\autoencoder.h5'):
+        auto_encoder = load_model(f'{model_save_dir}\\epoch{latest_epoch}\\autoencoder.h5')
+    else:
+        auto_encoder = autoencoder_model(112)
+        auto_encoder.load_weights(f'{model_save_dir}\\epoch{latest_epoch}\\autoencoder.weights')
 
     print('Loading block images...')
     block_images = utils.load_block_images(res_dir)
@@ -219,6 +257,7 @@ def predict_sample_matlab(network_ver, samples):
 
     x_worlds = os.listdir(f'{res_dir}\\worlds\\')
     np.random.shuffle(x_worlds)
+    world_cache = WorldCache(default_cache_dir(f'{res_dir}\\worlds\\'))
 
     world_size = auto_encoder.input_shape[1]
     dpi = 96
@@ -244,7 +283,7 @@ def predict_sample_matlab(network_ver, samples):
         world_id = utils.get_world_id(world_filename)
 
         # Load world and save preview
-        encoded_regions = load_world(world_file, (world_size, world_size), block_forward)
+        encoded_regions = load_world(world_file, (world_size, world_size), block_forward, world_cache=world_cache)
         if len(encoded_regions) == 0:
             continue
 
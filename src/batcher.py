@@ -0,0 +1,96 @@
+import numpy as np
+from keras.utils import Sequence
+
+
+class BatchAssembler:
+    # Keeps the dataset immutable and shuffles an index permutation instead of moving crops around.
+    # Batches are gathered into preallocated buffers that get reused between calls.
+
+    def __init__(self, arrays, batch_size, validation_split=0.0, seed=None, indices=None, drop_remainder=True):
+        self.single = not isinstance(arrays, (list, tuple))
+        self.arrays = [arrays] if self.single else list(arrays)
+        self.batch_size = batch_size
+        self.drop_remainder = drop_remainder
+        self.random = np.random.RandomState(seed)
+
+        if indices is None:
+            indices = np.arange(self.arrays[0].shape[0])
+
+        # Split train and validation by index so neither set is copied
+        indices = self.random.permutation(indices)
+        validation_count = int(len(indices) * validation_split)
+        self.validation_indices = np.sort(indices[len(indices) - validation_count:])
+        self.train_indices = np.sort(indices[:len(indices) - validation_count])
+
+        self.permutation = np.copy(self.train_indices)
+        self.buffers = [np.empty((batch_size,) + array.shape[1:], dtype=array.dtype) for array in self.arrays]
+
+    @property
+    def sample_count(self):
+        return len(self.permutation)
+
+    @property
+    def batch_count(self):
+        if self.drop_remainder:
+            return self.sample_count // self.batch_size
+        return (self.sample_count + self.batch_size - 1) // self.batch_size
+
+    def shuffle(self):
+        self.random.shuffle(self.permutation)
+
+    def get_state(self):
+        # Everything needed to continue the current epoch in the same order and to shuffle the same way after it
+        return {'permutation': np.copy(self.permutation), 'random_state': self.random.get_state()}
+
+    def set_state(self, state):
+        self.permutation = np.copy(state['permutation'])
+        self.random.set_state(state['random_state'])
+
+    def get_batch_indices(self, batch):
+        # Sorted so the gather walks memory forwards
+        return np.sort(self.permutation[batch * self.batch_size:(batch + 1) * self.batch_size])
+
+    def get_batch(self, batch, copy=False, out=None):
+        # Gathers into the shared buffers unless copy is set or other buffers are given
+        batch_indices = self.get_batch_indices(batch)
+
+        buffers = self.buffers
+        if out is not None:
+            buffers = [out] if self.single else out
+
+        gathered = []
+        for array, buffer in zip(self.arrays, buffers):
+            if copy:
+                gathered.append(np.take(array, batch_indices, axis=0))
+            else:
+                batch_out = buffer[:len(batch_indices)]
+                np.take(array, batch_indices, axis=0, out=batch_out)
+                gathered.append(batch_out)
+
+        if self.single:
+            return gathered[0]
+        return gathered
+
+    def get_validation_assembler(self):
+        return BatchAssembler(self.arrays if not self.single else self.arrays[0], self.batch_size,
+                              indices=self.validation_indices, drop_remainder=False)
+
+
+class BatchSequence(Sequence):
+    # Feeds a BatchAssembler to fit_generator, batches are copied because keras queues them ahead of time
+
+    def __init__(self, assembler, shuffle=True):
+        self.assembler = assembler
+        self.shuffle = shuffle
+        if self.shuffle:
+            self.assembler.shuffle()
+
+    def __len__(self):
+        return self.assembler.batch_count
+
+    def __getitem__(self, batch):
+        return tuple(self.assembler.get_batch(batch, copy=True))
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            self.assembler.shuffle()
@@ -313,13 +313,13 @@ def get_block_category(block_id):
 
 def rotate_block(block_id):
     convert_map = {
-        0: 1,
         1: 2,
         2: 3,
         3: 1518,
         411: 412,
         412: 413,
-        413: 0,
+        413: 1519,
+        1519: 411,
         117: 114,
         114: 116,
         116: 115,
@@ -333,6 +333,38 @@ def rotate_block(block_id):
         return block_id
 
 
+def flip_block_x(block_id):
+    convert_map = {
+        1: 3,
+        3: 1,
+        411: 413,
+        413: 411,
+        114: 115,
+        115: 114
+    }
+
+    if block_id in convert_map:
+        return convert_map[block_id]
+    else:
+        return block_id
+
+
+def flip_block_y(block_id):
+    convert_map = {
+        2: 1518,
+        1518: 2,
+        412: 1519,
+        1519: 412,
+        116: 117,
+        117: 116
+    }
+
+    if block_id in convert_map:
+        return convert_map[block_id]
+    else:
+        return block_id
+
+
 def simplify_block(block_id):
     convert_map = {
         411: 1,
@@ -0,0 +1,326 @@
+import json
+import os
+import queue
+import threading
+import time
+
+import h5py
+import keras
+import keras.backend as K
+import numpy as np
+
+import utils
+from datasetcache import DatasetCache, get_cache_entry
+
+manifest_name = 'manifest.json'
+state_name = 'training_state.npz'
+dataset_name = 'dataset.npy'
+dataset_reference_name = 'dataset.json'
+
+
+def snapshot_weights(model):
+    # Copies the weights of every layer into memory, in the same layout keras uses for save_weights
+    snapshot = []
+    for layer in model.layers:
+        weights = layer.weights
+        snapshot.append((layer.name, [w.name for w in weights], K.batch_get_value(weights)))
+    return snapshot
+
+
+def write_weights(snapshot, file):
+    # Writes a snapshot as a keras hdf5 weight file, so it can be read back with model.load_weights
+    temp_file = f'{file}.tmp'
+    with h5py.File(temp_file, 'w') as f:
+        f.attrs['layer_names'] = [layer_name.encode('utf8') for layer_name, _, _ in snapshot]
+        f.attrs['backend'] = K.backend().encode('utf8')
+        f.attrs['keras_version'] = str(keras.__version__).encode('utf8')
+
+        for layer_name, weight_names, weight_values in snapshot:
+            group = f.create_group(layer_name)
+            group.attrs['weight_names'] = [name.encode('utf8') for name in weight_names]
+            for name, value in zip(weight_names, weight_values):
+                dataset = group.create_dataset(name, value.shape, dtype=value.dtype)
+                if not value.shape:
+                    dataset[()] = value
+                else:
+                    dataset[:] = value
+
+    os.replace(temp_file, file)
+
+
+def snapshot_optimizer(model):
+    optimizer = getattr(model, 'optimizer', None)
+    if optimizer is None or len(optimizer.weights) == 0:
+        return None
+    return K.batch_get_value(optimizer.weights)
+
+
+def restore_optimizer(model, file):
+    # Same as keras load_model, the train function has to exist before the optimizer has weights to set
+    if not os.path.exists(file):
+        return False
+
+    with np.load(file) as data:
+        values = [data[f'arr_{i}'] for i in range(len(data.files))]
+
+    model._make_train_function()
+    model.optimizer.set_weights(values)
+    return True
+
+
+def write_npz(file, values):
+    temp_file = f'{file}.tmp'
+    with open(temp_file, 'wb') as fp:
+        if isinstance(values, dict):
+            np.savez(fp, **values)
+        else:
+            np.savez(fp, *values)
+    os.replace(temp_file, file)
+
+
+def pack_random_state(prefix, random_state, values):
+    values[f'{prefix}_keys'] = random_state[1]
+    values[f'{prefix}_pos'] = random_state[2]
+    values[f'{prefix}_has_gauss'] = random_state[3]
+    values[f'{prefix}_cached_gaussian'] = random_state[4]
+
+
+def unpack_random_state(prefix, values):
+    return ('MT19937', values[f'{prefix}_keys'], int(values[f'{prefix}_pos']), int(values[f'{prefix}_has_gauss']),
+            float(values[f'{prefix}_cached_gaussian']))
+
+
+def capture_training_state(epoch, batch, batch_cnt, batcher, epoch_loss=0.0):
+    # Called after a batch has been trained, records the position training continues from
+    next_epoch, next_batch = (epoch, batch + 1) if batch + 1 < batch_cnt else (epoch + 1, 0)
+
+    batcher_state = batcher.get_state()
+    state = {'epoch': next_epoch, 'batch': next_batch, 'epoch_loss': epoch_loss if next_batch > 0 else 0.0,
+             'permutation': batcher_state['permutation']}
+    pack_random_state('batcher_random', batcher_state['random_state'], state)
+    pack_random_state('numpy_random', np.random.get_state(), state)
+    return state
+
+
+def restore_training_state(state, batcher):
+    # Returns the epoch and batch to continue from and the loss accumulated so far in that epoch
+    batcher.set_state({'permutation': state['permutation'],
+                       'random_state': unpack_random_state('batcher_random', state)})
+    np.random.set_state(unpack_random_state('numpy_random', state))
+    return int(state['epoch']), int(state['batch']), float(state['epoch_loss'])
+
+
+def save_dataset_snapshot(version_dir, x):
+    # The crops a version trains on are kept next to its models, so resuming does not load and crop worlds again.
+    # Crops that already live in the dataset cache are only referenced by their cache key instead of copied
+    entry = get_cache_entry(x)
+    if entry is not None:
+        cache_dir, key = entry
+        reference_file = os.path.join(version_dir, dataset_reference_name)
+        with open(f'{reference_file}.tmp', 'w') as fp:
+            json.dump({'cache_dir': cache_dir, 'key': key}, fp, indent=2)
+        os.replace(f'{reference_file}.tmp', reference_file)
+        return
+
+    dataset_file = os.path.join(version_dir, dataset_name)
+    temp_file = f'{dataset_file}.tmp'
+    with open(temp_file, 'wb') as fp:
+        np.save(fp, x)
+    os.replace(temp_file, dataset_file)
+
+
+def load_dataset_snapshot(version_dir):
+    dataset_file = os.path.join(version_dir, dataset_name)
+    if os.path.exists(dataset_file):
+        return np.load(dataset_file, mmap_mode='r')
+
+    reference_file = os.path.join(version_dir, dataset_reference_name)
+    if not os.path.exists(reference_file):
+        return None
+
+    try:
+        with open(reference_file, 'r') as fp:
+            reference = json.load(fp)
+    except (IOError, ValueError):
+        return None
+
+    arrays = DatasetCache(reference['cache_dir']).get(reference['key'])
+    if arrays is None:
+        print('The cached dataset of this version was evicted, loading worlds again.')
+        return None
+    return arrays[0]
+
+
+def load_manifest(model_save_dir):
+    manifest_file = os.path.join(model_save_dir, manifest_name)
+    if not os.path.exists(manifest_file):
+        return None
+
+    try:
+        with open(manifest_file, 'r') as fp:
+            return json.load(fp)
+    except (IOError, ValueError):
+        return None
+
+
+class CheckpointManager:
+    # Saves model weights from a background thread and keeps only the last keep_last epochs plus the
+    # keep_best epochs with the best metric. Weights are copied to memory on the training thread, so training
+    # can continue while they are written. A snapshot that is superseded by a newer one for the same epoch
+    # before it gets written is dropped. Full .h5 models include the optimizer state and are only saved when
+    # full_models is set, since the .weights files already hold the same weights.
+    # Every write updates manifest.json, which utils.get_latest_epoch reads instead of scanning epoch folders.
+    # Optimizer state and an optional training state (data order, batch position and random state) are saved
+    # with the weights so training can continue from the exact batch it stopped at.
+
+    def __init__(self, model_save_dir, keep_last=3, keep_best=2, mode='min', max_queued=2):
+        self.model_save_dir = model_save_dir
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.mode = mode
+
+        self.manifest = load_manifest(model_save_dir)
+        if self.manifest is None:
+            self.manifest = {'mode': mode, 'checkpoints': []}
+
+        self.lock = threading.Lock()
+        self.latest_sequence = {}
+        self.sequence = 0
+        self.jobs = queue.Queue(maxsize=max_queued)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def save(self, epoch, models, metric=None, full_models=False, batch=None, training_state=None,
+             optimizer_models=None):
+        # models maps a file name to a model, e.g. {'generator': g, 'discriminator': d}. The optimizer state of
+        # optimizer_models is saved, which defaults to every model in models. Full models already hold it.
+        if optimizer_models is None:
+            optimizer_models = models
+        if full_models:
+            optimizer_models = {name: model for name, model in optimizer_models.items() if name not in models}
+
+        epoch_dir = utils.check_or_create_local_path(f'epoch{epoch}', self.model_save_dir)
+
+        files = []
+        if full_models:
+            for name, model in models.items():
+                try:
+                    model.save(f'{epoch_dir}{name}.h5')
+                    files.append(f'{name}.h5')
+                except ImportError:
+                    print('Failed to save data.')
+
+        snapshots = {name: snapshot_weights(model) for name, model in models.items()}
+        optimizer_snapshots = {name: snapshot_optimizer(model) for name, model in optimizer_models.items()}
+
+        with self.lock:
+            self.sequence += 1
+            self.latest_sequence[epoch] = self.sequence
+            job = (self.sequence, epoch, batch, epoch_dir, snapshots, optimizer_snapshots, training_state, files,
+                   metric)
+
+        # Blocks when the writer falls behind
+        self.jobs.put(job)
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                self.jobs.task_done()
+                return
+
+            try:
+                self.write(*job)
+            except Exception as e:
+                # Anything escaping here would end the writer thread and leave wait and close blocked forever
+                print(f'Failed to write checkpoint: {e}')
+            finally:
+                self.jobs.task_done()
+
+    def write(self, sequence, epoch, batch, epoch_dir, snapshots, optimizer_snapshots, training_state, files,
+              metric):
+        with self.lock:
+            if self.latest_sequence.get(epoch, sequence) > sequence:
+                # A newer snapshot of this epoch is queued
+                return
+
+        for name, snapshot in snapshots.items():
+            write_weights(snapshot, f'{epoch_dir}{name}.weights')
+            files.append(f'{name}.weights')
+
+        for name, values in optimizer_snapshots.items():
+            if values is not None:
+                write_npz(f'{epoch_dir}{name}.optimizer.npz', values)
+                files.append(f'{name}.optimizer.npz')
+
+        if training_state is not None:
+            write_npz(f'{epoch_dir}{state_name}', training_state)
+            files.append(state_name)
+
+        # The training thread reads the manifest through get_latest_checkpoint and get_best_epoch
+        with self.lock:
+            # Keep files from earlier full model saves of the same epoch
+            checkpoints = self.manifest['checkpoints']
+            previous = [c for c in checkpoints if c['epoch'] == epoch]
+            if len(previous) > 0:
+                files = sorted(set(files) | set(previous[0]['files']))
+
+            checkpoints = [c for c in checkpoints if c['epoch'] != epoch]
+            checkpoints.append({'epoch': epoch, 'batch': batch, 'metric': metric, 'files': files,
+                                'time': time.time()})
+            checkpoints.sort(key=lambda c: c['epoch'])
+            self.manifest['checkpoints'] = self.apply_retention(checkpoints)
+            self.write_manifest()
+
+    def apply_retention(self, checkpoints):
+        keep = set(c['epoch'] for c in checkpoints[-self.keep_last:])
+
+        scored = [c for c in checkpoints if c['metric'] is not None]
+        scored.sort(key=lambda c: c['metric'], reverse=self.mode == 'max')
+        keep.update(c['epoch'] for c in scored[:self.keep_best])
+
+        kept = []
+        for checkpoint in checkpoints:
+            if checkpoint['epoch'] in keep:
+                kept.append(checkpoint)
+            else:
+                utils.delete_folder(os.path.join(self.model_save_dir, f'epoch{checkpoint["epoch"]}'))
+        return kept
+
+    def write_manifest(self):
+        manifest_file = os.path.join(self.model_save_dir, manifest_name)
+        with open(f'{manifest_file}.tmp', 'w') as fp:
+            json.dump(self.manifest, fp, indent=2)
+        os.replace(f'{manifest_file}.tmp', manifest_file)
+
+    def get_latest_checkpoint(self):
+        with self.lock:
+            checkpoints = self.manifest['checkpoints']
+            if len(checkpoints) == 0:
+                return None
+            return max(checkpoints, key=lambda c: c['epoch'])
+
+    def get_epoch_dir(self, epoch):
+        return os.path.join(self.model_save_dir, f'epoch{epoch}')
+
+    def load_training_state(self, checkpoint):
+        if checkpoint is None or state_name not in checkpoint['files']:
+            return None
+
+        with np.load(os.path.join(self.get_epoch_dir(checkpoint['epoch']), state_name)) as data:
+            return {key: data[key] for key in data.files}
+
+    def get_best_epoch(self):
+        with self.lock:
+            scored = [c for c in self.manifest['checkpoints'] if c['metric'] is not None]
+        if len(scored) == 0:
+            return -1
+        best = min(scored, key=lambda c: c['metric'] if self.mode == 'min' else -c['metric'])
+        return best['epoch']
+
+    def wait(self):
+        self.jobs.join()
+
+    def close(self):
+        self.jobs.put(None)
+        self.thread.join()
@@ -0,0 +1,236 @@
+import os
+import time
+from multiprocessing import get_context
+
+import keras.backend as K
+import numpy as np
+from keras.optimizers import Adam
+
+from batcher import BatchAssembler, BatchSequence
+
+
+class SharedAllReduce:
+    # Averages a flat float vector between the worker processes of one machine through shared memory.
+    # Every rank writes its vector into its own row, then sums one slice of the rows into the result, so the
+    # reduction work is split between the ranks like a reduce-scatter followed by an all-gather.
+
+    def __init__(self, rows_buffer, result_buffer, barrier, rank, world_size):
+        self.rows = np.frombuffer(rows_buffer, dtype=np.float32).reshape((world_size, -1))
+        self.result = np.frombuffer(result_buffer, dtype=np.float32)
+        self.barrier = barrier
+        self.rank = rank
+        self.world_size = world_size
+
+        length = self.rows.shape[1]
+        bounds = np.linspace(0, length, world_size + 1).astype(int)
+        self.start = bounds[rank]
+        self.end = bounds[rank + 1]
+
+    def all_reduce(self, values):
+        self.rows[self.rank, :len(values)] = values
+        self.barrier.wait()
+
+        self.result[self.start:self.end] = self.rows[:, self.start:self.end].mean(axis=0)
+        self.barrier.wait()
+
+        # Nobody writes the result again before every rank has passed the first barrier of the next call
+        return np.copy(self.result[:len(values)])
+
+
+class ParallelTrainer:
+    # Replaces train_on_batch with a step that computes gradients locally, averages them with the other workers
+    # and applies the average with the model's own optimizer, so every worker keeps identical weights.
+
+    def __init__(self, model, reducer):
+        self.model = model
+        self.reducer = reducer
+
+        params = model._collected_trainable_weights
+        self.shapes = [K.int_shape(p) for p in params]
+        self.sizes = [int(np.prod(shape)) for shape in self.shapes]
+
+        inputs = model._feed_inputs + model._feed_targets + model._feed_sample_weights
+        self.uses_learning_phase = model._uses_dynamic_learning_phase()
+        if self.uses_learning_phase:
+            inputs = inputs + [K.learning_phase()]
+
+        # Batch norm statistics are updated locally and synced with the weights at the end of each epoch
+        grads = K.gradients(model.total_loss, params)
+        updates = model.updates + getattr(model, 'metrics_updates', [])
+        self.grad_function = K.function(inputs, [model.total_loss] + model.metrics_tensors + grads, updates=updates)
+        self.metric_count = 1 + len(model.metrics_tensors)
+
+        grad_inputs = [K.placeholder(shape=shape) for shape in self.shapes]
+        model.optimizer.get_gradients = lambda loss, variables: grad_inputs
+        optimizer_updates = model.optimizer.get_updates(loss=model.total_loss, params=params)
+        self.apply_function = K.function(grad_inputs, [], updates=optimizer_updates)
+
+    def train_on_batch(self, x, y):
+        inputs = [x, y, np.ones((x.shape[0],), dtype=np.float32)]
+        if self.uses_learning_phase:
+            inputs.append(1)
+
+        outputs = self.grad_function(inputs)
+        flat = np.concatenate([np.array(outputs[:self.metric_count], dtype=np.float32).ravel()] +
+                              [grad.ravel() for grad in outputs[self.metric_count:]])
+        mean = self.reducer.all_reduce(flat)
+
+        grads = []
+        offset = self.metric_count
+        for shape, size in zip(self.shapes, self.sizes):
+            grads.append(mean[offset:offset + size].reshape(shape))
+            offset += size
+        self.apply_function(grads)
+
+        return mean[:self.metric_count]
+
+    def broadcast_weights(self, weights_buffer):
+        # Copies rank 0's weights, including non trainable ones like batch norm statistics, to every worker
+        flat = np.frombuffer(weights_buffer, dtype=np.float32)
+        if self.reducer.rank == 0:
+            flat[:] = np.concatenate([w.ravel() for w in self.model.get_weights()])
+        self.reducer.barrier.wait()
+
+        if self.reducer.rank != 0:
+            weights = []
+            offset = 0
+            for w in self.model.get_weights():
+                weights.append(flat[offset:offset + w.size].reshape(w.shape).astype(w.dtype))
+                offset += w.size
+            self.model.set_weights(weights)
+        self.reducer.barrier.wait()
+
+
+def get_shared_file(array, file):
+    # Workers memory map the dataset, arrays that already come from a .npy file are not written again
+    if isinstance(array, np.memmap) and array.filename is not None and array.filename.endswith('.npy'):
+        return array.filename
+
+    np.save(file, array)
+    return file
+
+
+def run_worker(rank, world_size, config, shared):
+    x = np.load(config['x_file'], mmap_mode='r')
+    y = np.load(config['y_file'], mmap_mode='r')
+
+    model = config['build_func'](*config['build_args'])
+    model.compile(loss='binary_crossentropy', optimizer=Adam(lr=config['lr']), metrics=['accuracy'])
+
+    reducer = SharedAllReduce(shared['rows'], shared['result'], shared['barrier'], rank, world_size)
+    trainer = ParallelTrainer(model, reducer)
+    trainer.broadcast_weights(shared['weights'])
+
+    # Every rank makes the same split, then trains on an equally sized shard of the training indices
+    batch_size = config['batch_size']
+    full_batcher = BatchAssembler([x, y], batch_size, validation_split=config['validation_split'],
+                                  seed=config['seed'])
+    shard_size = len(full_batcher.train_indices) // world_size
+    shard = full_batcher.train_indices[rank::world_size][:shard_size]
+    batcher = BatchAssembler([x, y], batch_size, seed=config['seed'] + rank, indices=shard)
+    batch_cnt = batcher.batch_count
+
+    tb_manager = None
+    if rank == 0:
+        from tbmanager import TensorboardManager
+        tb_manager = TensorboardManager(config['graph_dir'], batch_cnt)
+
+    model_save_dir = config['model_save_dir']
+    best_acc = -1
+    for epoch in range(config['initial_epoch'], config['epochs']):
+        batcher.shuffle()
+        epoch_start_time = time.time()
+        epoch_metrics = np.zeros(trainer.metric_count)
+
+        for batch in range(batch_cnt):
+            x_batch, y_batch = batcher.get_batch(batch)
+            metrics = trainer.train_on_batch(x_batch, y_batch)
+            epoch_metrics += metrics
+
+            if rank == 0:
+                tb_manager.log_var('loss', epoch, batch, metrics[0])
+                tb_manager.log_var('acc', epoch, batch, metrics[1])
+                if batch % 100 == 0 or batch == batch_cnt - 1:
+                    print(f'epoch [{epoch}/{config["epochs"]}] :: batch [{batch}/{batch_cnt}] :: '
+                          f'loss = {metrics[0]} :: acc = {metrics[1]}')
+
+        trainer.broadcast_weights(shared['weights'])
+
+        # Rank 0 holds the synchronized weights, so it alone validates and writes the checkpoints
+        if rank == 0:
+            epoch_metrics /= batch_cnt
+            samples_per_sec = batch_cnt * batch_size * world_size / max(time.time() - epoch_start_time, 1e-6)
+            print(f'Epoch {epoch} :: loss = {epoch_metrics[0]} :: acc = {epoch_metrics[1]} :: '
+                  f'{samples_per_sec:.1f} samples/sec on {world_size} workers')
+
+            validation_sequence = BatchSequence(full_batcher.get_validation_assembler(), shuffle=False)
+            if len(validation_sequence) > 0:
+                val_loss, val_acc = model.evaluate_generator(validation_sequence)
+                tb_manager.log_var('val_loss', epoch, batch_cnt - 1, val_loss)
+                tb_manager.log_var('val_acc', epoch, batch_cnt - 1, val_acc)
+                print(f'Epoch {epoch} :: val_loss = {val_loss} :: val_acc = {val_acc}')
+
+            try:
+                model.save(f'{model_save_dir}\\latest.h5')
+                model.save_weights(f'{model_save_dir}\\latest.weights')
+                if epoch_metrics[1] > best_acc:
+                    best_acc = epoch_metrics[1]
+                    model.save(f'{model_save_dir}\\best_acc.h5')
+            except ImportError:
+                print('Failed to save data.')
+
+        shared['barrier'].wait()
+
+    if tb_manager is not None:
+        tb_manager.close()
+
+
+def run_data_parallel(model, build_func, build_args, x, y, worker_count, epochs, batch_size, lr, model_save_dir,
+                      graph_dir, data_dir, initial_epoch=0, validation_split=0.2, seed=0):
+    # Trains copies of the model in worker_count processes on this machine with averaged gradients.
+    # model is only used to size the shared buffers, every worker builds its own with build_func(*build_args).
+    param_count = sum(int(np.prod(K.int_shape(w))) for w in model.trainable_weights)
+    metric_count = len(model.metrics_names)
+    weight_count = sum(w.size for w in model.get_weights())
+
+    # Spawn instead of fork, a forked tensorflow session is not safe to use
+    ctx = get_context('spawn')
+    shared = {
+        'rows': ctx.RawArray('f', worker_count * (param_count + metric_count)),
+        'result': ctx.RawArray('f', param_count + metric_count),
+        'weights': ctx.RawArray('f', weight_count),
+        'barrier': ctx.Barrier(worker_count)
+    }
+
+    config = {
+        'x_file': get_shared_file(x, os.path.join(data_dir, 'parallel_x.npy')),
+        'y_file': get_shared_file(y, os.path.join(data_dir, 'parallel_y.npy')),
+        'build_func': build_func,
+        'build_args': build_args,
+        'lr': lr,
+        'batch_size': batch_size,
+        'epochs': epochs,
+        'initial_epoch': initial_epoch,
+        'validation_split': validation_split,
+        'seed': seed,
+        'model_save_dir': model_save_dir,
+        'graph_dir': graph_dir
+    }
+
+    print(f'Starting {worker_count} training workers...')
+    workers = []
+    for rank in range(worker_count):
+        worker = ctx.Process(target=run_worker, args=(rank, worker_count, config, shared))
+        worker.start()
+        workers.append(worker)
+
+    # If one worker dies the others would wait at the barrier forever, so break it for them
+    while any(worker.is_alive() for worker in workers):
+        if any(worker.exitcode not in (None, 0) for worker in workers):
+            print('A training worker failed, stopping the others.')
+            shared['barrier'].abort()
+            break
+        time.sleep(1.0)
+
+    for worker in workers:
+        worker.join()
@@ -0,0 +1,159 @@
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+
+
+def default_dataset_cache_dir(world_directory):
+    return os.path.abspath(os.path.join(world_directory, '..', 'dataset_cache'))
+
+
+def get_corpus_version(world_directory):
+    # Changes whenever a world is added, removed or modified
+    corpus_hash = hashlib.sha1()
+    for entry in sorted(os.scandir(world_directory), key=lambda e: e.name):
+        if entry.is_file():
+            stat = entry.stat()
+            corpus_hash.update(f'{entry.name}|{stat.st_mtime_ns}|{stat.st_size}\n'.encode('utf8'))
+    return corpus_hash.hexdigest()
+
+
+def get_dict_hash(values):
+    if values is None:
+        return None
+    return hashlib.sha1(json.dumps(sorted((str(k), str(v)) for k, v in values.items())).encode('utf8')).hexdigest()
+
+
+def get_dataset_key(loader_name, world_directory, load_count, gen_size, block_forward, params):
+    key_params = {
+        'loader': loader_name,
+        'corpus': get_corpus_version(world_directory),
+        'load_count': load_count,
+        'gen_size': list(gen_size),
+        'encoding': get_dict_hash(block_forward)
+    }
+    key_params.update(params)
+    key_str = json.dumps(key_params, sort_keys=True, default=str)
+    return hashlib.sha1(key_str.encode('utf8')).hexdigest(), key_params
+
+
+def get_cache_entry(array):
+    # Returns (cache_dir, key) when array is memory mapped from a complete dataset cache entry, otherwise None
+    if not isinstance(array, np.memmap) or array.filename is None:
+        return None
+
+    cache_dir, name = os.path.split(array.filename)
+    key, _, index = os.path.splitext(name)[0].rpartition('_')
+    if key == '' or not index.isdigit() or not os.path.exists(os.path.join(cache_dir, f'{key}.json')):
+        return None
+    return cache_dir, key
+
+
+class DatasetCache:
+    # Materialized loader outputs stored as .npy files so later runs with the same load parameters can memory map
+    # them instead of loading and cropping worlds again. Every entry has a json file with the parameters it was
+    # made with, which is written last and marks the entry as complete.
+
+    def __init__(self, cache_dir, max_bytes=32 * 1024 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def get_array_file(self, key, index):
+        return os.path.join(self.cache_dir, f'{key}_{index}.npy')
+
+    def get_meta_file(self, key):
+        return os.path.join(self.cache_dir, f'{key}.json')
+
+    def get(self, key):
+        meta_file = self.get_meta_file(key)
+        if not os.path.exists(meta_file):
+            return None
+
+        try:
+            with open(meta_file, 'r') as fp:
+                meta = json.load(fp)
+            arrays = [np.load(self.get_array_file(key, i), mmap_mode='r') for i in range(meta['array_count'])]
+            os.utime(meta_file)
+        except (IOError, ValueError, KeyError):
+            return None
+
+        print(f'Opened cached dataset {key[:8]} with {arrays[0].shape[0]} samples.')
+        return arrays
+
+    def put(self, key, arrays, params=None):
+        try:
+            for i, array in enumerate(arrays):
+                array_file = self.get_array_file(key, i)
+                temp_file = f'{array_file}.{os.getpid()}.tmp'
+                with open(temp_file, 'wb') as fp:
+                    np.save(fp, array)
+                os.replace(temp_file, array_file)
+
+            meta = {'array_count': len(arrays), 'created': time.time(), 'params': params}
+            temp_file = f'{self.get_meta_file(key)}.{os.getpid()}.tmp'
+            with open(temp_file, 'w') as fp:
+                json.dump(meta, fp, indent=2, default=str)
+            os.replace(temp_file, self.get_meta_file(key))
+        except IOError:
+            print(f'Failed to cache dataset {key[:8]}')
+            return
+
+        self.evict(keep=key)
+
+    def evict(self, keep=None):
+        # Remove least recently used entries until the cache fits inside the byte budget. The meta file's mtime is
+        # the entry's last use, and an entry is only ever removed as a whole.
+        entry_sizes = {}
+        entry_times = {}
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            entry_file = os.path.join(self.cache_dir, name)
+            if name.endswith('.tmp'):
+                if time.time() - os.path.getmtime(entry_file) > 60 * 60:
+                    # Left over from a process that died while writing
+                    os.remove(entry_file)
+                continue
+
+            stat = os.stat(entry_file)
+            if name.endswith('.json'):
+                key = os.path.splitext(name)[0]
+                entry_times[key] = stat.st_mtime
+            else:
+                # Arrays of an entry still being written have no meta file yet, their own mtime stands in for it
+                key = os.path.splitext(name)[0].rpartition('_')[0]
+                entry_times.setdefault(key, stat.st_mtime)
+            entry_sizes[key] = entry_sizes.get(key, 0) + stat.st_size
+            total += stat.st_size
+
+        entries = sorted((entry_times[key], key) for key in entry_sizes if key != keep)
+        evicted = 0
+        for _, key in entries:
+            if total <= self.max_bytes:
+                break
+
+            try:
+                self.remove(key)
+                total -= entry_sizes[key]
+                evicted += 1
+            except OSError:
+                pass
+
+        if evicted > 0:
+            print(f'Evicted {evicted} datasets from cache.')
+
+    def remove(self, key):
+        # The meta file goes first so a partly removed entry is never opened
+        meta_file = self.get_meta_file(key)
+        if os.path.exists(meta_file):
+            os.remove(meta_file)
+        for name in os.listdir(self.cache_dir):
+            if name.startswith(key):
+                os.remove(os.path.join(self.cache_dir, name))
+
+    def clear(self):
+        for name in os.listdir(self.cache_dir):
+            os.remove(os.path.join(self.cache_dir, name))
@@ -2,24 +2,187 @@ import numpy as np
 import scipy
 import utils
 import os
+import time
+import traceback
 
 from keras.models import load_model
 from keras import backend as K
+from multiprocessing.connection import AuthenticationError, Listener
 import argparse
 
-global fetch_loss_and_grads
-fetch_loss_and_grads = None
-
-
-def eval_loss_and_grads(input_x):
-    outs = fetch_loss_and_grads([input_x])
-    loss_value = outs[0]
-    grad_values = outs[1]
-    return loss_value, grad_values
+from dreamclient import default_address, get_key_file, write_authkey
+
+# Presets for the feature coefficients of feature_layers
+feature_layers = ['max_pooling2d_1', 'max_pooling2d_2', 'max_pooling2d_3', 'max_pooling2d_4']
+presets = {
+    'subtle': [1.03186447, 4.94900884, 4.52247586, -1.00151375],
+    'colors': [2.84376834, -4.96601078, -0.03940069, -4.7203666]
+}
+
+
+class DreamEngine:
+    # Compiles the loss and gradient function once per layer set. The feature coefficients are an input of the
+    # function instead of constants in the graph, so every preset runs through the same function, and each world in
+    # a batch gets its own coefficients, loss and gradient normalization.
+
+    def __init__(self, model):
+        self.model = model
+        self.layer_dict = dict([(layer.name, layer) for layer in model.layers])
+        self.functions = {}
+
+    def get_function(self, layer_names):
+        key = tuple(layer_names)
+        if key in self.functions:
+            return self.functions[key]
+
+        dream = self.model.input
+        coefficients = K.placeholder(shape=(None, len(layer_names)))
+
+        # Define the loss of every world in the batch
+        loss = 0
+        for i, layer_name in enumerate(layer_names):
+            # Add the L2 norm of the features of a layer to the loss.
+            if layer_name not in self.layer_dict:
+                raise ValueError('Layer ' + layer_name + ' not found in model.')
+            x = self.layer_dict[layer_name].output
+            # We avoid border artifacts by only involving non-border pixels in the loss.
+            scaling = K.prod(K.cast(K.shape(x)[1:], 'float32'))
+            loss += coefficients[:, i] * K.sum(K.square(x[:, 2: -2, 2: -2, :]), axis=[1, 2, 3]) / scaling
+
+        # Worlds do not interact, so the gradient of the summed loss is the gradient of each world's own loss.
+        # Gradients are normalized outside the graph, so tiles of one world can share the normalization
+        grads = K.gradients(K.sum(loss), dream)[0]
+
+        self.functions[key] = K.function([dream, coefficients], [loss, grads])
+        return self.functions[key]
+
+    def get_loss_and_grads(self, grad_x, coefficients, layer_names, tile_size=None, overlap=32, tile_batch=8):
+        fetch_loss_and_grads = self.get_function(layer_names)
+        if tile_size is None:
+            loss_values, grad_values = fetch_loss_and_grads([grad_x, coefficients])
+        else:
+            loss_values, grad_values = self.get_tiled_loss_and_grads(fetch_loss_and_grads, grad_x, coefficients,
+                                                                     tile_size, overlap, tile_batch)
+
+        # Normalize the gradients of every world separately
+        grad_values /= np.maximum(np.mean(np.abs(grad_values), axis=(1, 2, 3), keepdims=True), K.epsilon())
+        return loss_values, grad_values
+
+    @staticmethod
+    def get_tiled_loss_and_grads(fetch_loss_and_grads, grad_x, coefficients, tile_size, overlap, tile_batch):
+        # Runs overlapping tiles through the model, tile_batch at a time so peak memory only depends on the tile size,
+        # and blends the tile gradients with weights that fade out towards the tile edges so seams do not show
+        world_count, width, height = grad_x.shape[:3]
+        tile_w = min(tile_size, width)
+        tile_h = min(tile_size, height)
+        x_starts = get_tile_starts(width, tile_w, overlap)
+        y_starts = get_tile_starts(height, tile_h, overlap)
+        weights = get_tile_weights(tile_w, tile_h, overlap)
+
+        tiles = [(i, x, y) for i in range(world_count) for x in x_starts for y in y_starts]
+        grad_sum = np.zeros(grad_x.shape, dtype=np.float32)
+        weight_sum = np.zeros((width, height, 1), dtype=np.float32)
+        for x in x_starts:
+            for y in y_starts:
+                weight_sum[x:x + tile_w, y:y + tile_h] += weights
+
+        loss_values = np.zeros(world_count, dtype=np.float32)
+        tile_input = np.empty((tile_batch, tile_w, tile_h, grad_x.shape[3]), dtype=np.float32)
+        tile_coefficients = np.empty((tile_batch, coefficients.shape[1]), dtype=np.float32)
+        for start in range(0, len(tiles), tile_batch):
+            batch_tiles = tiles[start:start + tile_batch]
+            for j, (i, x, y) in enumerate(batch_tiles):
+                tile_input[j] = grad_x[i, x:x + tile_w, y:y + tile_h]
+                tile_coefficients[j] = coefficients[i]
+
+            count = len(batch_tiles)
+            tile_losses, tile_grads = fetch_loss_and_grads([tile_input[:count], tile_coefficients[:count]])
+            for j, (i, x, y) in enumerate(batch_tiles):
+                grad_sum[i, x:x + tile_w, y:y + tile_h] += tile_grads[j] * weights
+                loss_values[i] += tile_losses[j]
+
+        # The loss of a world is the mean loss of its tiles
+        loss_values /= len(x_starts) * len(y_starts)
+        return loss_values, grad_sum / weight_sum
+
+    def gradient_ascent(self, grad_x, coefficients, layer_names, ascent_cnt, step_value, maximum_loss=None,
+                        tile_size=None, overlap=32, tile_batch=8):
+        # A world stops for the rest of the octave once its loss passes maximum_loss, the others continue
+        active = np.ones(grad_x.shape[0], dtype=bool)
+        for ascent_i in range(ascent_cnt):
+            loss_values, grad_values = self.get_loss_and_grads(grad_x[active], coefficients[active], layer_names,
+                                                               tile_size, overlap, tile_batch)
+            if maximum_loss is not None:
+                still_active = loss_values <= maximum_loss
+                grad_values = grad_values[still_active]
+                active[active] = still_active
+                if not active.any():
+                    break
+            grad_x[active] += step_value * grad_values
+        return grad_x
+
+    def dream(self, worlds_encoded, coefficients, layer_names=None, step=0.05, num_octave=4, octave_scale=1.1,
+              iterations=100, max_loss=3, tile_size=None, overlap=32, tile_batch=8):
+        # worlds_encoded is (batch, width, height, 10) and coefficients is (batch, len(layer_names)), either one
+        # can have a batch of 1 to use the same world or the same coefficients for the whole batch.
+        # With tile_size set, the model only ever sees tile_batch tiles of tile_size x tile_size at once
+        if layer_names is None:
+            layer_names = feature_layers
+
+        worlds_encoded = np.asarray(worlds_encoded, dtype=np.float32)
+        coefficients = np.asarray(coefficients, dtype=np.float32).reshape((-1, len(layer_names)))
+        batch_size = max(worlds_encoded.shape[0], coefficients.shape[0])
+        if worlds_encoded.shape[0] == 1:
+            worlds_encoded = np.repeat(worlds_encoded, batch_size, axis=0)
+        if coefficients.shape[0] == 1:
+            coefficients = np.repeat(coefficients, batch_size, axis=0)
+        if worlds_encoded.shape[0] != coefficients.shape[0]:
+            raise ValueError(f'Got {worlds_encoded.shape[0]} worlds and {coefficients.shape[0]} coefficient vectors.')
+
+        original_shape = worlds_encoded.shape[1:3]
+        successive_shapes = [original_shape]
+        for i in range(1, num_octave):
+            shape = tuple([int(dim / (octave_scale ** i)) for dim in original_shape])
+            successive_shapes.append(shape)
+        successive_shapes = successive_shapes[::-1]
+
+        for shape in successive_shapes:
+            print('Processing image shape', shape)
+            worlds_encoded = resize_world(worlds_encoded, shape)
+            worlds_encoded = self.gradient_ascent(worlds_encoded, coefficients, layer_names,
+                                                  ascent_cnt=iterations,
+                                                  step_value=step,
+                                                  maximum_loss=max_loss,
+                                                  tile_size=tile_size,
+                                                  overlap=overlap,
+                                                  tile_batch=tile_batch)
+        return worlds_encoded
+
+
+def get_tile_starts(size, tile_size, overlap):
+    # The last tile is aligned to the edge so every tile has the same size
+    if tile_size >= size:
+        return [0]
+    stride = max(tile_size - overlap, 1)
+    return sorted(set(list(range(0, size - tile_size, stride)) + [size - tile_size]))
+
+
+def get_tile_weights(tile_w, tile_h, overlap):
+    # Linear ramps over the overlap on every side, never zero so edges of the world still get gradients
+    def ramp(size):
+        ramp_size = min(overlap, size // 2)
+        weights = np.ones(size, dtype=np.float32)
+        if ramp_size > 0:
+            edge = (np.arange(ramp_size, dtype=np.float32) + 1) / (ramp_size + 1)
+            weights[:ramp_size] = edge
+            weights[size - ramp_size:] = edge[::-1]
+        return weights
+
+    return np.outer(ramp(tile_w), ramp(tile_h))[:, :, np.newaxis]
 
 
 def resize_world(world, size):
-    world = np.copy(world)
+    # Zooms the float32 worlds without copying them first, the batch and channel axes are not resized
     factors = (1,
                float(size[0]) / world.shape[1],
                float(size[1]) / world.shape[2],
@@ -27,47 +190,139 @@ def resize_world(world, size):
     return scipy.ndimage.zoom(world, factors, order=1)
 
 
-def gradient_ascent(grad_x, ascent_cnt, step_value, maximum_loss=None):
-    for ascent_i in range(ascent_cnt):
-        loss_value, grad_values = eval_loss_and_grads(grad_x)
-        if maximum_loss is not None and loss_value > maximum_loss:
-            break
-        grad_x = np.add(grad_x, step_value * grad_values, casting='unsafe')
-    return grad_x
-
-
-def do_dream(world_data, res_dir):
-    # Playing with these hyperparameters will also allow you to achieve new effects
-    step = 0.05  # Gradient ascent step size
-    num_octave = 4  # Number of scales at which to run gradient ascent
-    octave_scale = 1.1  # Size ratio between scales
-    iterations = 100  # Number of ascent steps per scale
-    max_loss = 3
-
-    # Load resources
-    block_images = utils.load_block_images(res_dir)
-    block_forward, block_backward = utils.load_encoding_dict(res_dir, 'blocks_optimized')
-
-    world_encoded = np.array([utils.encode_world_sigmoid(block_forward, world_data)])
-
-    original_shape = world_encoded.shape[1:3]
-    successive_shapes = [original_shape]
-    for i in range(1, num_octave):
-        shape = tuple([int(dim / (octave_scale ** i)) for dim in original_shape])
-        successive_shapes.append(shape)
-    successive_shapes = successive_shapes[::-1]
-
-    for shape in successive_shapes:
-        print('Processing image shape', shape)
-        world_encoded = resize_world(world_encoded, shape)
-        world_encoded = gradient_ascent(world_encoded,
-                                        ascent_cnt=iterations,
-                                        step_value=step,
-                                        maximum_loss=max_loss)
-
-    world_dream = utils.decode_world_sigmoid(block_backward, world_encoded[0])
-    utils.save_world_preview(block_images, world_dream, 'dream.png', overwrite=True)
-    utils.save_world_preview(block_images, world_data, 'input.png', overwrite=True)
+# Playing with these hyperparameters will also allow you to achieve new effects
+default_params = {
+    'step': 0.05,  # Gradient ascent step size
+    'num_octave': 4,  # Number of scales at which to run gradient ascent
+    'octave_scale': 1.1,  # Size ratio between scales
+    'iterations': 100,  # Number of ascent steps per scale
+    'max_loss': 3,
+    'tile_size': None,  # Dream in tiles of this size to bound memory use
+    'tile_batch': 8  # Number of tiles run through the model at once
+}
+
+
+# Fields a dream server job may have
+job_keys = ['command', 'world', 'presets', 'output_dir', 'params']
+
+
+class DreamResources:
+    # Block images and encoding dicts, loaded once per process
+
+    def __init__(self, res_dir):
+        self.block_images = utils.load_block_images(res_dir)
+        self.block_forward, self.block_backward = utils.load_encoding_dict(res_dir, 'blocks_optimized')
+
+
+def do_dream(engine, resources, world_data, preset_names, params=None, output_dir=None):
+    params = dict(default_params, **(params or {}))
+    if output_dir is None:
+        output_dir = os.getcwd()
+
+    world_encoded = np.array([utils.encode_world_sigmoid(resources.block_forward, world_data)])
+
+    # Every preset is dreamed in the same batch
+    coefficients = []
+    for preset_name in preset_names:
+        if preset_name == 'random':
+            scale = 10
+            coefficients.append((np.random.rand(1, len(feature_layers))[0] * scale) - (scale / 2))
+        elif preset_name in presets:
+            coefficients.append(presets[preset_name])
+        else:
+            raise ValueError(f'Unknown preset \'{preset_name}\'.')
+        print(f'Feature params {preset_name} = {list(coefficients[-1])}')
+
+    worlds_dream = engine.dream(world_encoded, np.array(coefficients), feature_layers, step=params['step'],
+                                num_octave=params['num_octave'], octave_scale=params['octave_scale'],
+                                iterations=params['iterations'], max_loss=params['max_loss'],
+                                tile_size=params['tile_size'], tile_batch=params['tile_batch'])
+
+    files = []
+    for preset_name, world_dream in zip(preset_names, worlds_dream):
+        dream_name = 'dream.png' if len(preset_names) == 1 else f'dream_{preset_name}.png'
+        world_dream = utils.decode_world_sigmoid(resources.block_backward, world_dream)
+        files.append(os.path.join(output_dir, dream_name))
+        utils.save_world_preview(resources.block_images, world_dream, files[-1], overwrite=True)
+
+    files.append(os.path.join(output_dir, 'input.png'))
+    utils.save_world_preview(resources.block_images, world_data, files[-1], overwrite=True)
+    return files
+
+
+def check_job(job):
+    # Jobs come from another process, so only accept the fields and parameters the client can send
+    if not isinstance(job, dict) or not set(job).issubset(job_keys):
+        raise ValueError('Job must be a dict with the keys ' + ', '.join(sorted(job_keys)) + '.')
+
+    if job.get('command') not in ['dream', 'stop']:
+        raise ValueError(f'Unknown command \'{job.get("command")}\'.')
+    if job['command'] == 'stop':
+        return
+
+    if not isinstance(job.get('world'), str) or not os.path.isfile(job['world']):
+        raise ValueError('World not found.')
+
+    job_presets = job.get('presets', ['colors'])
+    if not isinstance(job_presets, list) or not all(isinstance(name, str) for name in job_presets):
+        raise ValueError('Presets must be a list of preset names.')
+
+    params = job.get('params', {})
+    if not isinstance(params, dict) or not set(params).issubset(default_params):
+        raise ValueError('Params must be a dict with the keys ' + ', '.join(sorted(default_params)) + '.')
+
+    output_dir = job.get('output_dir')
+    if output_dir is not None and (not isinstance(output_dir, str) or not os.path.isdir(output_dir)):
+        raise ValueError('Output directory not found.')
+
+
+def serve(engine, resources, res_dir, address=default_address):
+    # Keeps the model, resources and compiled functions loaded and runs jobs sent by dreamclient.py one at a time.
+    # Clients authenticate with a key that is made at startup and kept in a file only the user can read
+    authkey = write_authkey(res_dir)
+    try:
+        with Listener(address, authkey=authkey) as listener:
+            print(f'Dream server listening on {address[0]}:{address[1]}')
+            while serve_connection(engine, resources, listener):
+                pass
+    finally:
+        os.remove(get_key_file(res_dir))
+    print('Dream server stopped.')
+
+
+def serve_connection(engine, resources, listener):
+    # Returns False once the server should stop
+    try:
+        connection = listener.accept()
+    except (AuthenticationError, OSError) as e:
+        print(f'Rejected connection: {e}')
+        return True
+
+    with connection:
+        start_time = time.time()
+        try:
+            job = connection.recv()
+            check_job(job)
+            if job['command'] == 'stop':
+                connection.send({'status': 'ok'})
+                return False
+
+            print(f'Dreaming {job["world"]}')
+            world_data = utils.load_world_eelvl(job['world'])
+            files = do_dream(engine, resources, world_data, job.get('presets', ['colors']),
+                             job.get('params'), job.get('output_dir'))
+            response = {'status': 'ok', 'files': files, 'time': time.time() - start_time}
+        except EOFError:
+            return True
+        except Exception as e:
+            traceback.print_exc()
+            response = {'status': 'error', 'error': f'{type(e).__name__}: {e}'}
+
+        try:
+            connection.send(response)
+        except OSError:
+            print('Client went away before the dream finished.')
+    return True
 
 
 def main():
@@ -76,6 +331,15 @@ def main():
     parser.add_argument('--resources', nargs=1, type=str, help='The path to the resources directory')
     parser.add_argument('--model', nargs='?', type=str, help='The path to the h5 model file.',
                         default='model.h5')
+    parser.add_argument('--presets', nargs='+', type=str, help='Feature presets to dream with in one batch.',
+                        choices=sorted(presets) + ['random'], default=['colors'])
+    parser.add_argument('--tile-size', nargs='?', type=int, help='Dream in tiles of this size to bound memory use.',
+                        default=None)
+    parser.add_argument('--tile-batch', nargs='?', type=int, help='Number of tiles run through the model at once.',
+                        default=8)
+    parser.add_argument('--serve', action='store_true', help='Keep running and take jobs from dreamclient.py.')
+    parser.add_argument('--port', nargs='?', type=int, help='Port the dream server listens on.',
+                        default=default_address[1])
 
     args = parser.parse_args()
 
@@ -99,9 +363,19 @@ def main():
         exit(1)
 
     model = load_model(model_path)
-    dream = model.input
     print('Model loaded.')
 
+    K.set_learning_phase(0)
+
+    engine = DreamEngine(model)
+    resources = DreamResources(res_dir)
+
+    if args.serve:
+        # Build the default function now so the first job does not pay for it
+        engine.get_function(feature_layers)
+        serve(engine, resources, res_dir, (default_address[0], args.port))
+        return
+
     world_path = args.world[0]
     print(f'World = \'{world_path}\'')
     if not os.path.isabs(world_path):
@@ -113,54 +387,8 @@ def main():
 
     world_data = utils.load_world_eelvl(world_path)
 
-    scale = 10
-    rand_params = (np.random.rand(1, 4)[0] * scale) - (scale / 2)
-
-    # Presets
-    subtle = [1.03186447, 4.94900884, 4.52247586, -1.00151375]
-    colors = [2.84376834, -4.96601078, -0.03940069, -4.7203666]
-
-    params = colors
-    print(f'Feature params = {params}')
-
-    settings = {
-        'features': {
-            'max_pooling2d_1': params[0],
-            'max_pooling2d_2': params[1],
-            'max_pooling2d_3': params[2],
-            'max_pooling2d_4': params[3]
-        },
-    }
-
-    K.set_learning_phase(0)
-
-    # Get the symbolic outputs of each "key" layer (we gave them unique names).
-    layer_dict = dict([(layer.name, layer) for layer in model.layers])
-
-    # Define the loss.
-    loss = K.variable(0.)
-    for layer_name in settings['features']:
-        # Add the L2 norm of the features of a layer to the loss.
-        if layer_name not in layer_dict:
-            raise ValueError('Layer ' + layer_name + ' not found in model.')
-        coeff = settings['features'][layer_name]
-        x = layer_dict[layer_name].output
-        # We avoid border artifacts by only involving non-border pixels in the loss.
-        scaling = K.prod(K.cast(K.shape(x), 'float32'))
-        loss += coeff * K.sum(K.square(x[:, 2: -2, 2: -2, :])) / scaling
-
-    # Compute the gradients of the dream wrt the loss and normalize gradients
-    grads = K.gradients(loss, dream)[0]
-    grads /= K.maximum(K.mean(K.abs(grads)), K.epsilon())
-
-    # Set up function to retrieve the value
-    # of the loss and gradients given an input image.
-    outputs = [loss, grads]
-
-    global fetch_loss_and_grads
-    fetch_loss_and_grads = K.function([dream], outputs)
-
-    do_dream(world_data, res_dir)
+    do_dream(engine, resources, world_data, args.presets,
+             {'tile_size': args.tile_size, 'tile_batch': args.tile_batch})
 
 
 if __name__ == '__main__':
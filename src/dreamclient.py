@@ -0,0 +1,102 @@
+import argparse
+import os
+from multiprocessing.connection import Client
+
+# Shared with the server in dream.py. Kept free of keras imports so sending a job starts instantly
+default_address = ('localhost', 6005)
+key_name = 'dream_server.key'
+
+
+def get_key_file(res_dir):
+    return os.path.join(res_dir, key_name)
+
+
+def write_authkey(res_dir):
+    # A new random key every time the server starts, readable only by the user that started it
+    authkey = os.urandom(32)
+    key_file = get_key_file(res_dir)
+    fd = os.open(key_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'wb') as fp:
+        fp.write(authkey)
+    os.chmod(key_file, 0o600)
+    return authkey
+
+
+def read_authkey(res_dir):
+    with open(get_key_file(res_dir), 'rb') as fp:
+        return fp.read()
+
+
+def send_job(job, address, authkey):
+    with Client(address, authkey=authkey) as connection:
+        connection.send(job)
+        return connection.recv()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sends deep dream jobs to a running dream server.')
+    parser.add_argument('--world', nargs='?', type=str, help='The path to the eelvl file.')
+    parser.add_argument('--resources', nargs='?', type=str, help='The resources directory the server was started with.',
+                        default=os.getcwd())
+    parser.add_argument('--presets', nargs='+', type=str, help='Feature presets to dream with in one batch.',
+                        default=['colors'])
+    parser.add_argument('--output', nargs='?', type=str, help='Directory the previews are written to.',
+                        default=os.getcwd())
+    parser.add_argument('--step', nargs='?', type=float, help='Gradient ascent step size.')
+    parser.add_argument('--num-octave', nargs='?', type=int, help='Number of scales at which to run gradient ascent.')
+    parser.add_argument('--octave-scale', nargs='?', type=float, help='Size ratio between scales.')
+    parser.add_argument('--iterations', nargs='?', type=int, help='Number of ascent steps per scale.')
+    parser.add_argument('--max-loss', nargs='?', type=float, help='Loss at which a world stops for an octave.')
+    parser.add_argument('--tile-size', nargs='?', type=int, help='Dream in tiles of this size to bound memory use.')
+    parser.add_argument('--tile-batch', nargs='?', type=int, help='Number of tiles run through the model at once.')
+    parser.add_argument('--port', nargs='?', type=int, help='Port of the dream server.', default=default_address[1])
+    parser.add_argument('--stop', action='store_true', help='Stop the dream server.')
+
+    args = parser.parse_args()
+    address = (default_address[0], args.port)
+
+    try:
+        authkey = read_authkey(os.path.abspath(args.resources))
+    except IOError:
+        print(f'No dream server key in \'{args.resources}\', start a server with dream.py --serve.')
+        exit(1)
+
+    if args.stop:
+        print(send_job({'command': 'stop'}, address, authkey))
+        return
+
+    if args.world is None:
+        print('No world given.')
+        exit(1)
+
+    # Only parameters that were given are sent, the server fills in its defaults
+    params = {}
+    for name in ['step', 'num_octave', 'octave_scale', 'iterations', 'max_loss', 'tile_size', 'tile_batch']:
+        if getattr(args, name) is not None:
+            params[name] = getattr(args, name)
+
+    job = {
+        'command': 'dream',
+        'world': os.path.abspath(args.world),
+        'presets': args.presets,
+        'output_dir': os.path.abspath(args.output),
+        'params': params
+    }
+
+    try:
+        response = send_job(job, address, authkey)
+    except ConnectionRefusedError:
+        print(f'No dream server is running on port {args.port}, start one with dream.py --serve.')
+        exit(1)
+
+    if response['status'] != 'ok':
+        print(f'Dream failed: {response["error"]}')
+        exit(1)
+
+    print(f'Dreamed in {response["time"]:.1f}s:')
+    for file in response['files']:
+        print(f'  {file}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+from collections import deque
+from multiprocessing import Pool, cpu_count
+
+import numpy as np
+
+import utils
+
+# Set once per pool process by init_export_worker so block images are only sent to each worker one time
+worker_block_images = None
+worker_block_backward = None
+worker_minimap_values = None
+
+
+def init_export_worker(block_images, block_backward, minimap_values):
+    global worker_block_images, worker_block_backward, worker_minimap_values
+    worker_block_images = block_images
+    worker_block_backward = block_backward
+    worker_minimap_values = minimap_values
+
+
+def export_world_task(args):
+    encoded_world, preview_file, world_file, minimap_file = args
+    decoded_world = utils.decode_world_sigmoid(worker_block_backward, encoded_world)
+
+    if world_file is not None:
+        utils.save_world_data(decoded_world, world_file)
+    if preview_file is not None:
+        utils.save_world_preview(worker_block_images, decoded_world, preview_file)
+    if minimap_file is not None:
+        utils.save_world_minimap(worker_minimap_values, decoded_world, minimap_file)
+
+
+def export_minimap_task(args):
+    encoded_minimap, rgb_file = args
+    utils.save_rgb_map(utils.decode_world_minimap(encoded_minimap), rgb_file)
+
+
+class PreviewExporter:
+    # Decodes and writes previews on a process pool so training does not stop while samples are saved.
+    # Arrays are copied on submit, so the training loop can reuse its batch buffers right away.
+    # When max_in_flight exports are pending, submitting waits for the oldest one to finish.
+
+    def __init__(self, block_images, block_backward, minimap_values=None, thread_count=None, max_in_flight=256):
+        if thread_count is None:
+            thread_count = max(min(cpu_count() - 1, 4), 1)
+
+        self.max_in_flight = max_in_flight
+        self.pending = deque()
+        self.pool = Pool(thread_count, initializer=init_export_worker,
+                         initargs=(block_images, block_backward, minimap_values))
+
+    def submit(self, func, args):
+        while len(self.pending) >= self.max_in_flight:
+            self.collect(self.pending.popleft())
+
+        self.pending.append(self.pool.apply_async(func, (args,)))
+
+        # Drop finished exports from the front of the queue
+        while len(self.pending) > 0 and self.pending[0].ready():
+            self.collect(self.pending.popleft())
+
+    @staticmethod
+    def collect(result):
+        try:
+            result.get()
+        except Exception as e:
+            print(f'Failed to export preview: {e}')
+
+    def export_world(self, encoded_world, preview_file=None, world_file=None, minimap_file=None):
+        self.submit(export_world_task, (np.array(encoded_world), preview_file, world_file, minimap_file))
+
+    def export_minimap(self, encoded_minimap, rgb_file):
+        self.submit(export_minimap_task, (np.array(encoded_minimap), rgb_file))
+
+    def wait(self):
+        while len(self.pending) > 0:
+            self.collect(self.pending.popleft())
+
+    def close(self):
+        self.wait()
+        self.pool.close()
+        self.pool.join()
@@ -13,7 +13,12 @@ from keras.models import Sequential, load_model
 from keras.optimizers import Adam
 
 import utils
+from batcher import BatchAssembler
+from checkpoints import CheckpointManager, capture_training_state, load_dataset_snapshot, restore_optimizer, \
+    restore_training_state, save_dataset_snapshot
+from exporter import PreviewExporter
 from loadworker import load_worlds_with_label
+from profiler import StepProfiler
 from tbmanager import TensorboardManager
 
 
@@ -92,7 +97,8 @@ def generator_containing_discriminator(g, d):
     return model
 
 
-def train(epochs, batch_size, world_count, latent_dim, version_name=None, initial_epoch=0):
+def train(epochs, batch_size, world_count, latent_dim, version_name=None, initial_epoch=0, fused_step=False,
+          profile=False):
     cur_dir = os.getcwd()
     res_dir = os.path.abspath(os.path.join(cur_dir, '..', 'res'))
     all_models_dir = os.path.abspath(os.path.join(cur_dir, '..', 'models'))
@@ -124,6 +130,12 @@ def train(epochs, batch_size, world_count, latent_dim, version_name=None, initia
     # Load model and existing weights
     print('Loading model...')
 
+    # Continue from the latest checkpoint of an existing version
+    checkpoints = CheckpointManager(model_save_dir)
+    checkpoint = None if no_version else checkpoints.get_latest_checkpoint()
+    if checkpoint is not None:
+        initial_epoch = checkpoint['epoch'] + 1
+
     # Try to load full model, otherwise try to load weights
     size = 64
     cur_models = f'{model_save_dir}\\epoch{initial_epoch - 1}'
@@ -138,6 +150,7 @@ def train(epochs, batch_size, world_count, latent_dim, version_name=None, initia
             g_optim = Adam(lr=0.0001, beta_1=0.5)
             d_on_g = generator_containing_discriminator(g, d)
             d_on_g.compile(loss='binary_crossentropy', optimizer=g_optim)
+            restore_optimizer(d_on_g, f'{cur_models}\\d_g.optimizer.npz')
     elif os.path.exists(f'{cur_models}\\discriminator.weights') and os.path.exists(
             f'{cur_models}\\generator.weights'):
         print('Building model with weights...')
@@ -146,12 +159,15 @@ def train(epochs, batch_size, world_count, latent_dim, version_name=None, initia
         d.load_weights(f'{cur_models}\\discriminator.weights')
         d.compile(loss='binary_crossentropy', optimizer=d_optim, metrics=['accuracy'])
 
-        g = build_generator(size)
+        g = build_generator(size, latent_dim)
         g.load_weights(f'{cur_models}\\generator.weights')
 
         g_optim = Adam(lr=0.0001, beta_1=0.5)
         d_on_g = generator_containing_discriminator(g, d)
         d_on_g.compile(loss='binary_crossentropy', optimizer=g_optim)
+
+        restore_optimizer(d, f'{cur_models}\\discriminator.optimizer.npz')
+        restore_optimizer(d_on_g, f'{cur_models}\\d_g.optimizer.npz')
     else:
         print('Building model from scratch...')
         d_optim = Adam(lr=0.00001)
@@ -178,18 +194,44 @@ def train(epochs, batch_size, world_count, latent_dim, version_name=None, initia
                                show_layer_names=True)
         keras.utils.plot_model(g, to_file=f'{version_dir}\\generator.png', show_shapes=True, show_layer_names=True)
 
-    # Load Data
-    print('Loading worlds...')
-    label_dict = utils.load_label_dict(res_dir, 'pro_labels_b')
-    x_train = load_worlds_with_label(world_count, f'{res_dir}\\worlds\\', label_dict, 1, (size, size), block_forward,
-                                     overlap_x=0.1, overlap_y=0.1)
+    # Load Data, a resumed version trains on the same crops as before
+    x_train = None if no_version else load_dataset_snapshot(version_dir)
+    resume_data = x_train is not None
+    if resume_data:
+        print('Loaded dataset snapshot.')
+    else:
+        print('Loading worlds...')
+        label_dict = utils.load_label_dict(res_dir, 'pro_labels_b')
+        x_train = load_worlds_with_label(world_count, f'{res_dir}\\worlds\\', label_dict, 1, (size, size),
+                                         block_forward, overlap_x=0.1, overlap_y=0.1, use_dataset_cache=True)
+        save_dataset_snapshot(version_dir, x_train)
+
+    batcher = BatchAssembler(x_train, batch_size)
+    batch_cnt = batcher.batch_count
 
-    world_count = x_train.shape[0]
-    batch_cnt = (world_count - (world_count % batch_size)) // batch_size
+    start_batch = 0
+    training_state = checkpoints.load_training_state(checkpoint)
+    if resume_data and training_state is not None:
+        initial_epoch, start_batch, _ = restore_training_state(training_state, batcher)
+        print(f'Resuming at epoch {initial_epoch}, batch {start_batch}')
 
     # Set up tensorboard
     print('Setting up tensorboard...')
     tb_manager = TensorboardManager(graph_version_dir, batch_cnt)
+    exporter = PreviewExporter(block_images, block_backward)
+
+    real_labels = np.ones((batch_size, 1))  # np.random.uniform(0.9, 1.1, size=(batch_size,))
+    fake_labels = np.zeros((batch_size, 1))  # np.random.uniform(-0.1, 0.1, size=(batch_size,))
+
+    # The fused step trains the discriminator on real and fake worlds in a single call. Real worlds fill the
+    # first half of a reused input buffer and generated worlds the second half. Trainable flags are fixed when a
+    # model is compiled, so d stays trainable on its own and frozen inside d_on_g without toggling per batch.
+    # Batch norm sees mixed real/fake statistics in this mode.
+    if fused_step:
+        d_inputs = np.empty((batch_size * 2, size, size, 10), dtype=np.float32)
+        d_labels = np.concatenate((real_labels, fake_labels))
+
+    profiler = StepProfiler(profile, f'{version_dir}\\profile.json')
 
     preview_frequency_sec = 5 * 60.0
     for epoch in range(initial_epoch, epochs):
@@ -197,73 +239,110 @@ def train(epochs, batch_size, world_count, latent_dim, version_name=None, initia
         # Create directories for current epoch
         cur_worlds_dir = utils.check_or_create_local_path(f'epoch{epoch}', worlds_dir)
         cur_previews_dir = utils.check_or_create_local_path(f'epoch{epoch}', previews_dir)
-        cur_models_dir = utils.check_or_create_local_path(f'epoch{epoch}', model_save_dir)
 
-        print('Shuffling data...')
-        np.random.shuffle(x_train)
+        # A resumed epoch continues in its saved order
+        first_batch = start_batch if epoch == initial_epoch else 0
+        if first_batch == 0:
+            print('Shuffling data...')
+            batcher.shuffle()
 
         last_save_time = time.time()
-        for batch in range(batch_cnt):
-
-            # Get real set of images
-            real_worlds = x_train[batch * batch_size:(batch + 1) * batch_size]
+        epoch_start_time = time.time()
+        for batch in range(first_batch, batch_cnt):
 
-            # Get fake set of images
             noise = np.random.normal(0, 1, size=(batch_size, latent_dim))
-            fake_worlds = g.predict(noise)
 
-            real_labels = np.ones((batch_size, 1))  # np.random.uniform(0.9, 1.1, size=(batch_size,))
-            fake_labels = np.zeros((batch_size, 1))  # np.random.uniform(-0.1, 0.1, size=(batch_size,))
-
-            # Train discriminator on real worlds
-            d.trainable = True
-            d_loss = d.train_on_batch(real_worlds, real_labels)
-            acc_real = d_loss[1]
-            loss_real = d_loss[0]
-            tb_manager.log_var('d_acc_real', epoch, batch, d_loss[1])
-            tb_manager.log_var('d_loss_real', epoch, batch, d_loss[0])
-
-            # Train discriminator on fake worlds
-            d_loss = d.train_on_batch(fake_worlds, fake_labels)
-            d.trainable = False
-            acc_fake = d_loss[1]
-            loss_fake = d_loss[0]
-            tb_manager.log_var('d_acc_fake', epoch, batch, d_loss[1])
-            tb_manager.log_var('d_loss_fake', epoch, batch, d_loss[0])
-
-            # Training generator on X data, with Y labels
-            # noise = np.random.normal(0, 1, (batch_size, 256))
-
-            # Train generator to generate real
-            g_loss = d_on_g.train_on_batch(noise, real_labels)
-            tb_manager.log_var('g_loss', epoch, batch, g_loss)
-
-            print(f'epoch [{epoch}/{epochs}] :: batch [{batch}/{batch_cnt}] :: fake_acc = {acc_fake} :: '
-                  f'real_acc = {acc_real} :: fake_loss = {loss_fake} :: real_loss = {loss_real} :: gen_loss = {g_loss}')
+            if fused_step:
+                # Real and generated worlds go through the discriminator as one batch
+                with profiler.phase('data'):
+                    d_inputs[:batch_size] = batcher.get_batch(batch)
+                with profiler.phase('generate'):
+                    d_inputs[batch_size:] = g.predict(noise)
+                fake_worlds = d_inputs[batch_size:]
+
+                with profiler.phase('train_d'):
+                    d_loss = d.train_on_batch(d_inputs, d_labels)
+                tb_manager.log_var('d_acc', epoch, batch, d_loss[1])
+                tb_manager.log_var('d_loss', epoch, batch, d_loss[0])
+
+                with profiler.phase('train_g'):
+                    g_loss = d_on_g.train_on_batch(noise, real_labels)
+                tb_manager.log_var('g_loss', epoch, batch, g_loss)
+
+                d_summary = f'd_acc = {d_loss[1]} :: d_loss = {d_loss[0]}'
+            else:
+                # Get real set of images
+                with profiler.phase('data'):
+                    real_worlds = batcher.get_batch(batch)
+
+                # Get fake set of images
+                with profiler.phase('generate'):
+                    fake_worlds = g.predict(noise)
+
+                # Train discriminator on real worlds
+                with profiler.phase('train_d'):
+                    d.trainable = True
+                    d_loss = d.train_on_batch(real_worlds, real_labels)
+                acc_real = d_loss[1]
+                loss_real = d_loss[0]
+                tb_manager.log_var('d_acc_real', epoch, batch, d_loss[1])
+                tb_manager.log_var('d_loss_real', epoch, batch, d_loss[0])
+
+                # Train discriminator on fake worlds
+                with profiler.phase('train_d'):
+                    d_loss = d.train_on_batch(fake_worlds, fake_labels)
+                    d.trainable = False
+                acc_fake = d_loss[1]
+                loss_fake = d_loss[0]
+                tb_manager.log_var('d_acc_fake', epoch, batch, d_loss[1])
+                tb_manager.log_var('d_loss_fake', epoch, batch, d_loss[0])
+
+                # Train generator to generate real
+                with profiler.phase('train_g'):
+                    g_loss = d_on_g.train_on_batch(noise, real_labels)
+                tb_manager.log_var('g_loss', epoch, batch, g_loss)
+
+                d_summary = (f'fake_acc = {acc_fake} :: real_acc = {acc_real} :: fake_loss = {loss_fake} :: '
+                             f'real_loss = {loss_real}')
+
+            with profiler.phase('logging'):
+                iterations_per_sec = (batch + 1 - first_batch) / max(time.time() - epoch_start_time, 1e-6)
+                tb_manager.log_var('iterations_per_sec', epoch, batch, iterations_per_sec)
+                tb_manager.log_step_time(epoch, batch)
+
+                print(f'epoch [{epoch}/{epochs}] :: batch [{batch}/{batch_cnt}] :: {d_summary} :: '
+                      f'gen_loss = {g_loss} :: {iterations_per_sec:.2f} it/s')
 
             # Save models
             time_since_save = time.time() - last_save_time
             if time_since_save >= preview_frequency_sec or batch == batch_cnt - 1:
                 print('Saving previews...')
-                for i in range(batch_size):
-                    generated_world = fake_worlds[i]
-                    decoded_world = utils.decode_world_sigmoid(block_backward, generated_world)
-                    utils.save_world_data(decoded_world, f'{cur_worlds_dir}\\world{i}.world')
-                    utils.save_world_preview(block_images, decoded_world, f'{cur_previews_dir}\\preview{i}.png')
+                with profiler.phase('preview'):
+                    tb_manager.log_histogram('generated', epoch, batch, fake_worlds)
+                    for i in range(batch_size):
+                        exporter.export_world(fake_worlds[i], f'{cur_previews_dir}\\preview{i}.png',
+                                              f'{cur_worlds_dir}\\world{i}.world')
 
+                # d_g only holds the generator and discriminator weights, it gets rebuilt when resuming
                 print('Saving models...')
-                try:
-                    d.save(f'{cur_models_dir}\\discriminator.h5')
-                    g.save(f'{cur_models_dir}\\generator.h5')
-                    d_on_g.save(f'{cur_models_dir}\\d_g.h5')
-                    d.save_weights(f'{cur_models_dir}\\discriminator.weights')
-                    g.save_weights(f'{cur_models_dir}\\generator.weights')
-                    d_on_g.save_weights(f'{cur_models_dir}\\d_g.weights')
-                except ImportError:
-                    print('Failed to save data.')
+                with profiler.phase('checkpoint'):
+                    training_state = capture_training_state(epoch, batch, batch_cnt, batcher)
+                    checkpoints.save(epoch, {'discriminator': d, 'generator': g},
+                                     full_models=batch == batch_cnt - 1, batch=batch, training_state=training_state,
+                                     optimizer_models={'discriminator': d, 'd_g': d_on_g})
 
                 last_save_time = time.time()
 
+        profiler.end_epoch(epoch, tb_manager, batch_cnt - 1)
+
+        step_mode = 'fused' if fused_step else 'separate'
+        print(f'Epoch {epoch} finished in {time.time() - epoch_start_time:.1f}s :: {step_mode} step :: '
+              f'{(batch_cnt - first_batch) / max(time.time() - epoch_start_time, 1e-6):.2f} it/s')
+
+    exporter.close()
+    checkpoints.close()
+    tb_manager.close()
+
 
 def main():
     train(epochs=100, batch_size=100, world_count=64000, latent_dim=128, initial_epoch=0)
@@ -13,7 +13,12 @@ from keras.models import Model
 from keras.optimizers import Adam
 
 import utils
+from augment import AugmentStage, LowMasks
+from batcher import BatchAssembler
+from checkpoints import CheckpointManager
+from exporter import PreviewExporter
 from loadworker import load_worlds
+from profiler import StepProfiler
 from tbmanager import TensorboardManager
 
 
@@ -117,7 +122,7 @@ def build_helper_feedback_model(helper, judge, size):
     return helper_feedback_model
 
 
-def train(epochs, batch_size, world_count, version_name=None, initial_epoch=0):
+def train(epochs, batch_size, world_count, version_name=None, initial_epoch=0, profile=False):
     cur_dir = os.getcwd()
     res_dir = os.path.abspath(os.path.join(cur_dir, '..', 'res'))
     all_models_dir = os.path.abspath(os.path.join(cur_dir, '..', 'models'))
@@ -168,12 +173,16 @@ def train(epochs, batch_size, world_count, version_name=None, initial_epoch=0):
 
     # Load Data
     print('Loading worlds...')
-    x_train = load_worlds(world_count, f'{res_dir}\\worlds\\', (32, 32), block_forward)
+    x_train = load_worlds(world_count, f'{res_dir}\\worlds\\', (32, 32), block_forward, use_dataset_cache=True)
 
     # Start Training loop
-    world_count = x_train.shape[0]
-    batch_cnt = (world_count - (world_count % batch_size)) // batch_size
+    batcher = BatchAssembler(x_train, batch_size)
+    batch_cnt = batcher.batch_count
     tb_manager = TensorboardManager(graph_version_dir, batch_cnt)
+    stage = AugmentStage(batcher, masks=LowMasks())
+    exporter = PreviewExporter(block_images, block_backward)
+    checkpoints = CheckpointManager(model_save_dir)
+    profiler = StepProfiler(profile, f'{version_dir}\\profile.json')
 
     for epoch in range(initial_epoch, epochs):
 
@@ -181,38 +190,39 @@ def train(epochs, batch_size, world_count, version_name=None, initial_epoch=0):
         # Create directories for current epoch
         cur_worlds_cur = utils.check_or_create_local_path(f'epoch{epoch}', worlds_dir)
         cur_previews_dir = utils.check_or_create_local_path(f'epoch{epoch}', previews_dir)
-        cur_models_dir = utils.check_or_create_local_path(f'epoch{epoch}', model_save_dir)
 
         print('Shuffling data...')
-        np.random.shuffle(x_train)
+        batcher.shuffle()
 
-        for batch in range(batch_cnt):
+        for batch, (world_batch, world_batch_masked, world_masks) in enumerate(profiler.iterate(stage.epoch(epoch))):
 
-            # Get real set of worlds
-            world_batch = x_train[batch * batch_size:(batch + 1) * batch_size]
-            world_batch_masked, world_masks = utils.mask_batch_low(world_batch)
+            # Real set of worlds comes masked from the augment stage
             world_masks_reshaped = np.reshape(world_masks[:, :, :, 0], (batch_size, 32 * 32, 1))
 
             # Get fake set of worlds
             noise = np.random.normal(0, 1, size=(batch_size, 128))
-            generated = helper.predict([world_batch_masked, noise])
+            with profiler.phase('generate'):
+                generated = helper.predict([world_batch_masked, noise])
 
             real_labels = np.ones((batch_size, 32 * 32, 1))
             fake_labels = np.zeros((batch_size, 32 * 32, 1))
             masked_labels = 1 - world_masks_reshaped
 
-            judge.trainable = True
-            j_real = judge.train_on_batch([world_batch_masked, world_batch], real_labels)
-            j_fake = judge.train_on_batch([world_batch_masked, generated[1]], fake_labels)
+            with profiler.phase('train_judge'):
+                judge.trainable = True
+                j_real = judge.train_on_batch([world_batch_masked, world_batch], real_labels)
+                j_fake = judge.train_on_batch([world_batch_masked, generated[1]], fake_labels)
 
             tb_manager.log_var('j_loss_real', epoch, batch, j_real[0])
             tb_manager.log_var('j_loss_fake', epoch, batch, j_fake[0])
             tb_manager.log_var('j_acc_real', epoch, batch, j_real[1])
             tb_manager.log_var('j_acc_fake', epoch, batch, j_fake[1])
 
-            judge.trainable = False
-            h_loss = helper_feedback.train_on_batch([world_batch_masked, noise], real_labels)
+            with profiler.phase('train_helper'):
+                judge.trainable = False
+                h_loss = helper_feedback.train_on_batch([world_batch_masked, noise], real_labels)
             tb_manager.log_var('h_loss', epoch, batch, h_loss)
+            tb_manager.log_step_time(epoch, batch)
 
             print(f'epoch [{epoch}/{epochs}] :: batch [{batch}/{batch_cnt}] :: fake_loss = {j_fake[0]} :: fake_acc = '
                   f'{j_fake[1]} :: real_loss = {j_real[0]} :: real_acc = {j_real[1]} :: h_loss = {h_loss}')
@@ -220,23 +230,22 @@ def train(epochs, batch_size, world_count, version_name=None, initial_epoch=0):
             if batch % 1000 == 999 or batch == batch_cnt - 1:
 
                 # Save generated batch
-                for i in range(batch_size):
-                    actual_world = world_batch_masked[i]
-                    a_decoded = utils.decode_world_sigmoid(block_backward, actual_world)
-                    utils.save_world_preview(block_images, a_decoded, f'{cur_previews_dir}\\actual{i}.png')
-
-                    gen_world = generated[1][i]
-                    decoded = utils.decode_world_sigmoid(block_backward, gen_world)
-                    utils.save_world_preview(block_images, decoded, f'{cur_previews_dir}\\preview{i}.png')
+                with profiler.phase('preview'):
+                    for i in range(batch_size):
+                        exporter.export_world(world_batch_masked[i], f'{cur_previews_dir}\\actual{i}.png')
+                        exporter.export_world(generated[1][i], f'{cur_previews_dir}\\preview{i}.png')
 
                 # Save models
-                try:
-                    judge.save(f'{cur_models_dir}\\judge.h5')
-                    helper.save(f'{cur_models_dir}\\helper.h5')
-                    judge.save_weights(f'{cur_models_dir}\\judge.weights')
-                    helper.save_weights(f'{cur_models_dir}\\helper.weights')
-                except ImportError:
-                    print('Failed to save data.')
+                with profiler.phase('checkpoint'):
+                    checkpoints.save(epoch, {'judge': judge, 'helper': helper},
+                                     full_models=batch == batch_cnt - 1, batch=batch)
+
+        profiler.end_epoch(epoch, tb_manager, batch_cnt - 1)
+
+    stage.close()
+    exporter.close()
+    checkpoints.close()
+    tb_manager.close()
 
 
 def main():
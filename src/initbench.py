@@ -0,0 +1,117 @@
+import time
+
+import numpy as np
+
+from playerio.initparse import BlockData, get_world_data, parse
+from playerio.message import Message
+
+
+def build_init_message(width, height, fill=0.8, args_share=0.1, seed=0):
+    # A synthetic init message where fill of the cells on both layers hold blocks spread over 200 block types
+    random = np.random.RandomState(seed)
+    values = [0] * 18 + [width, height] + ['ws']
+
+    for layer in range(2):
+        cells = np.flatnonzero(random.rand(width * height) < fill)
+        block_types = random.randint(1, 201, size=len(cells))
+        for block_type in np.unique(block_types):
+            chunk_cells = cells[block_types == block_type]
+            xs = (chunk_cells // height).astype('>u2').tobytes()
+            ys = (chunk_cells % height).astype('>u2').tobytes()
+            values.extend([int(block_type), layer, xs, ys])
+
+            # Some blocks carry args like sign text or portal targets, a few of them a lot
+            if random.rand() < args_share:
+                values.extend(['arg'] * random.randint(1, 64))
+
+    values.append('we')
+    return Message('init', *values)
+
+
+def parse_reference(m):
+    # The parser this replaced, kept to check results and compare speed
+    p = 0
+    data = []
+
+    while m[p] != 'ws':
+        p += 1
+
+    p += 1
+
+    while m[p] != 'we':
+        data.append(m[p])
+        p += 1
+
+    chunks = []
+    while len(data) > 0:
+        args = []
+        while len(data) > 0 and not isinstance(data[-1], bytes):
+            args.insert(0, data.pop())
+
+        ys = list(memoryview(data.pop()))
+        xs = list(memoryview(data.pop()))
+        layer = data.pop()
+        block_type = data.pop()
+
+        points = []
+        for i in range(0, len(xs), 2):
+            points.append((((xs[i] << 8) | xs[i + 1]), ((ys[i] << 8) | ys[i + 1])))
+        chunks.append((layer, block_type, points, args))
+
+    return chunks
+
+
+def get_world_data_reference(m):
+    world_width = m[18]
+    world_height = m[19]
+
+    blocks = np.empty((world_width, world_height, 2), dtype=BlockData)
+    for i in range(world_width):
+        for j in range(world_height):
+            for k in range(2):
+                block_id = 0
+                if i == 0 or i == world_width - 1 or j == 0 or j == world_height - 1:
+                    block_id = 9
+
+                blocks[i, j, k] = BlockData(k, i, j, block_id, None)
+
+    for layer, block_type, points, args in parse_reference(m):
+        for x, y in points:
+            blocks[x, y, layer] = BlockData(layer, x, y, int(block_type), args)
+    return blocks
+
+
+def time_func(func, m, repeats):
+    best = None
+    result = None
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        result = func(m)
+        elapsed = time.perf_counter() - start_time
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def benchmark(sizes=((200, 200), (400, 400), (636, 460)), repeats=3):
+    for width, height in sizes:
+        m = build_init_message(width, height)
+
+        parse_time, _ = time_func(parse, m, repeats)
+        world_time, world = time_func(get_world_data, m, repeats)
+        reference_parse_time, _ = time_func(parse_reference, m, 1)
+        reference_world_time, reference = time_func(get_world_data_reference, m, 1)
+
+        reference_ids = np.vectorize(lambda block: block.block_id, otypes=[np.uint16])(reference)
+        matches = np.array_equal(world.ids, reference_ids.transpose((2, 0, 1)))
+
+        print(f'{width}x{height} :: {len(m)} values :: parse {parse_time * 1000:.1f}ms '
+              f'(was {reference_parse_time * 1000:.1f}ms) :: get_world_data {world_time * 1000:.1f}ms '
+              f'(was {reference_world_time * 1000:.1f}ms) :: same ids = {matches}')
+
+
+def main():
+    benchmark()
+
+
+if __name__ == '__main__':
+    main()
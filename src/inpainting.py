@@ -1,16 +1,22 @@
 import os
 
 import keras
-import numpy as np
-import tensorflow as tf
 
 import auto_encoder
 import utils
+from augment import AugmentStage, HighMasks, RandomFlip, RandomJitter, RandomRotate
+from batcher import BatchAssembler
+from checkpoints import CheckpointManager
+from exporter import PreviewExporter
 from loadworker import load_worlds
+from maskgen import MaskBank
+from profiler import StepProfiler
+from tbmanager import TensorboardManager
 from unet_model import PConvUnet
 
 
-def train(epochs, batch_size, world_count, version_name=None, initial_epoch=0):
+def train(epochs, batch_size, world_count, version_name=None, initial_epoch=0, augment=False,
+          profile=False):
     cur_dir = os.getcwd()
     res_dir = os.path.abspath(os.path.join(cur_dir, '..', 'res'))
     all_models_dir = os.path.abspath(os.path.join(cur_dir, '..', 'models'))
@@ -62,18 +68,30 @@ def train(epochs, batch_size, world_count, version_name=None, initial_epoch=0):
     keras.utils.plot_model(unet, to_file=f'{version_dir}\\unet.png', show_shapes=True,
                            show_layer_names=True)
 
-    # Set up tensorboard
-    print('Setting up tensorboard...')
-    tb_writer = tf.summary.FileWriter(logdir=graph_version_dir)
-    unet_loss_summary = tf.Summary()
-    unet_loss_summary.value.add(tag='unet_loss', simple_value=None)
-
     # Load Data
-    x_train = load_worlds(world_count, f'{res_dir}\\worlds\\', (128, 128), block_forward)
+    x_train = load_worlds(world_count, f'{res_dir}\\worlds\\', (128, 128), block_forward,
+                          use_dataset_cache=True)
+
+    print('Loading mask bank...')
+    mask_bank = MaskBank.load_or_create(f'{res_dir}\\mask_bank_128.npz', 20000, 128, 128)
 
     # Start Training loop
-    world_count = x_train.shape[0]
-    batch_cnt = (world_count - (world_count % batch_size)) // batch_size
+    batcher = BatchAssembler(x_train, batch_size)
+    batch_cnt = batcher.batch_count
+
+    # Set up tensorboard
+    print('Setting up tensorboard...')
+    tb_manager = TensorboardManager(graph_version_dir, batch_cnt)
+
+    # Masking and augmentation of upcoming batches runs in the background while the current one trains
+    transforms = None
+    if augment:
+        transforms = [RandomRotate(block_forward, block_backward), RandomFlip(block_forward, block_backward),
+                      RandomJitter(block_forward)]
+    stage = AugmentStage(batcher, transforms, HighMasks(mask_bank))
+    exporter = PreviewExporter(block_images, block_backward)
+    checkpoints = CheckpointManager(model_save_dir)
+    profiler = StepProfiler(profile, f'{version_dir}\\profile.json')
 
     for epoch in range(initial_epoch, epochs):
 
@@ -81,45 +99,45 @@ def train(epochs, batch_size, world_count, version_name=None, initial_epoch=0):
         # Create directories for current epoch
         cur_worlds_cur = utils.check_or_create_local_path(f'epoch{epoch}', worlds_dir)
         cur_previews_dir = utils.check_or_create_local_path(f'epoch{epoch}', previews_dir)
-        cur_models_dir = utils.check_or_create_local_path(f'epoch{epoch}', model_save_dir)
 
         print('Shuffling data...')
-        np.random.shuffle(x_train)
-
-        for batch in range(batch_cnt):
+        batcher.shuffle()
 
-            # Get real set of images
-            world_batch = x_train[batch * batch_size:(batch + 1) * batch_size]
-            world_batch_masked, world_masks = utils.mask_batch_high(world_batch)
+        epoch_loss = 0.0
+        for batch, (world_batch, world_batch_masked, world_masks) in enumerate(profiler.iterate(stage.epoch(epoch))):
 
             if batch % 1000 == 999 or batch == batch_cnt - 1:
 
                 # Save model
-                try:
-                    unet.save(f'{cur_models_dir}\\unet.h5')
-                    unet.save_weights(f'{cur_models_dir}\\unet.weights')
-                except ImportError:
-                    print('Failed to save data.')
+                with profiler.phase('checkpoint'):
+                    checkpoints.save(epoch, {'unet': unet}, metric=epoch_loss / max(batch, 1),
+                                     full_models=batch == batch_cnt - 1, batch=batch)
 
                 # Save previews
-                test = unet.predict([world_batch_masked, world_masks])
+                with profiler.phase('preview'):
+                    test = unet.predict([world_batch_masked, world_masks])
 
-                d0 = utils.decode_world_sigmoid(block_backward, world_batch[0])
-                utils.save_world_preview(block_images, d0, f'{cur_previews_dir}\\{batch}_orig.png')
+                    exporter.export_world(world_batch[0], f'{cur_previews_dir}\\{batch}_orig.png')
+                    exporter.export_world(test[0], f'{cur_previews_dir}\\{batch}_fixed.png')
+                    exporter.export_world(world_batch_masked[0], f'{cur_previews_dir}\\{batch}_masked.png')
 
-                d1 = utils.decode_world_sigmoid(block_backward, test[0])
-                utils.save_world_preview(block_images, d1, f'{cur_previews_dir}\\{batch}_fixed.png')
+            with profiler.phase('train'):
+                loss = unet.train_on_batch([world_batch_masked, world_masks], world_batch)
+            epoch_loss += loss
 
-                d2 = utils.decode_world_sigmoid(block_backward, world_batch_masked[0])
-                utils.save_world_preview(block_images, d2, f'{cur_previews_dir}\\{batch}_masked.png')
+            with profiler.phase('logging'):
+                # Divide by 1000 for better Y-Axis values
+                tb_manager.log_var('unet_loss', epoch, batch, loss / 1000.0)
+                tb_manager.log_step_time(epoch, batch)
 
-            loss = unet.train_on_batch([world_batch_masked, world_masks], world_batch)
+                print(f'epoch [{epoch}/{epochs}] :: batch [{batch}/{batch_cnt}] :: unet_loss = {loss}')
 
-            unet_loss_summary.value[0].simple_value = loss / 1000.0  # Divide by 1000 for better Y-Axis values
-            tb_writer.add_summary(unet_loss_summary, (epoch * batch_cnt) + batch)
-            tb_writer.flush()
+        profiler.end_epoch(epoch, tb_manager, batch_cnt - 1)
 
-            print(f'epoch [{epoch}/{epochs}] :: batch [{batch}/{batch_cnt}] :: unet_loss = {loss}')
+    stage.close()
+    exporter.close()
+    checkpoints.close()
+    tb_manager.close()
 
 
 def main():
@@ -55,24 +55,20 @@ def build_for(r, player_id):
     world_y1 = max(0, avg_y - 64)
     world_y2 = min(world_data.shape[1] - 1, world_y1 + 128)
 
-    input_mask = np.ones((128, 128, 10), dtype=np.int8)
+    input_mask = np.ones((128, 128, 1), dtype=np.int8)
     for i in range(len(coords)):
         loc_x = coords[i][0] - world_x1
         loc_y = coords[i][1] - world_y2
         input_mask[loc_x, loc_y, :] = 0
 
     input_data = np.zeros((128, 128), dtype=int)
-    for x in range(world_x1, world_x2):
-        for y in range(world_y1, world_y2):
-            loc_x = x - world_x1
-            loc_y = y - world_y1
-            cur_block_data = world_data[x, y, 0]
-            input_data[loc_x, loc_y] = cur_block_data.block_id
+    input_data[:world_x2 - world_x1, :world_y2 - world_y1] = world_data.get_layer(0)[world_x1:world_x2,
+                                                                                     world_y1:world_y2]
 
     utils.save_world_preview(block_images, input_data, f'{cur_dir}\\input.png')
 
     encoded_input = utils.encode_world_sigmoid(block_forward, input_data)
-    encoded_input[input_mask == 0] = 1
+    encoded_input[input_mask[:, :, 0] == 0] = 1
 
     encoded_context_data = None
     with graph.as_default():
@@ -97,16 +93,10 @@ def on_init(r, init_message):
     print('Joined.')
     r.send('init2')
 
-    width = init_message[18]
-    height = init_message[19]
-
     global world_data
     world_data = get_world_data(init_message)
 
-    wd = np.empty((width, height), dtype=int)
-    for x in range(width):
-        for y in range(height):
-            wd[x, y] = world_data[x, y, 0].block_id
+    wd = world_data.get_layer(0).astype(int)
 
     utils.save_world_preview(block_images, wd, f'{cur_dir}\\init.png')
 
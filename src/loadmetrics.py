@@ -0,0 +1,160 @@
+import json
+import math
+import time
+from multiprocessing import Array, Value
+
+
+class LoadMetrics:
+    # Counters kept per worker, each worker only writes to its own row so no locking is needed
+    fields = ['files', 'crops', 'bytes', 'parse_time', 'encode_time', 'filter_time', 'busy_time',
+              'missing_rejects', 'label_rejects', 'crops_checked', 'quality_rejects', 'cache_hits']
+
+    def __init__(self, **kwargs):
+        self.summary_interval = kwargs.get('summary_interval', 10.0)
+        self.jsonl_file = kwargs.get('jsonl_file', None)
+        self.tb_dir = kwargs.get('tb_dir', None)
+        self.tb_manager = None
+        self.report_index = 0
+
+        self.worker_count = 0
+        self.target_count = 0
+        self.values = None
+        self.start_time = None
+        self.end_time = None
+
+    def reset(self, worker_count, target_count):
+        # Must be called before the workers are started so the shared memory is inherited
+        self.worker_count = worker_count
+        self.target_count = int(target_count)
+        self.values = Array('d', worker_count * len(self.fields), lock=False)
+        self.start_time = Value('d', time.time(), lock=False)
+        self.end_time = None
+        self.report_index = 0
+
+    def add(self, worker_index, field, amount=1):
+        self.values[(worker_index * len(self.fields)) + self.fields.index(field)] += amount
+
+    def get(self, worker_index, field):
+        return self.values[(worker_index * len(self.fields)) + self.fields.index(field)]
+
+    def finish(self):
+        self.end_time = time.time()
+
+    def snapshot(self):
+        if self.values is None:
+            return {}
+
+        end_time = self.end_time if self.end_time is not None else time.time()
+        elapsed = max(end_time - self.start_time.value, 1e-6)
+
+        totals = {}
+        for field in self.fields:
+            totals[field] = sum([self.get(worker, field) for worker in range(self.worker_count)])
+
+        utilization = [min(self.get(worker, 'busy_time') / elapsed, 1.0) for worker in range(self.worker_count)]
+
+        parsed_files = totals['files'] - totals['missing_rejects'] - totals['label_rejects']
+        rejection_rate = {
+            'missing': totals['missing_rejects'] / max(totals['files'], 1),
+            'label': totals['label_rejects'] / max(totals['files'], 1),
+            'quality': totals['quality_rejects'] / max(totals['crops_checked'], 1)
+        }
+
+        return {
+            'elapsed': elapsed,
+            'files': int(totals['files']),
+            'crops': int(totals['crops']),
+            'target': self.target_count,
+            'bytes_read': int(totals['bytes']),
+            'cache_hit_rate': totals['cache_hits'] / max(parsed_files, 1),
+            'files_per_sec': totals['files'] / elapsed,
+            'crops_per_sec': totals['crops'] / elapsed,
+            'mb_per_sec': (totals['bytes'] / (1024 * 1024)) / elapsed,
+            'parse_time': totals['parse_time'],
+            'encode_time': totals['encode_time'],
+            'filter_time': totals['filter_time'],
+            'rejection_rate': rejection_rate,
+            'worker_utilization': utilization
+        }
+
+    def summary_str(self, stats=None):
+        if stats is None:
+            stats = self.snapshot()
+        if len(stats) == 0:
+            return 'No load in progress.'
+
+        eta_str = ''
+        if self.end_time is None and stats['crops_per_sec'] > 0 and stats['crops'] < stats['target']:
+            eta_sec = (stats['target'] - stats['crops']) / stats['crops_per_sec']
+            if eta_sec >= 60:
+                eta_str = f' :: ETA {int(math.ceil(eta_sec / 60.0))} minutes'
+            else:
+                eta_str = f' :: ETA {int(math.ceil(eta_sec))} seconds'
+
+        avg_util = sum(stats['worker_utilization']) / max(len(stats['worker_utilization']), 1)
+        rates = stats['rejection_rate']
+        return f'Loaded ({stats["crops"]}/{stats["target"]}) :: {stats["files_per_sec"]:.1f} files/s :: ' \
+               f'{stats["crops_per_sec"]:.1f} crops/s :: {stats["mb_per_sec"]:.2f} MB/s :: ' \
+               f'cache hits = {stats["cache_hit_rate"]:.2f} :: parse/encode/filter = {stats["parse_time"]:.1f}/' \
+               f'{stats["encode_time"]:.1f}/{stats["filter_time"]:.1f}s :: rejected missing/label/quality = ' \
+               f'{rates["missing"]:.2f}/{rates["label"]:.2f}/{rates["quality"]:.2f} :: utilization = ' \
+               f'{avg_util:.2f}{eta_str}'
+
+    def report(self):
+        stats = self.snapshot()
+        if len(stats) == 0:
+            return
+
+        print(self.summary_str(stats))
+
+        if self.jsonl_file is not None:
+            self.write_jsonl(self.jsonl_file, stats)
+
+        if self.tb_dir is not None:
+            self.write_tensorboard(stats)
+
+        self.report_index += 1
+
+    def write_jsonl(self, file, stats=None):
+        if stats is None:
+            stats = self.snapshot()
+
+        try:
+            with open(file, 'a') as fp:
+                fp.write(json.dumps(stats))
+                fp.write('\n')
+        except IOError:
+            print(f'Failed to write load metrics to {file}')
+
+    def write_tensorboard(self, stats=None):
+        if stats is None:
+            stats = self.snapshot()
+
+        # Only pull in tensorflow when tensorboard output is requested
+        if self.tb_manager is None:
+            from tbmanager import TensorboardManager
+            self.tb_manager = TensorboardManager(self.tb_dir, 1)
+
+        for name in ['files_per_sec', 'crops_per_sec', 'mb_per_sec', 'parse_time', 'encode_time', 'filter_time']:
+            self.tb_manager.log_var(f'load_{name}', self.report_index, 0, stats[name])
+
+        for name, rate in stats['rejection_rate'].items():
+            self.tb_manager.log_var(f'load_reject_{name}', self.report_index, 0, rate)
+
+        for worker, utilization in enumerate(stats['worker_utilization']):
+            self.tb_manager.log_var(f'load_utilization_{worker}', self.report_index, 0, utilization)
+
+        self.tb_manager.flush()
+
+    def wait_for(self, workers):
+        # Join workers while printing a periodic summary instead of per file output
+        last_report = time.time()
+        while any([worker.is_alive() for worker in workers]):
+            for worker in workers:
+                worker.join(timeout=0.5)
+                if time.time() - last_report >= self.summary_interval:
+                    self.report()
+                    last_report = time.time()
+
+        self.finish()
+        self.report()
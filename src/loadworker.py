@@ -1,19 +1,28 @@
-import math
 import os
 import random
 import time
-from multiprocessing import Process, Manager, Value, Lock, cpu_count
+from multiprocessing import Process, Manager, Value, Lock, Array, cpu_count
 
 import numpy as np
 
 import utils
+from datasetcache import DatasetCache, default_dataset_cache_dir, get_dataset_key, get_dict_hash
+from loadmetrics import LoadMetrics
+from worldcache import WorldCache, default_cache_dir
+from worldcatalog import WorldCatalog, default_catalog_file
 
+last_metrics = None
 
-def load_world(world_file, gen_size, block_forward, encode_func=utils.encode_world_sigmoid, overlap_x=1, overlap_y=1):
+
+def load_world(world_file, gen_size, block_forward, encode_func=utils.encode_world_sigmoid, overlap_x=1, overlap_y=1,
+               world_cache=None):
     if not os.path.exists(world_file):
         return
 
-    world = utils.load_world_data_ver3(world_file)
+    if world_cache is not None:
+        world = world_cache.load(world_file)
+    else:
+        world = utils.load_world_data_ver3(world_file)
     world_width = world.shape[0]
     world_height = world.shape[1]
 
@@ -69,8 +78,18 @@ def load_world(world_file, gen_size, block_forward, encode_func=utils.encode_wor
 
 
 def load_worlds(load_count, world_directory, gen_size, block_forward, **kwargs):
-    world_names = os.listdir(world_directory)
-    random.shuffle(world_names)
+    dataset_cache, dataset_key, dataset_params, file_random = start_dataset_cache('load_worlds', load_count,
+                                                                                  world_directory, gen_size,
+                                                                                  block_forward, kwargs)
+    if dataset_key is not None:
+        cached = dataset_cache.get(dataset_key)
+        if cached is not None:
+            return cached[0]
+
+    world_names = query_world_files(world_directory, kwargs)
+    if world_names is None:
+        world_names = os.listdir(world_directory)
+    file_random.shuffle(world_names)
 
     thread_count = min(load_count, cpu_count() - 1)
 
@@ -84,14 +103,20 @@ def load_worlds(load_count, world_directory, gen_size, block_forward, **kwargs):
 
         world_counter = Value('i', 0)
         thread_lock = Lock()
+        metrics = start_metrics(thread_count, load_count, kwargs)
+        world_cache = start_world_cache(world_directory, kwargs)
 
         threads = []
         for thread in range(thread_count):
             load_thread = WorldLoader(file_queue, manager, world_counter, thread_lock, load_count, gen_size,
-                                      block_forward, **kwargs)
+                                      block_forward, metrics=metrics, worker_index=thread, **kwargs)
             load_thread.start()
             threads.append(load_thread)
 
+        metrics.wait_for(threads)
+        if world_cache is not None:
+            world_cache.evict()
+
         world_index = 0
         for thread in range(len(threads)):
             threads[thread].join()
@@ -103,37 +128,57 @@ def load_worlds(load_count, world_directory, gen_size, block_forward, **kwargs):
                 world_index += 1
 
         world_array = world_array[:world_index, :, :, :]
-    return world_array
+
+    return finish_dataset_cache(dataset_cache, dataset_key, [world_array], dataset_params)[0]
 
 
 def load_worlds_with_labels(load_count, world_directory, label_dict, gen_size, block_forward, **kwargs):
+    dataset_cache, dataset_key, dataset_params, file_random = start_dataset_cache('load_worlds_with_labels',
+                                                                                  load_count, world_directory,
+                                                                                  gen_size, block_forward, kwargs,
+                                                                                  label_dict=label_dict)
+    if dataset_key is not None:
+        cached = dataset_cache.get(dataset_key)
+        if cached is not None:
+            return cached[0], cached[1]
+
+    labeled_files = get_labeled_files(world_directory, label_dict,
+                                      allowed_files=query_world_files(world_directory, kwargs),
+                                      file_random=file_random)
+    class_quotas = get_class_quotas(load_count, labeled_files, kwargs)
+    if class_quotas is not None:
+        labeled_files = {label: labeled_files[label] for label in labeled_files if label in class_quotas}
+        load_count = min(load_count, sum(class_quotas.values()))
+
     thread_count = min(load_count, cpu_count() - 1)
 
     with Manager() as manager:
         file_queue = manager.Queue()
 
-        dict_keys = []
-        for world_id in label_dict.keys():
-            dict_keys.append(f'{world_directory}\\{world_id}.world')
-
-        # Shuffle keys
-        random.shuffle(dict_keys)
-        for key in dict_keys:
-            file_queue.put(key)
+        for world_file in interleave_labeled_files(labeled_files):
+            file_queue.put(world_file)
 
         world_array = np.empty((load_count, gen_size[0], gen_size[1], 10), dtype=np.int8)
         world_labels = np.empty((load_count, 1), dtype=np.int8)
 
         world_counter = Value('i', 0)
         thread_lock = Lock()
+        class_counts = Array('i', len(class_quotas) if class_quotas is not None else 0)
+        metrics = start_metrics(thread_count, load_count, kwargs)
+        world_cache = start_world_cache(world_directory, kwargs)
 
         threads = []
         for thread in range(thread_count):
             load_thread = WorldLoader(file_queue, manager, world_counter, thread_lock, load_count, gen_size,
-                                      block_forward, label_dict=label_dict, **kwargs)
+                                      block_forward, label_dict=label_dict, class_quotas=class_quotas,
+                                      class_counts=class_counts, metrics=metrics, worker_index=thread, **kwargs)
             load_thread.start()
             threads.append(load_thread)
 
+        metrics.wait_for(threads)
+        if world_cache is not None:
+            world_cache.evict()
+
         world_index = 0
         for thread in range(len(threads)):
             threads[thread].join()
@@ -148,36 +193,54 @@ def load_worlds_with_labels(load_count, world_directory, label_dict, gen_size, b
 
         world_array = world_array[:world_index, :, :, :]
         world_labels = world_labels[:world_index, :]
+
+    world_array, world_labels = finish_dataset_cache(dataset_cache, dataset_key, [world_array, world_labels],
+                                                     dataset_params)
     return world_array, world_labels
 
 
 def load_worlds_with_label(load_count, world_directory, label_dict, label_target, gen_size, block_forward, **kwargs):
+    dataset_cache, dataset_key, dataset_params, file_random = start_dataset_cache('load_worlds_with_label',
+                                                                                  load_count, world_directory,
+                                                                                  gen_size, block_forward, kwargs,
+                                                                                  label_dict=label_dict,
+                                                                                  label_target=label_target)
+    if dataset_key is not None:
+        cached = dataset_cache.get(dataset_key)
+        if cached is not None:
+            return cached[0]
+
+    labeled_files = get_labeled_files(world_directory, label_dict, label_target,
+                                      allowed_files=query_world_files(world_directory, kwargs),
+                                      file_random=file_random)
+
     thread_count = min(load_count, cpu_count() - 1)
 
     with Manager() as manager:
         file_queue = manager.Queue()
 
-        dict_keys = []
-        for world_id in label_dict.keys():
-            dict_keys.append(f'{world_directory}\\{world_id}.world')
-
-        # Shuffle keys
-        random.shuffle(dict_keys)
-        for key in dict_keys:
-            file_queue.put(key)
+        for world_file in interleave_labeled_files(labeled_files):
+            file_queue.put(world_file)
 
         world_array = np.empty((load_count, gen_size[0], gen_size[1], 10), dtype=np.int8)
 
         world_counter = Value('i', 0)
         thread_lock = Lock()
+        metrics = start_metrics(thread_count, load_count, kwargs)
+        world_cache = start_world_cache(world_directory, kwargs)
 
         threads = []
         for thread in range(thread_count):
             load_thread = WorldLoader(file_queue, manager, world_counter, thread_lock, load_count, gen_size,
-                                      block_forward, label_dict=label_dict, label_target=label_target, **kwargs)
+                                      block_forward, label_dict=label_dict, label_target=label_target, metrics=metrics,
+                                      worker_index=thread, **kwargs)
             load_thread.start()
             threads.append(load_thread)
 
+        metrics.wait_for(threads)
+        if world_cache is not None:
+            world_cache.evict()
+
         world_index = 0
         for thread in range(len(threads)):
             threads[thread].join()
@@ -189,11 +252,14 @@ def load_worlds_with_label(load_count, world_directory, label_dict, label_target
                 world_index += 1
 
         world_array = world_array[:world_index, :, :, :]
-    return world_array
+
+    return finish_dataset_cache(dataset_cache, dataset_key, [world_array], dataset_params)[0]
 
 
 def load_worlds_with_files(load_count, world_directory, gen_size, block_forward, **kwargs):
-    world_names = os.listdir(world_directory)
+    world_names = query_world_files(world_directory, kwargs)
+    if world_names is None:
+        world_names = os.listdir(world_directory)
     random.shuffle(world_names)
 
     thread_count = min(load_count, cpu_count() - 1)
@@ -209,14 +275,20 @@ def load_worlds_with_files(load_count, world_directory, gen_size, block_forward,
 
         world_counter = Value('i', 0)
         thread_lock = Lock()
+        metrics = start_metrics(thread_count, load_count, kwargs)
+        world_cache = start_world_cache(world_directory, kwargs)
 
         threads = []
         for thread in range(thread_count):
             load_thread = WorldLoader(file_queue, manager, world_counter, thread_lock, load_count, gen_size,
-                                      block_forward, **kwargs)
+                                      block_forward, metrics=metrics, worker_index=thread, **kwargs)
             load_thread.start()
             threads.append(load_thread)
 
+        metrics.wait_for(threads)
+        if world_cache is not None:
+            world_cache.evict()
+
         world_index = 0
         for thread in range(len(threads)):
             threads[thread].join()
@@ -234,7 +306,9 @@ def load_worlds_with_files(load_count, world_directory, gen_size, block_forward,
 
 
 def load_worlds_with_minimaps(load_count, world_directory, gen_size, block_forward, minimap_values, **kwargs):
-    world_names = os.listdir(world_directory)
+    world_names = query_world_files(world_directory, kwargs)
+    if world_names is None:
+        world_names = os.listdir(world_directory)
     random.shuffle(world_names)
 
     thread_count = min(load_count, cpu_count() - 1)
@@ -250,14 +324,21 @@ def load_worlds_with_minimaps(load_count, world_directory, gen_size, block_forwa
 
         world_counter = Value('i', 0)
         thread_lock = Lock()
+        metrics = start_metrics(thread_count, load_count, kwargs)
+        world_cache = start_world_cache(world_directory, kwargs)
 
         threads = []
         for thread in range(thread_count):
             load_thread = WorldLoader(file_queue, manager, world_counter, thread_lock, load_count, gen_size,
-                                      block_forward, minimap_values=minimap_values, load_minimap=True, **kwargs)
+                                      block_forward, minimap_values=minimap_values, load_minimap=True, metrics=metrics,
+                                      worker_index=thread, **kwargs)
             load_thread.start()
             threads.append(load_thread)
 
+        metrics.wait_for(threads)
+        if world_cache is not None:
+            world_cache.evict()
+
         world_index = 0
         for thread in range(len(threads)):
             threads[thread].join()
@@ -276,7 +357,9 @@ def load_worlds_with_minimaps(load_count, world_directory, gen_size, block_forwa
 
 
 def load_minimaps(load_count, world_directory, gen_size, block_forward, minimap_values, **kwargs):
-    world_names = os.listdir(world_directory)
+    world_names = query_world_files(world_directory, kwargs)
+    if world_names is None:
+        world_names = os.listdir(world_directory)
     random.shuffle(world_names)
 
     thread_count = min(load_count, cpu_count() - 1)
@@ -291,15 +374,21 @@ def load_minimaps(load_count, world_directory, gen_size, block_forward, minimap_
 
         world_counter = Value('i', 0)
         thread_lock = Lock()
+        metrics = start_metrics(thread_count, load_count, kwargs)
+        world_cache = start_world_cache(world_directory, kwargs)
 
         threads = []
         for thread in range(thread_count):
             load_thread = WorldLoader(file_queue, manager, world_counter, thread_lock, load_count, gen_size,
                                       block_forward, minimap_values=minimap_values, load_minimap=True, skip_world=True,
-                                      **kwargs)
+                                      metrics=metrics, worker_index=thread, **kwargs)
             load_thread.start()
             threads.append(load_thread)
 
+        metrics.wait_for(threads)
+        if world_cache is not None:
+            world_cache.evict()
+
         world_index = 0
         for thread in range(len(threads)):
             threads[thread].join()
@@ -314,6 +403,156 @@ def load_minimaps(load_count, world_directory, gen_size, block_forward, minimap_
     return world_minimaps
 
 
+def get_dataset_params(kwargs, label_dict=None, label_target=None):
+    # Everything besides the loader arguments that changes which crops come out of a load
+    encode_func = kwargs.get('encode_func', utils.encode_world_sigmoid)
+    return {
+        'encode_func': encode_func.__name__,
+        'overlap_x': kwargs.get('overlap_x', 1),
+        'overlap_y': kwargs.get('overlap_y', 1),
+        'query': kwargs.get('query', None),
+        'label_name': kwargs.get('label_name', None),
+        'class_quotas': kwargs.get('class_quotas', None),
+        'balanced': kwargs.get('balanced', False),
+        'label_dict': get_dict_hash(label_dict),
+        'label_target': label_target,
+        'seed': kwargs.get('seed', None)
+    }
+
+
+def start_dataset_cache(loader_name, load_count, world_directory, gen_size, block_forward, kwargs, label_dict=None,
+                        label_target=None):
+    # With use_dataset_cache=True the loaded crops are stored under a key made from all load parameters and
+    # the state of the world directory, and later loads with the same key memory map them instead.
+    # A seed makes the file order repeatable, so a given seed can be used to ask for a different dataset. The
+    # order comes from the returned file_random, the global random module is left alone.
+    dataset_cache = kwargs.pop('dataset_cache', None)
+    use_dataset_cache = kwargs.pop('use_dataset_cache', dataset_cache is not None)
+
+    params = get_dataset_params(kwargs, label_dict, label_target)
+    file_random = random.Random(kwargs.pop('seed', None))
+
+    if not use_dataset_cache:
+        return None, None, None, file_random
+
+    if dataset_cache is None:
+        dataset_cache = DatasetCache(default_dataset_cache_dir(world_directory))
+
+    dataset_key, key_params = get_dataset_key(loader_name, world_directory, load_count, gen_size, block_forward,
+                                              params)
+    return dataset_cache, dataset_key, key_params, file_random
+
+
+def finish_dataset_cache(dataset_cache, dataset_key, arrays, dataset_params):
+    # Stores freshly loaded arrays and hands back the memory mapped entry, so the first load is cache backed like
+    # every later one and checkpoints or worker processes can refer to the cached file instead of copying it
+    if dataset_key is None:
+        return arrays
+
+    dataset_cache.put(dataset_key, arrays, dataset_params)
+    cached = dataset_cache.get(dataset_key)
+    if cached is None:
+        return arrays
+    return cached
+
+
+def query_world_files(world_directory, kwargs):
+    # With a query like 'width>=100, density>0.4' only worlds matching the catalog are loaded
+    query = kwargs.pop('query', None)
+    catalog = kwargs.pop('catalog', None)
+    label_name = kwargs.pop('label_name', None)
+    if query is None:
+        return None
+
+    if catalog is None:
+        # Opening a missing catalog would create an empty one and every query would silently match nothing
+        catalog_file = default_catalog_file(world_directory)
+        if not os.path.exists(catalog_file):
+            raise ValueError(f'No world catalog at \'{catalog_file}\', build it with worldcatalog.py first.')
+        catalog = WorldCatalog(catalog_file)
+
+    if catalog.count() == 0:
+        raise ValueError(f'World catalog \'{catalog.db_file}\' is empty, build it with worldcatalog.py first.')
+
+    world_files = catalog.query(query, label_name)
+    print(f'Catalog query \'{query}\' matched {len(world_files)} worlds.')
+    return world_files
+
+
+def get_labeled_files(world_directory, label_dict, label_target=None, allowed_files=None, file_random=random):
+    # Filter by label and existence up front so workers never parse a world only to discard it
+    allowed_ids = None
+    if allowed_files is not None:
+        allowed_ids = set([utils.get_world_id(world_file) for world_file in allowed_files])
+
+    labeled_files = {}
+    for world_id, label in label_dict.items():
+        if label_target is not None and label != label_target:
+            continue
+
+        if allowed_ids is not None and world_id not in allowed_ids:
+            continue
+
+        world_file = f'{world_directory}\\{world_id}.world'
+        if not os.path.exists(world_file):
+            continue
+
+        if label not in labeled_files:
+            labeled_files[label] = []
+        labeled_files[label].append(world_file)
+
+    for label in labeled_files:
+        file_random.shuffle(labeled_files[label])
+
+    candidate_count = sum([len(files) for files in labeled_files.values()])
+    print(f'Filtered {len(label_dict)} labeled worlds to {candidate_count} candidates.')
+    return labeled_files
+
+
+def interleave_labeled_files(labeled_files):
+    # Round robin between labels so every class fills its quota at a similar rate
+    interleaved = []
+    label_files = list(labeled_files.values())
+    longest = max([len(files) for files in label_files], default=0)
+    for i in range(longest):
+        for files in label_files:
+            if i < len(files):
+                interleaved.append(files[i])
+    return interleaved
+
+
+def get_class_quotas(load_count, labeled_files, kwargs):
+    # Either explicit per label crop counts or an even split between the labels that have files
+    class_quotas = kwargs.pop('class_quotas', None)
+    balanced = kwargs.pop('balanced', False)
+    if class_quotas is None and balanced and len(labeled_files) > 0:
+        class_quotas = {label: load_count // len(labeled_files) for label in labeled_files}
+    return class_quotas
+
+
+def start_metrics(thread_count, load_count, kwargs):
+    # Reuse metrics passed in by the caller so it can poll them during the load
+    global last_metrics
+    metrics = kwargs.pop('metrics', None)
+    if metrics is None:
+        metrics = LoadMetrics()
+
+    metrics.reset(thread_count, load_count)
+    last_metrics = metrics
+    return metrics
+
+
+def start_world_cache(world_directory, kwargs):
+    # Decoded worlds are cached next to the world directory unless disabled with use_world_cache=False
+    if kwargs.get('world_cache', None) is None and kwargs.pop('use_world_cache', True):
+        kwargs['world_cache'] = WorldCache(default_cache_dir(world_directory))
+    return kwargs.get('world_cache', None)
+
+
+def get_load_metrics():
+    return last_metrics
+
+
 def is_good_world(cross_section):
     # - Count blocks
     # - Diversity of blocks
@@ -351,41 +590,23 @@ def is_good_label_world(cross_section):
 
 
 class WorldLoader(Process):
-    time_pt_index = 0
-    time_pt_cnt = 0
-
-    def update_estimate(self, time_points, time0, time1, cnt0, cnt1):
-        cnt_delta = cnt1 - cnt0
-        worlds_left = self.target_count - self.world_counter.value
-        if cnt_delta != 0:
-            time_points[self.time_pt_index] = (time1 - time0) / cnt_delta
-            self.time_pt_index = (self.time_pt_index + 1) % len(time_points)
-            if self.time_pt_index < len(time_points):
-                self.time_pt_cnt += 1
-
-        if self.time_pt_cnt > 0:
-            time_left_sec = np.average(time_points[0:self.time_pt_cnt]) * worlds_left
-            time_left = time_left_sec / 60.0
-            time_left_minutes = int(time_left)
-            time_left_minutes_frac = time_left - time_left_minutes
-            time_left_seconds = int(math.ceil(time_left_minutes_frac * 60))
-            if time_left_minutes > 1:
-                return f'ETA {time_left_minutes} minutes'
-            elif time_left_minutes == 1:
-                return 'ETA 1 minute'
-            else:
-                return f'ETA {time_left_seconds} seconds'  # 'ETA <1 Minute'
-        else:
-            return ''
+
+    def is_quota_full(self, label):
+        if self.class_quotas is None:
+            return False
+
+        if label not in self.class_quotas:
+            return True
+
+        return self.class_counts[self.quota_labels.index(label)] >= self.class_quotas[label]
 
     def load_world(self, world_file):
+        self.metrics.add(self.worker_index, 'files')
         if not os.path.exists(world_file):
+            self.metrics.add(self.worker_index, 'missing_rejects')
             return
 
-        world = utils.load_world_data_ver3(world_file)
-        world_width = world.shape[0]
-        world_height = world.shape[1]
-
+        # Check the label before parsing so rejected worlds cost no file I/O
         label = None
         if self.label_dict is not None:
             world_id = utils.get_world_id(world_file)
@@ -393,11 +614,34 @@ class WorldLoader(Process):
                 label = self.label_dict[world_id]
                 if self.label_target is not None and label != self.label_target:
                     # Label does not match label_target
+                    self.metrics.add(self.worker_index, 'label_rejects')
+                    return
+
+                if self.is_quota_full(label):
+                    # Enough crops already loaded for this label
+                    self.metrics.add(self.worker_index, 'label_rejects')
                     return
             else:
                 # No label for world, return
+                self.metrics.add(self.worker_index, 'label_rejects')
                 return
 
+        time0 = time.time()
+        world = None
+        if self.world_cache is not None:
+            world = self.world_cache.get(world_file)
+
+        if world is not None:
+            self.metrics.add(self.worker_index, 'cache_hits')
+        else:
+            self.metrics.add(self.worker_index, 'bytes', os.path.getsize(world_file))
+            world = utils.load_world_data_ver3(world_file)
+            if self.world_cache is not None:
+                self.world_cache.put(world_file, world)
+        self.metrics.add(self.worker_index, 'parse_time', time.time() - time0)
+        world_width = world.shape[0]
+        world_height = world.shape[1]
+
         # Check if need to resize width
         if world_width < self.gen_size[0]:
             # Random placement along x axis
@@ -436,27 +680,43 @@ class WorldLoader(Process):
                 y_end = y_start + self.gen_size[1]
                 cross_section = world[x_start:x_end, y_start:y_end]
 
-                if (self.label_dict is not None and is_good_label_world(cross_section)) or \
-                        (self.label_dict is None and is_good_world(cross_section)):
+                time0 = time.time()
+                if self.label_dict is not None:
+                    is_good = is_good_label_world(cross_section)
+                else:
+                    is_good = is_good_world(cross_section)
+                self.metrics.add(self.worker_index, 'filter_time', time.time() - time0)
+                self.metrics.add(self.worker_index, 'crops_checked')
+
+                if is_good:
 
                     if self.skip_world:
                         if self.load_minimap and self.world_counter.value < self.target_count:
-                            self.thread_lock.acquire()
+                            time0 = time.time()
                             minimap = utils.encode_world_minimap(self.minimap_values, cross_section)
+                            self.metrics.add(self.worker_index, 'encode_time', time.time() - time0)
+
+                            self.thread_lock.acquire()
                             self.minimap_queue.put(minimap)
                             self.world_counter.value += 1
                             self.thread_lock.release()
+                            self.metrics.add(self.worker_index, 'crops')
 
                         y_start += np.random.randint(y_min_increment, self.gen_size[1] + 1)
                         continue
 
+                    time0 = time.time()
                     encoded_world0 = self.encode_func(self.block_forward, cross_section)
+                    self.metrics.add(self.worker_index, 'encode_time', time.time() - time0)
                     encoded_worlds = [encoded_world0]
 
                     self.thread_lock.acquire()
 
                     local_index = 0
                     while self.world_counter.value < self.target_count and local_index < len(encoded_worlds):
+                        if self.is_quota_full(label):
+                            break
+
                         self.load_queue.put(encoded_worlds[local_index])
 
                         if self.label_dict is not None:
@@ -468,13 +728,19 @@ class WorldLoader(Process):
                             minimap = utils.encode_world_minimap(self.minimap_values, cross_section)
                             self.minimap_queue.put(minimap)
 
+                        if self.class_quotas is not None:
+                            self.class_counts[self.quota_labels.index(label)] += 1
+
                         self.world_counter.value += 1
                         local_index += 1
 
                     self.thread_lock.release()
+                    self.metrics.add(self.worker_index, 'crops', local_index)
 
                     if local_index == 0:
                         break
+                else:
+                    self.metrics.add(self.worker_index, 'quality_rejects')
 
                 y_start += np.random.randint(y_min_increment, self.gen_size[1] + 1)
 
@@ -493,9 +759,13 @@ class WorldLoader(Process):
         self.block_forward = block_forward
 
         self.encode_func = kwargs.get('encode_func', utils.encode_world_sigmoid)
+        self.world_cache = kwargs.get('world_cache', None)
         self.label_dict = kwargs.get('label_dict', None)
 
         self.label_target = kwargs.get('label_target', None)
+        self.class_quotas = kwargs.get('class_quotas', None)
+        self.class_counts = kwargs.get('class_counts', None)
+        self.quota_labels = sorted(self.class_quotas.keys()) if self.class_quotas is not None else []
         self.overlap_x = kwargs.get('overlap_x', 1)
         self.overlap_y = kwargs.get('overlap_y', 1)
 
@@ -506,22 +776,22 @@ class WorldLoader(Process):
         if self.skip_world and not self.load_minimap:
             raise Exception('Nothing to load.')
 
+        self.metrics = kwargs.get('metrics', None)
+        self.worker_index = kwargs.get('worker_index', 0)
+        if self.metrics is None:
+            self.metrics = LoadMetrics()
+            self.metrics.reset(self.worker_index + 1, self.target_count)
+
         self.daemon = True
 
     def run(self):
-        time_points = np.array([0.] * 200)
         while not self.file_queue.empty() and self.world_counter.value < self.target_count:
             world_file = self.file_queue.get()
             time0 = time.time()
-            cnt0 = self.world_counter.value
             self.load_world(world_file)
-            time1 = time.time()
-            cnt1 = self.world_counter.value
-            time_est_str = self.update_estimate(time_points, time0, time1, cnt0, cnt1)
-            print(f'Loaded ({self.world_counter.value}/{self.target_count}) {time_est_str}')
+            self.metrics.add(self.worker_index, 'busy_time', time.time() - time0)
             if self.world_counter.value >= self.target_count:
                 break
-        print('Done loading.')
 
     def get_worlds(self):
         return self.load_queue
@@ -0,0 +1,137 @@
+import os
+
+import numpy as np
+
+
+def random_masks_high(count, width, height, max_size=12, random=None):
+    # Batched version of utils.random_mask_high, every shape of every sample is rasterized at once.
+    # Returns (count, width, height, 1) masks where 0 marks a hole.
+    if random is None:
+        random = np.random
+
+    xs = np.arange(width).reshape((1, 1, width, 1))
+    ys = np.arange(height).reshape((1, 1, 1, height))
+
+    # 1 or 2 rectangles per sample
+    rect_x1 = random.randint(1, width - max_size, size=(count, 2, 1, 1))
+    rect_x2 = rect_x1 + random.randint(5, max_size + 1, size=(count, 2, 1, 1))
+    rect_y1 = random.randint(1, height - max_size, size=(count, 2, 1, 1))
+    rect_y2 = rect_y1 + random.randint(5, max_size + 1, size=(count, 2, 1, 1))
+    rect_on = (np.arange(2).reshape((1, 2, 1, 1)) < random.randint(1, 3, size=(count, 1, 1, 1)))
+
+    holes = np.any(rect_on & (xs >= rect_x1) & (xs < rect_x2) & (ys >= rect_y1) & (ys < rect_y2), axis=1)
+
+    # 1 or 2 ellipses per sample
+    circle_x = random.randint(1, width - max_size, size=(count, 2, 1, 1))
+    circle_rx = random.randint(5, max_size + 1, size=(count, 2, 1, 1))
+    circle_y = random.randint(1, height - max_size, size=(count, 2, 1, 1))
+    circle_ry = random.randint(5, max_size + 1, size=(count, 2, 1, 1))
+    circle_on = (np.arange(2).reshape((1, 2, 1, 1)) < random.randint(1, 3, size=(count, 1, 1, 1)))
+
+    # The distance is separable, so only the per row and per column terms are computed for all shapes and the
+    # full (count, width, height) sum exists for one shape at a time, in float32
+    dist_x = (((xs - circle_x) / circle_rx) ** 2).astype(np.float32)
+    dist_y = (((ys - circle_y) / circle_ry) ** 2).astype(np.float32)
+    for i in range(2):
+        holes |= circle_on[:, i] & (dist_x[:, i] + dist_y[:, i] < 1)
+
+    # 15 to 20 lines per sample
+    line_count = 20
+    line_x1 = random.randint(1, width, size=(count, line_count, 1))
+    line_x2 = random.randint(1, width, size=(count, line_count, 1))
+    line_y1 = random.randint(1, height, size=(count, line_count, 1))
+    line_y2 = random.randint(1, height, size=(count, line_count, 1))
+    line_on = np.arange(line_count).reshape((1, line_count)) < random.randint(15, 21, size=(count, 1))
+
+    # One point per step along the major axis, like Bresenham
+    steps = np.maximum(np.maximum(np.abs(line_x2 - line_x1), np.abs(line_y2 - line_y1)), 1)
+    step = np.arange(max(width, height)).reshape((1, 1, -1))
+    t = np.minimum(step / steps, 1.0)
+    points_x = np.rint(line_x1 + (line_x2 - line_x1) * t).astype(int)
+    points_y = np.rint(line_y1 + (line_y2 - line_y1) * t).astype(int)
+    samples = np.broadcast_to(np.arange(count).reshape((count, 1, 1)), points_x.shape)
+
+    line_mask = line_on[:, :, None] & (step <= steps)
+    holes[samples[line_mask], points_x[line_mask], points_y[line_mask]] = True
+
+    return (1 - holes[:, :, :, None]).astype(np.int8)
+
+
+def random_masks_low(count, width, height, max_size=20, random=None):
+    # Batched version of utils.random_mask_low, returns (count, width, height, 1) masks with one rectangle of 1s
+    if random is None:
+        random = np.random
+
+    xs = np.arange(width).reshape((1, width, 1))
+    ys = np.arange(height).reshape((1, 1, height))
+
+    x1 = random.randint(1, width - max_size, size=(count, 1, 1))
+    x2 = x1 + random.randint(12, max_size + 1, size=(count, 1, 1))
+    y1 = random.randint(1, height - max_size, size=(count, 1, 1))
+    y2 = y1 + random.randint(12, max_size + 1, size=(count, 1, 1))
+
+    rects = (xs >= x1) & (xs < x2) & (ys >= y1) & (ys < y2)
+    return rects[:, :, :, None].astype(np.int8)
+
+
+class MaskBank:
+    # Precomputed masks stored as bitmaps, sampled with random flips and rolls so a modest bank
+    # still gives a large variety of masks
+
+    def __init__(self, packed, width, height):
+        self.packed = packed
+        self.width = width
+        self.height = height
+
+    @staticmethod
+    def create(count, width, height, chunk_size=128):
+        packed = np.empty((count, (width * height + 7) // 8), dtype=np.uint8)
+        for start in range(0, count, chunk_size):
+            end = min(start + chunk_size, count)
+            masks = random_masks_high(end - start, width, height)
+            packed[start:end] = np.packbits(masks.reshape((end - start, width * height)), axis=1)
+        return MaskBank(packed, width, height)
+
+    @staticmethod
+    def load(file):
+        with np.load(file) as data:
+            return MaskBank(data['packed'], int(data['width']), int(data['height']))
+
+    @staticmethod
+    def load_or_create(file, count, width, height):
+        if os.path.exists(file):
+            bank = MaskBank.load(file)
+            if bank.width == width and bank.height == height and len(bank) >= count:
+                return bank
+
+        print(f'Creating mask bank of {count} masks...')
+        bank = MaskBank.create(count, width, height)
+        bank.save(file)
+        return bank
+
+    def save(self, file):
+        np.savez_compressed(file, packed=self.packed, width=self.width, height=self.height)
+
+    def __len__(self):
+        return self.packed.shape[0]
+
+    def sample(self, count, random=None):
+        if random is None:
+            random = np.random
+
+        indices = random.randint(0, len(self), size=count)
+        masks = np.unpackbits(self.packed[indices], axis=1, count=self.width * self.height)
+        masks = masks.reshape((count, self.width, self.height))
+
+        # Random flips along both axes
+        flip_x = random.rand(count) < 0.5
+        masks[flip_x] = masks[flip_x, ::-1, :]
+        flip_y = random.rand(count) < 0.5
+        masks[flip_y] = masks[flip_y, :, ::-1]
+
+        # Random rolls, done as a single gather
+        rows = (np.arange(self.width)[None, :] + random.randint(0, self.width, size=(count, 1))) % self.width
+        cols = (np.arange(self.height)[None, :] + random.randint(0, self.height, size=(count, 1))) % self.height
+        masks = masks[np.arange(count)[:, None, None], rows[:, :, None], cols[:, None, :]]
+
+        return masks[:, :, :, None].astype(np.int8)
@@ -8,30 +8,26 @@ def parse(m):
     if m.type != 'init' and m.type != 'reset':
         raise Exception('Invalid message type')
 
-    p = 0
-    data = []
-
-    while m[p] != 'ws':
-        p += 1
-
-    p += 1
-
-    while m[p] != 'we':
-        data.append(m[p])
-        p += 1
+    values = m.args
+    start = values.index('ws') + 1
+    end = values.index('we', start)
+
+    # Every chunk is type, layer, xs, ys followed by its args, and only xs and ys are bytes. So the bytes mark where
+    # each chunk starts and everything up to the next chunk's type belongs to the args, found in one forward pass
+    xs_positions = []
+    p = start
+    while p < end:
+        if isinstance(values[p], bytes):
+            xs_positions.append(p)
+            p += 2
+        else:
+            p += 1
 
     chunks = []
-    while len(data) > 0:
-        args = []
-        while len(data) > 0 and not isinstance(data[-1], bytes):
-            args.insert(0, data.pop())
-
-        ys = list(memoryview(data.pop()))
-        xs = list(memoryview(data.pop()))
-        layer = data.pop()
-        block_type = data.pop()
-
-        chunks.append(DataChunk(layer, block_type, xs, ys, args))
+    for i, xs_position in enumerate(xs_positions):
+        args_end = xs_positions[i + 1] - 2 if i + 1 < len(xs_positions) else end
+        chunks.append(DataChunk(values[xs_position - 1], values[xs_position - 2], values[xs_position],
+                                values[xs_position + 1], values[xs_position + 2:args_end]))
 
     return chunks
 
@@ -40,23 +36,96 @@ def get_world_data(m):
     world_width = m[18]
     world_height = m[19]
 
-    blocks = np.empty((world_width, world_height, 2), dtype=BlockData)
+    world = WorldState(world_width, world_height)
+    for chunk in parse(m):
+        world.set_blocks(chunk.layer, chunk.xs, chunk.ys, int(chunk.type), chunk.args)
+    return world
+
+
+class WorldState:
+    # Block ids of both layers in a (2, width, height) uint16 array, plus the args of the few blocks that have any in
+    # a dict keyed by (layer, x, y). Indexing with [x, y, layer] returns a BlockView that reads and writes through to
+    # the arrays, so code written against the old array of BlockData keeps working.
+
+    def __init__(self, width, height):
+        self.ids = np.zeros((2, width, height), dtype=np.uint16)
+        self.args = {}
+
+        # The border of both layers starts out as gray basic blocks
+        self.ids[:, 0, :] = 9
+        self.ids[:, width - 1, :] = 9
+        self.ids[:, :, 0] = 9
+        self.ids[:, :, height - 1] = 9
+
+    @property
+    def width(self):
+        return self.ids.shape[1]
+
+    @property
+    def height(self):
+        return self.ids.shape[2]
+
+    @property
+    def shape(self):
+        return self.width, self.height, 2
+
+    def __getitem__(self, item):
+        x, y, layer = item
+        return BlockView(self, layer, x, y)
+
+    def __setitem__(self, item, block_id):
+        # world[x, y] = block_id sets the foreground, world[x, y, layer] = block_id a specific layer
+        if len(item) == 2:
+            item = item + (0,)
+        x, y, layer = item
+        self.set_block(layer, x, y, block_id)
+
+    def get_layer(self, layer=0):
+        # A view, copy it before keeping it around while the world still changes
+        return self.ids[layer]
+
+    def snapshot(self):
+        return np.copy(self.ids), dict(self.args)
+
+    def set_block(self, layer, x, y, block_id, args=None):
+        self.ids[layer, x, y] = block_id
+        if args:
+            self.args[(layer, x, y)] = args
+        else:
+            self.args.pop((layer, x, y), None)
+
+    def set_blocks(self, layer, xs, ys, block_id, args=None):
+        # Scatters one block id to many cells at once, only blocks with args touch the dict
+        self.ids[layer, xs, ys] = block_id
+        if args:
+            for x, y in zip(xs.tolist(), ys.tolist()):
+                self.args[(layer, x, y)] = args
+        elif len(self.args) > 0:
+            for x, y in zip(xs.tolist(), ys.tolist()):
+                self.args.pop((layer, x, y), None)
+
+
+class BlockView:
+    # Stands in for BlockData on a WorldState
+
+    def __init__(self, world, layer, x, y):
+        self.world = world
+        self.layer = layer
+        self.x = x
+        self.y = y
 
-    for i in range(world_width):
-        for j in range(world_height):
-            for k in range(2):
-                block_id = 0
-                if i == 0 or i == world_width - 1 or j == 0 or j == world_height - 1:
-                    block_id = 9
+    @property
+    def block_id(self):
+        return int(self.world.ids[self.layer, self.x, self.y])
 
-                blocks[i, j, k] = BlockData(k, i, j, block_id, None)
+    @block_id.setter
+    def block_id(self, block_id):
+        # Like assigning BlockData.block_id, the args of the cell are left as they are
+        self.world.ids[self.layer, self.x, self.y] = block_id
 
-    data = parse(m)
-    for chunk in data:
-        for location in chunk.locations:
-            blocks[location[0], location[1], chunk.layer] = BlockData(chunk.layer, location[0], location[1],
-                                                                      int(chunk.type), chunk.args)
-    return blocks
+    @property
+    def args(self):
+        return self.world.args.get((self.layer, self.x, self.y), None)
 
 
 class BlockData:
@@ -75,20 +144,20 @@ class BlockData:
 
 
 class DataChunk:
-    locations = None
-    args = None
-    layer = None
-    type = None
+    # One block type on one layer, xs and ys hold the coordinates of every block of the chunk
 
     def __init__(self, layer, block_type, xs, ys, args):
         self.layer = layer
         self.type = block_type
         self.args = args
-        self.locations = self.get_locations(xs, ys)
+        self.xs = self.decode_coordinates(xs)
+        self.ys = self.decode_coordinates(ys)
+
+    @property
+    def locations(self):
+        return list(zip(self.xs.tolist(), self.ys.tolist()))
 
     @staticmethod
-    def get_locations(xs, ys):
-        points = []
-        for i in range(0, len(xs), 2):
-            points.append((((xs[i] << 8) | xs[i + 1]), ((ys[i] << 8) | ys[i + 1])))
-        return points
\ No newline at end of file
+    def decode_coordinates(data):
+        # Coordinates are big endian unsigned shorts
+        return np.frombuffer(data, dtype='>u2').astype(np.intp)
@@ -13,10 +13,17 @@ from keras.models import Sequential, load_model
 from keras.optimizers import Adam
 
 import utils
-from loadworker import load_world, load_worlds_with_labels, load_worlds_with_files
+from activelearning import ActiveLearner
+from batcher import BatchAssembler, BatchSequence
+from dataparallel import run_data_parallel
+from loadworker import load_world, load_worlds_with_labels
+from profiler import ProfilerCallback, StepProfiler
+from scoring import ScoreTable, default_score_file, render_previews, score_corpus
+from sweep import SweepCallback, grid_configs, run_sweep
+from worldcache import WorldCache, default_cache_dir
 
 
-def build_classifier(size):
+def build_classifier(size, dropout=0.15):
     model = Sequential(name='pro_classifier')
 
     f = 64
@@ -36,7 +43,7 @@ def build_classifier(size):
         model.add(LeakyReLU())
 
         model.add(MaxPooling2D(pool_size=(2, 2)))
-        model.add(SpatialDropout2D(0.15))
+        model.add(SpatialDropout2D(dropout))
 
         f = f * 2
         s = s // 2
@@ -47,7 +54,56 @@ def build_classifier(size):
     return model
 
 
-def train(epochs, batch_size, world_count, dict_src_name, version_name=None, initial_epoch=0):
+def build_score_map_model(classifier):
+    # Same trunk as the classifier but for worlds of any size, the final dense layer becomes a 1x1 convolution
+    # so it outputs a logit for every region the global average pooling would have averaged over
+    score_model = Sequential(name='pro_score_map')
+
+    trunk_layers = [layer for layer in classifier.layers if not isinstance(layer, (GlobalAveragePooling2D, Dense))]
+    for i, layer in enumerate(trunk_layers):
+        config = layer.get_config()
+        if i == 0:
+            config['batch_input_shape'] = (None, None, None, 10)
+        score_model.add(layer.__class__.from_config(config))
+
+    dense = classifier.layers[-1]
+    score_model.add(Conv2D(filters=1, kernel_size=1, strides=1, padding='same'))
+
+    for layer, source in zip(score_model.layers, trunk_layers):
+        layer.set_weights(source.get_weights())
+    kernel, bias = dense.get_weights()
+    score_model.layers[-1].set_weights([kernel.reshape((1, 1) + kernel.shape), bias])
+    return score_model
+
+
+def score_world_map(score_model, encoded_world, min_size=64):
+    # Returns the score of every region and the pooled score of the whole world. Averaging the logits before the
+    # sigmoid is the same as the classifier's global average pooling followed by its dense layer.
+    width = max(encoded_world.shape[0], min_size)
+    height = max(encoded_world.shape[1], min_size)
+    batch_input = np.zeros((1, width, height, 10), dtype=np.int8)
+    batch_input[0, :encoded_world.shape[0], :encoded_world.shape[1]] = encoded_world
+
+    logits = score_model.predict(batch_input)[0, :, :, 0].astype(np.float64)
+
+    # Drop the regions that only cover the zero padding so they do not pull down the world score
+    stride = 2 ** len([layer for layer in score_model.layers if isinstance(layer, MaxPooling2D)])
+    map_width = -(-encoded_world.shape[0] // stride)
+    map_height = -(-encoded_world.shape[1] // stride)
+    logits = logits[:map_width, :map_height]
+
+    score_map = 1.0 / (1.0 + np.exp(-logits))
+    world_score = 1.0 / (1.0 + np.exp(-logits.mean()))
+    return score_map, world_score
+
+
+def save_score_map(score_map, name):
+    # Transposed so the heatmap lines up with world previews, which are drawn with x as the horizontal axis
+    plt.imsave(name, score_map.T, cmap='magma', vmin=0.0, vmax=1.0)
+
+
+def train(epochs, batch_size, world_count, dict_src_name, version_name=None, initial_epoch=0, profile=False,
+          workers=1):
     cur_dir = os.getcwd()
     res_dir = os.path.abspath(os.path.join(cur_dir, '..', 'res'))
     all_models_dir = os.path.abspath(os.path.join(cur_dir, '..', 'models'))
@@ -87,10 +143,17 @@ def train(epochs, batch_size, world_count, dict_src_name, version_name=None, ini
 
     print('Loading worlds...')
     x, y_raw = load_worlds_with_labels(world_count, f'{res_dir}\\worlds\\', label_dict, (size, size),
-                                       block_forward)
+                                       block_forward, balanced=True, use_dataset_cache=True)
 
     y = utils.convert_labels_binary(y_raw, epsilon=0)
 
+    if workers > 1:
+        # Each worker trains on its own shard of the training set with gradients averaged after every batch,
+        # batch_size is per worker
+        run_data_parallel(c, build_classifier, (size,), x, y, workers, epochs, batch_size, 0.0001, model_save_dir,
+                          graph_version_dir, version_dir, initial_epoch=initial_epoch)
+        return
+
     # Create callback for automatically saving best model based on highest regular accuracy
     check_best_acc = keras.callbacks.ModelCheckpoint(f'{model_save_dir}\\best_acc.h5', monitor='acc', verbose=0,
                                                      save_best_only=True, save_weights_only=False, mode='max',
@@ -111,65 +174,120 @@ def train(epochs, batch_size, world_count, dict_src_name, version_name=None, ini
                                               write_grads=True)
 
     callback_list = [check_best_acc, latest_h5_callback, latest_weights_callback, tb_callback]
+    if profile:
+        profiler = StepProfiler(True, f'{version_dir}\\profile.json')
+        callback_list.append(ProfilerCallback(profiler, f'{graph_version_dir}\\profile'))
+
+    # Split by index so the training data is never copied or moved
+    train_batcher = BatchAssembler([x, y], batch_size, validation_split=0.2)
+    train_sequence = BatchSequence(train_batcher)
+    validation_sequence = BatchSequence(train_batcher.get_validation_assembler(), shuffle=False)
 
     # Train model
-    c.fit(x, y, batch_size, epochs, initial_epoch=initial_epoch, callbacks=callback_list, validation_split=0.2)
+    c.fit_generator(train_sequence, epochs=epochs, initial_epoch=initial_epoch, callbacks=callback_list,
+                    validation_data=validation_sequence)
+
+
+def train_trial(config, arrays, reporter):
+    # One sweep trial, config holds lr, batch_size, dropout and epochs
+    x, y = arrays
+
+    c = build_classifier(64, config['dropout'])
+    c.compile(loss='binary_crossentropy', optimizer=Adam(lr=config['lr']), metrics=['accuracy'])
 
+    # Same split for every trial so their validation accuracies compare
+    train_batcher = BatchAssembler([x, y], config['batch_size'], validation_split=0.2, seed=0)
+    train_sequence = BatchSequence(train_batcher)
+    validation_sequence = BatchSequence(train_batcher.get_validation_assembler(), shuffle=False)
 
-def predict(network_ver, dict_src_name):
+    history = c.fit_generator(train_sequence, epochs=config['epochs'], callbacks=[SweepCallback(reporter, 'val_acc')],
+                              validation_data=validation_sequence, verbose=0)
+    return {'val_loss': min(history.history['val_loss']), 'val_acc': max(history.history['val_acc'])}
+
+
+def sweep(world_count, dict_src_name, grid, workers=2, threads_per_trial=None):
     cur_dir = os.getcwd()
     res_dir = os.path.abspath(os.path.join(cur_dir, '..', 'res'))
     all_models_dir = os.path.abspath(os.path.join(cur_dir, '..', 'models'))
     model_dir = utils.check_or_create_local_path('pro_classifier', all_models_dir)
-    version_dir = utils.check_or_create_local_path(network_ver, model_dir)
-    model_save_dir = utils.check_or_create_local_path('models', version_dir)
+    sweeps_dir = utils.check_or_create_local_path('sweeps', model_dir)
+    sweep_dir = utils.check_or_create_local_path(f'ver{utils.get_latest_version(sweeps_dir) + 1}', sweeps_dir)
 
-    classifications_dir = utils.check_or_create_local_path('classifications', model_dir)
-    utils.delete_files_in_path(classifications_dir)
+    print('Loading encoding dictionaries...')
+    block_forward, block_backward = utils.load_encoding_dict(res_dir, 'blocks_optimized')
 
-    pro_dir = utils.check_or_create_local_path('pro', classifications_dir)
-    notpro_dir = utils.check_or_create_local_path('notpro', classifications_dir)
+    print('Loading labels...')
+    label_dict = utils.load_label_dict(res_dir, dict_src_name)
+
+    # Loaded once and shared by every trial
+    print('Loading worlds...')
+    x, y_raw = load_worlds_with_labels(world_count, f'{res_dir}\\worlds\\', label_dict, (64, 64), block_forward,
+                                       balanced=True, use_dataset_cache=True)
+    y = utils.convert_labels_binary(y_raw, epsilon=0)
+
+    return run_sweep(train_trial, grid_configs(grid), [x, y], sweep_dir, workers=workers,
+                     threads_per_trial=threads_per_trial, mode='max')
+
+
+def predict(network_ver, batch_size=256, rescore=False):
+    # Scores every world in the corpus, previews are rendered separately by render_predictions
+    cur_dir = os.getcwd()
+    res_dir = os.path.abspath(os.path.join(cur_dir, '..', 'res'))
+    all_models_dir = os.path.abspath(os.path.join(cur_dir, '..', 'models'))
+    model_dir = utils.check_or_create_local_path('pro_classifier', all_models_dir)
+    version_dir = utils.check_or_create_local_path(network_ver, model_dir)
+    model_save_dir = utils.check_or_create_local_path('models', version_dir)
 
     print('Loading model...')
     classifier = load_model(f'{model_save_dir}\\latest.h5')
-
-    print('Loading block images...')
-    block_images = utils.load_block_images(res_dir)
+    size = classifier.input_shape[1] or 64
 
     print('Loading encoding dictionaries...')
     block_forward, block_backward = utils.load_encoding_dict(res_dir, 'blocks_optimized')
 
-    x_data, x_files = load_worlds_with_files(5000, f'{res_dir}\\worlds\\', (112, 112), block_forward)
+    world_directory = f'{res_dir}\\worlds\\'
+    world_cache = WorldCache(default_cache_dir(world_directory))
+    score_table = ScoreTable(default_score_file(world_directory))
+    score_corpus(classifier, f'pro_classifier_{network_ver}', world_directory, score_table, (size, size),
+                 block_forward, batch_size=batch_size, world_cache=world_cache, rescore=rescore)
+    score_table.close()
 
-    x_labeled = utils.load_label_dict(res_dir, dict_src_name)
 
-    batch_size = 50
-    batches = x_data.shape[0] // batch_size
+def render_predictions(network_ver, dict_src_name, limit=2500):
+    # Renders the limit most confident pro and notpro worlds from the score table, skipping labeled worlds
+    cur_dir = os.getcwd()
+    res_dir = os.path.abspath(os.path.join(cur_dir, '..', 'res'))
+    all_models_dir = os.path.abspath(os.path.join(cur_dir, '..', 'models'))
+    model_dir = utils.check_or_create_local_path('pro_classifier', all_models_dir)
 
-    for batch_index in range(batches):
-        x_batch = x_data[batch_index * batch_size:(batch_index + 1) * batch_size]
-        y_batch = classifier.predict(x_batch)
+    classifications_dir = utils.check_or_create_local_path('classifications', model_dir)
+    utils.delete_files_in_path(classifications_dir)
 
-        for world in range(batch_size):
-            g_index = (batch_index * batch_size) + world
-            world_file = x_files[g_index]
-            world_id = utils.get_world_id(world_file)
+    pro_dir = utils.check_or_create_local_path('pro', classifications_dir)
+    notpro_dir = utils.check_or_create_local_path('notpro', classifications_dir)
+
+    print('Loading block images...')
+    block_images = utils.load_block_images(res_dir)
 
-            # Ignore worlds we've already labeled
-            if world_id in x_labeled:
-                continue
+    x_labeled = utils.load_label_dict(res_dir, dict_src_name)
 
-            prediction = y_batch[world]
+    world_directory = f'{res_dir}\\worlds\\'
+    score_table = ScoreTable(default_score_file(world_directory))
+    model = f'pro_classifier_{network_ver}'
+    pro_rows = score_table.get_scores(model, min_score=0.5, descending=True)
+    notpro_rows = score_table.get_scores(model, max_score=0.5, descending=False)
+    score_table.close()
 
-            world_data = utils.load_world_data_ver3(f'{res_dir}\\worlds\\{world_id}.world')
+    jobs = []
+    for rows, output_dir in [(pro_rows, pro_dir), (notpro_rows, notpro_dir)]:
+        # Ignore worlds we've already labeled
+        rows = [row for row in rows if row[0] not in x_labeled][:limit]
+        jobs.extend((f'{world_directory}{filename}', f'{output_dir}{world_id}.png') for world_id, filename, _ in rows)
 
-            if prediction[0] < 0.5:
-                utils.save_world_preview(block_images, world_data, f'{notpro_dir}\\{world_id}.png')
-            else:
-                utils.save_world_preview(block_images, world_data, f'{pro_dir}\\{world_id}.png')
+    render_previews(jobs, block_images, WorldCache(default_cache_dir(world_directory)))
 
 
-def predict_sample_matlab(network_ver, dict_src_name, cols, rows):
+def predict_sample_matlab(network_ver, dict_src_name, cols, rows, whole_world=False):
     cur_dir = os.getcwd()
     res_dir = os.path.abspath(os.path.join(cur_dir, '..', 'res'))
     all_models_dir = os.path.abspath(os.path.join(cur_dir, '..', 'models'))
@@ -191,9 +309,11 @@ def predict_sample_matlab(network_ver, dict_src_name, cols, rows):
 
     x_labeled = utils.load_label_dict(res_dir, dict_src_name)
     x_worlds = os.listdir(f'{res_dir}\\worlds\\')
+    world_cache = WorldCache(default_cache_dir(f'{res_dir}\\worlds\\'))
     np.random.shuffle(x_worlds)
 
     world_size = classifier.input_shape[1]
+    score_model = build_score_map_model(classifier) if whole_world else None
     dpi = 96
     hpixels = 320 * cols
     hfigsize = hpixels / dpi
@@ -209,21 +329,34 @@ def predict_sample_matlab(network_ver, dict_src_name, cols, rows):
         world_id = utils.get_world_id(world_filename)
         if world_id not in x_labeled:
 
-            # Load world and save preview
-            encoded_regions = load_world(world_file, (world_size, world_size), block_forward)
-            if len(encoded_regions) == 0:
-                continue
+            if whole_world:
+                # One forward pass over the whole world instead of scoring a single crop
+                world_data = world_cache.load(world_file)
+                score_map, pro_score = score_world_map(score_model, utils.encode_world_sigmoid(block_forward,
+                                                                                               world_data), world_size)
+                if pro_score < pro_score_floor or pro_score > pro_score_ceiling:
+                    continue
+
+                decoded_region = world_data
+                save_score_map(score_map, f'{plots_dir}\\heatmap{sample_num}.png')
+            else:
+                # Load world and save preview
+                encoded_regions = load_world(world_file, (world_size, world_size), block_forward,
+                                             world_cache=world_cache)
+                if len(encoded_regions) == 0:
+                    continue
+
+                # Create prediction
+                batch_input = np.empty((1, world_size, world_size, 10), dtype=np.int8)
+                batch_input[0] = encoded_regions[0]
+                batch_score = classifier.predict(batch_input)
+                pro_score = batch_score[0][0]
 
-            # Create prediction
-            batch_input = np.empty((1, world_size, world_size, 10), dtype=np.int8)
-            batch_input[0] = encoded_regions[0]
-            batch_score = classifier.predict(batch_input)
-            pro_score = batch_score[0][0]
+                if pro_score < pro_score_floor or pro_score > pro_score_ceiling:
+                    continue
 
-            if pro_score < pro_score_floor or pro_score > pro_score_ceiling:
-                continue
+                decoded_region = utils.decode_world_sigmoid(block_backward, encoded_regions[0])
 
-            decoded_region = utils.decode_world_sigmoid(block_backward, encoded_regions[0])
             utils.save_world_preview(block_images, decoded_region, f'{plots_dir}\\preview{sample_num}.png')
 
             pro_score_floor += 1.0 / (rows * cols)
@@ -237,11 +370,11 @@ def predict_sample_matlab(network_ver, dict_src_name, cols, rows):
             subplt.set_xlabel('P = %.2f%%' % (pro_score * 100))
 
             no_labels = 2  # how many labels to see on axis x
-            step = (16 * world_size) / (no_labels - 1)  # step between consecutive labels
-            positions = np.arange(0, (16 * world_size) + 1, step)  # pixel count at label position
-            labels = positions // 16
-            plt.xticks(positions, labels)
-            plt.yticks(positions, labels)
+            for ticks, region_size in [(plt.xticks, decoded_region.shape[0]), (plt.yticks, decoded_region.shape[1])]:
+                step = (16 * region_size) / (no_labels - 1)  # step between consecutive labels
+                positions = np.arange(0, (16 * region_size) + 1, step)  # pixel count at label position
+                labels = positions // 16
+                ticks(positions, labels)
             plt.imshow(img)
 
             print(f'Adding plot {sample_num + 1} of {rows * cols}')
@@ -255,6 +388,46 @@ def predict_sample_matlab(network_ver, dict_src_name, cols, rows):
     fig.savefig(f'{plots_dir}\\plot.png', transparent=True)
 
 
+def start_labeling_round(network_ver, dict_src_name, count=200, batch_size=256):
+    # Scores new or changed worlds with the model and renders the most uncertain unlabeled ones for sorting
+    cur_dir = os.getcwd()
+    res_dir = os.path.abspath(os.path.join(cur_dir, '..', 'res'))
+    all_models_dir = os.path.abspath(os.path.join(cur_dir, '..', 'models'))
+    model_dir = utils.check_or_create_local_path('pro_classifier', all_models_dir)
+    version_dir = utils.check_or_create_local_path(network_ver, model_dir)
+    model_save_dir = utils.check_or_create_local_path('models', version_dir)
+    labeling_dir = utils.check_or_create_local_path('active_learning', model_dir)
+
+    print('Loading model...')
+    classifier = load_model(f'{model_save_dir}\\latest.h5')
+    size = classifier.input_shape[1] or 64
+
+    print('Loading block images...')
+    block_images = utils.load_block_images(res_dir)
+
+    print('Loading encoding dictionaries...')
+    block_forward, block_backward = utils.load_encoding_dict(res_dir, 'blocks_optimized')
+
+    learner = ActiveLearner(res_dir, dict_src_name, labeling_dir)
+    world_cache = WorldCache(default_cache_dir(learner.world_directory))
+    model = f'pro_classifier_{network_ver}'
+    learner.score(classifier, model, (size, size), block_forward, batch_size=batch_size, world_cache=world_cache)
+
+    round_dir = learner.start_round(model, count, block_images, world_cache)
+    print(f'Sort the previews in {round_dir}unsorted into pro and notpro, then run finish_labeling_round.')
+
+
+def finish_labeling_round(dict_src_name):
+    cur_dir = os.getcwd()
+    res_dir = os.path.abspath(os.path.join(cur_dir, '..', 'res'))
+    all_models_dir = os.path.abspath(os.path.join(cur_dir, '..', 'models'))
+    model_dir = utils.check_or_create_local_path('pro_classifier', all_models_dir)
+    labeling_dir = utils.check_or_create_local_path('active_learning', model_dir)
+
+    learner = ActiveLearner(res_dir, dict_src_name, labeling_dir)
+    learner.collect_round()
+
+
 def add_training_data(current_label_dict):
     cur_dir = os.getcwd()
     res_dir = os.path.abspath(os.path.join(cur_dir, '..', 'res'))
@@ -295,6 +468,7 @@ def save_current_labels(current_label_dict):
 
     print('Loading label dict...')
     x_labeled = utils.load_label_dict(res_dir, current_label_dict)
+    world_cache = WorldCache(default_cache_dir(f'{res_dir}\\worlds\\'))
 
     saved = 0
     for x_world in x_labeled:
@@ -305,7 +479,7 @@ def save_current_labels(current_label_dict):
             continue
 
         world_file = f'{res_dir}\\worlds\\{x_world}.world'
-        world_data = utils.load_world_data_ver3(world_file)
+        world_data = world_cache.load(world_file)
 
         if label == 1:
             utils.save_world_preview(block_images, world_data, f'{pro_dir}\\{x_world}.png')
@@ -318,8 +492,13 @@ def save_current_labels(current_label_dict):
 
 def main():
     train(epochs=100, batch_size=32, world_count=125000, dict_src_name='pro_labels_b')
-    # predict('ver9', dict_src_name='pro_labels_b')
+    # sweep(world_count=125000, dict_src_name='pro_labels_b',
+    #       grid={'lr': [0.001, 0.0001], 'batch_size': [32, 64], 'dropout': [0.1, 0.15, 0.25], 'epochs': [10]})
+    # predict('ver9')
+    # render_predictions('ver9', dict_src_name='pro_labels_b')
     # add_training_data('pro_labels_b')
+    # start_labeling_round('ver9', dict_src_name='pro_labels_b', count=200)
+    # finish_labeling_round('pro_labels_b')
     # predict_sample_matlab('ver38', dict_src_name='pro_labels_b', cols=3, rows=3)
     # save_current_labels('pro_labels_b')
 
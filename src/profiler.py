@@ -0,0 +1,162 @@
+import json
+import os
+import time
+
+import numpy as np
+from keras.callbacks import Callback
+
+
+class NullPhase:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+null_phase = NullPhase()
+
+
+class Phase:
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.start = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler.add(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class StepProfiler:
+    # Times named phases of every training step, e.g. data, train, preview and checkpoint, and reports
+    # percentiles per phase at the end of each epoch. When disabled, phase returns a shared no-op context manager
+    # and iterate returns the iterable unchanged, so the hooks can stay in the training loops.
+
+    def __init__(self, enabled=False, json_file=None, percentiles=(50, 90, 99)):
+        self.enabled = enabled
+        self.json_file = json_file
+        self.percentiles = percentiles
+        self.times = {}
+
+    def phase(self, name):
+        if not self.enabled:
+            return null_phase
+        return Phase(self, name)
+
+    def iterate(self, iterable, name='data'):
+        # Times how long each item takes to arrive, for loops that pull batches from a generator
+        if not self.enabled:
+            return iterable
+        return self.timed_iter(iterable, name)
+
+    def timed_iter(self, iterable, name):
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.add(name, time.perf_counter() - start)
+            yield item
+
+    def add(self, name, seconds):
+        if name not in self.times:
+            self.times[name] = []
+        self.times[name].append(seconds)
+
+    def get_stats(self):
+        stats = {}
+        for name, times in self.times.items():
+            times = np.array(times)
+            phase_stats = {'count': len(times), 'total': float(times.sum()), 'mean': float(times.mean())}
+            for percentile, value in zip(self.percentiles, np.percentile(times, self.percentiles)):
+                phase_stats[f'p{percentile}'] = float(value)
+            stats[name] = phase_stats
+        return stats
+
+    def end_epoch(self, epoch, tb_manager=None, batch=0):
+        if not self.enabled or len(self.times) == 0:
+            return None
+
+        stats = self.get_stats()
+        self.times = {}
+
+        step_total = sum(phase_stats['total'] for phase_stats in stats.values())
+        print(f'Profile for epoch {epoch}:')
+        for name, phase_stats in sorted(stats.items(), key=lambda item: -item[1]['total']):
+            share = phase_stats['total'] / step_total if step_total > 0 else 0
+            percentiles = ' :: '.join(f'p{p} = {phase_stats[f"p{p}"] * 1000:.1f}ms' for p in self.percentiles)
+            print(f'  {name} :: {share:.1%} of time :: mean = {phase_stats["mean"] * 1000:.1f}ms :: {percentiles}')
+
+        if tb_manager is not None:
+            for name, phase_stats in stats.items():
+                for key in ['mean'] + [f'p{p}' for p in self.percentiles]:
+                    tb_manager.log_var(f'profile_{name}_{key}', epoch, batch, phase_stats[key])
+
+        if self.json_file is not None:
+            self.write_json(epoch, stats)
+
+        return stats
+
+    def write_json(self, epoch, stats):
+        summary = {}
+        if os.path.exists(self.json_file):
+            try:
+                with open(self.json_file, 'r') as fp:
+                    summary = json.load(fp)
+            except (IOError, ValueError):
+                summary = {}
+
+        summary[str(epoch)] = stats
+        try:
+            with open(self.json_file, 'w') as fp:
+                json.dump(summary, fp, indent=2)
+        except IOError:
+            print(f'Failed to write profile to {self.json_file}')
+
+
+class ProfilerCallback(Callback):
+    # Profiles trainers that run through fit and fit_generator, data is the time spent waiting between batches
+
+    def __init__(self, profiler, tb_dir=None):
+        super().__init__()
+        self.profiler = profiler
+        self.tb_dir = tb_dir
+        self.tb_manager = None
+        self.batch_start = None
+        self.batch_end = None
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.batch_end = time.perf_counter()
+
+    def on_batch_begin(self, batch, logs=None):
+        self.batch_start = time.perf_counter()
+        if self.batch_end is not None:
+            self.profiler.add('data', self.batch_start - self.batch_end)
+
+    def on_batch_end(self, batch, logs=None):
+        self.batch_end = time.perf_counter()
+        self.profiler.add('train', self.batch_end - self.batch_start)
+
+    def on_epoch_end(self, epoch, logs=None):
+        # Only pull in the tensorboard manager when there is something to report
+        if self.tb_manager is None and self.tb_dir is not None and self.profiler.enabled:
+            from tbmanager import TensorboardManager
+            self.tb_manager = TensorboardManager(self.tb_dir, 1)
+
+        self.profiler.end_epoch(epoch, self.tb_manager)
+        if self.tb_manager is not None:
+            self.tb_manager.flush()
+        self.batch_end = None
+
+    def on_train_end(self, logs=None):
+        if self.tb_manager is not None:
+            self.tb_manager.close()
@@ -0,0 +1,234 @@
+import os
+import sqlite3
+import time
+from collections import deque
+from multiprocessing import Pool, cpu_count
+
+import numpy as np
+
+import utils
+from loadworker import is_good_world
+
+# Set once per pool process by init_score_worker
+worker_gen_size = None
+worker_block_forward = None
+worker_world_cache = None
+worker_block_images = None
+
+
+def default_score_file(world_directory):
+    return os.path.abspath(os.path.join(world_directory, '..', 'world_scores.db'))
+
+
+def get_score_crops(world, gen_size, block_forward):
+    # Tiles the whole world without random offsets, the last row and column of tiles are aligned to the edge so
+    # every block is covered and the same world always gives the same crops
+    width = max(world.shape[0], gen_size[0])
+    height = max(world.shape[1], gen_size[1])
+    if (width, height) != world.shape:
+        world_resized = np.zeros((width, height), dtype=world.dtype)
+        world_resized[:world.shape[0], :world.shape[1]] = world
+        world = world_resized
+
+    x_starts = sorted(set(list(range(0, width - gen_size[0], gen_size[0])) + [width - gen_size[0]]))
+    y_starts = sorted(set(list(range(0, height - gen_size[1], gen_size[1])) + [height - gen_size[1]]))
+
+    crops = []
+    for x_start in x_starts:
+        for y_start in y_starts:
+            cross_section = world[x_start:x_start + gen_size[0], y_start:y_start + gen_size[1]]
+            if is_good_world(cross_section):
+                crops.append(utils.encode_world_sigmoid(block_forward, cross_section))
+
+    if len(crops) == 0:
+        return None
+    return np.array(crops, dtype=np.int8)
+
+
+def init_score_worker(gen_size, block_forward, world_cache, block_images=None):
+    global worker_gen_size, worker_block_forward, worker_world_cache, worker_block_images
+    worker_gen_size = gen_size
+    worker_block_forward = block_forward
+    worker_world_cache = world_cache
+    worker_block_images = block_images
+
+
+def load_world_task(world_file):
+    if worker_world_cache is not None:
+        return worker_world_cache.load(world_file)
+    return utils.load_world_data_ver3(world_file)
+
+
+def encode_world_task(world_file):
+    # Runs in a pool worker, crops is None for worlds that could not be parsed or have no usable crops. Any error
+    # is caught since it would otherwise be raised again in score_corpus and end the whole run.
+    try:
+        crops = get_score_crops(load_world_task(world_file), worker_gen_size, worker_block_forward)
+    except Exception as e:
+        print(f'Failed to encode {os.path.basename(world_file)}: {e}')
+        crops = None
+    return world_file, crops
+
+
+def render_preview_task(args):
+    world_file, preview_file = args
+    utils.save_world_preview(worker_block_images, load_world_task(world_file), preview_file)
+
+
+class ScoreTable:
+    # SQLite table of per world scores keyed by world id and model version. The mtime and size of the world file are
+    # stored with each score, so only new or changed worlds are scored again.
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self.connection = sqlite3.connect(db_file)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS scores (id TEXT, model TEXT, filename TEXT, '
+                                'score_max REAL, score_mean REAL, crop_count INTEGER, mtime INTEGER, '
+                                'file_size INTEGER, scored REAL, PRIMARY KEY (id, model))')
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def get_known(self, model):
+        known = {}
+        for world_id, mtime, file_size in self.connection.execute('SELECT id, mtime, file_size FROM scores '
+                                                                  'WHERE model = ?', (model,)):
+            known[world_id] = (mtime, file_size)
+        return known
+
+    def put_scores(self, rows):
+        self.connection.executemany('INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        self.connection.commit()
+
+    def get_scores(self, model, min_score=None, max_score=None, column='score_max', descending=True, limit=None):
+        # Returns (id, filename, score) rows, worlds without usable crops have no score and are left out
+        if column not in ['score_max', 'score_mean']:
+            raise ValueError(f'Unknown score column \'{column}\'.')
+
+        sql = f'SELECT id, filename, {column} FROM scores WHERE model = ? AND {column} IS NOT NULL'
+        params = [model]
+        if min_score is not None:
+            sql += f' AND {column} >= ?'
+            params.append(min_score)
+        if max_score is not None:
+            sql += f' AND {column} < ?'
+            params.append(max_score)
+
+        sql += f' ORDER BY {column} {"DESC" if descending else "ASC"}'
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(limit)
+
+        return list(self.connection.execute(sql, params))
+
+    def count(self, model):
+        return self.connection.execute('SELECT COUNT(*) FROM scores WHERE model = ?', (model,)).fetchone()[0]
+
+
+def get_pending_worlds(world_directory, score_table, model, rescore=False):
+    known = {} if rescore else score_table.get_known(model)
+
+    pending = []
+    for entry in os.scandir(world_directory):
+        if not entry.is_file():
+            continue
+
+        stat = entry.stat()
+        if known.get(utils.get_world_id(entry.name), None) != (stat.st_mtime_ns, stat.st_size):
+            pending.append(entry.path)
+    return pending
+
+
+def score_corpus(classifier, model, world_directory, score_table, gen_size, block_forward, batch_size=256,
+                 thread_count=None, world_cache=None, rescore=False, commit_interval=1000):
+    # Streams every new or changed world through the classifier. A process pool parses and encodes worlds while
+    # the classifier predicts full batches of crops, a world gets its scores once all of its crops are predicted.
+    pending_files = get_pending_worlds(world_directory, score_table, model, rescore)
+    print(f'Scoring {len(pending_files)} worlds with {model}...')
+    if len(pending_files) == 0:
+        return 0
+
+    if thread_count is None:
+        thread_count = max(cpu_count() - 1, 1)
+
+    batch = np.empty((batch_size, gen_size[0], gen_size[1], 10), dtype=np.int8)
+    batch_owners = []
+    worlds = {}
+    rows = []
+    scored = 0
+    start_time = time.time()
+
+    def add_row(world_file, scores):
+        stat = os.stat(world_file)
+        score_max = float(np.max(scores)) if scores is not None else None
+        score_mean = float(np.mean(scores)) if scores is not None else None
+        crop_count = len(scores) if scores is not None else 0
+        rows.append((utils.get_world_id(world_file), model, os.path.basename(world_file), score_max, score_mean,
+                     crop_count, stat.st_mtime_ns, stat.st_size, time.time()))
+
+    def predict_batch(count):
+        predictions = classifier.predict_on_batch(batch[:count])
+        for owner, prediction in zip(batch_owners, predictions[:, 0]):
+            world = worlds[owner]
+            world[1].append(prediction)
+            if len(world[1]) == world[0]:
+                add_row(owner, world[1])
+                del worlds[owner]
+        batch_owners.clear()
+
+    # Keep a bounded number of worlds in flight so parsing can not run far ahead of inference
+    max_in_flight = thread_count * 4
+    in_flight = deque()
+    file_iter = iter(pending_files)
+
+    # Finished worlds are committed even when the run fails part way, so they are not scored again
+    try:
+        with Pool(thread_count, initializer=init_score_worker,
+                  initargs=(gen_size, block_forward, world_cache)) as pool:
+            for world_file in file_iter:
+                in_flight.append(pool.apply_async(encode_world_task, (world_file,)))
+                if len(in_flight) >= max_in_flight:
+                    break
+
+            while len(in_flight) > 0:
+                world_file, crops = in_flight.popleft().get()
+                next_file = next(file_iter, None)
+                if next_file is not None:
+                    in_flight.append(pool.apply_async(encode_world_task, (next_file,)))
+
+                if crops is None:
+                    add_row(world_file, None)
+                else:
+                    worlds[world_file] = (len(crops), [])
+                    for crop in crops:
+                        batch[len(batch_owners)] = crop
+                        batch_owners.append(world_file)
+                        if len(batch_owners) == batch_size:
+                            predict_batch(batch_size)
+
+                scored += 1
+                if len(rows) >= commit_interval:
+                    score_table.put_scores(rows)
+                    rows.clear()
+                    print(f'Scored {scored} of {len(pending_files)} worlds :: '
+                          f'{scored / (time.time() - start_time):.1f} worlds/sec')
+
+            if len(batch_owners) > 0:
+                predict_batch(len(batch_owners))
+    finally:
+        score_table.put_scores(rows)
+
+    print(f'Scored {scored} worlds in {time.time() - start_time:.0f}s.')
+    return scored
+
+
+def render_previews(jobs, block_images, world_cache=None, thread_count=None):
+    # jobs is a list of (world_file, preview_file), rendering is kept apart from scoring so it is optional
+    if thread_count is None:
+        thread_count = max(cpu_count() - 1, 1)
+
+    with Pool(thread_count, initializer=init_score_worker, initargs=(None, None, world_cache, block_images)) as pool:
+        for rendered, _ in enumerate(pool.imap_unordered(render_preview_task, jobs, chunksize=8)):
+            if (rendered + 1) % 100 == 0:
+                print(f'Rendered {rendered + 1} of {len(jobs)} previews')
@@ -0,0 +1,192 @@
+import csv
+import itertools
+import json
+import os
+import time
+import traceback
+from multiprocessing import get_context
+
+import keras.backend as K
+import numpy as np
+import tensorflow as tf
+from keras.callbacks import Callback
+
+from dataparallel import get_shared_file
+
+# Set in every trial process by init_trial_worker
+trial_arrays = None
+
+
+def init_trial_worker(data_files, thread_count):
+    global trial_arrays
+
+    # Limit every trial so parallel trials do not fight over the same cores
+    for name in ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']:
+        os.environ[name] = str(thread_count)
+    config = tf.ConfigProto(intra_op_parallelism_threads=thread_count, inter_op_parallelism_threads=thread_count)
+    K.set_session(tf.Session(config=config))
+
+    # Every trial memory maps the same .npy files, so the dataset is in memory once through the page cache
+    trial_arrays = [np.load(data_file, mmap_mode='r') for data_file in data_files]
+
+
+def grid_configs(grid):
+    # Every combination of the values in grid, e.g. {'lr': [1e-3, 1e-4], 'batch_size': [32, 64]}
+    names = sorted(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+
+
+def random_configs(space, count, seed=0):
+    # Lists are sampled as choices and (low, high) tuples uniformly
+    random = np.random.RandomState(seed)
+    configs = []
+    for _ in range(count):
+        config = {}
+        for name in sorted(space):
+            values = space[name]
+            if isinstance(values, tuple):
+                config[name] = float(random.uniform(values[0], values[1]))
+            else:
+                config[name] = values[random.randint(len(values))]
+        configs.append(config)
+    return configs
+
+
+class TrialReporter:
+    # Shares the metric history of every trial between the trial processes. A trial is stopped when its best metric
+    # so far is worse than the median of the other trials at the same epoch, once grace_epochs epochs have passed
+    # and at least min_trials other trials have reached that epoch.
+
+    def __init__(self, trial_id, history, mode='max', grace_epochs=2, min_trials=3):
+        self.trial_id = trial_id
+        self.history = history
+        self.mode = mode
+        self.grace_epochs = grace_epochs
+        self.min_trials = min_trials
+        self.metrics = []
+        self.stopped = False
+
+    def get_best(self, metrics):
+        return max(metrics) if self.mode == 'max' else min(metrics)
+
+    @property
+    def best(self):
+        if len(self.metrics) == 0:
+            return None
+        return self.get_best(self.metrics)
+
+    def report(self, epoch, metric):
+        # Returns False when the trial should stop
+        self.metrics.append(float(metric))
+        self.history[self.trial_id] = list(self.metrics)
+
+        if len(self.metrics) <= self.grace_epochs:
+            return True
+
+        others = [self.get_best(metrics[:len(self.metrics)]) for trial_id, metrics in self.history.items()
+                  if trial_id != self.trial_id and len(metrics) >= len(self.metrics)]
+        if len(others) < self.min_trials:
+            return True
+
+        median = float(np.median(others))
+        best = self.best
+        if (self.mode == 'max' and best < median) or (self.mode == 'min' and best > median):
+            print(f'Stopping trial {self.trial_id} at epoch {epoch}, {best} is behind the median {median}')
+            self.stopped = True
+            return False
+        return True
+
+
+class SweepCallback(Callback):
+    # Reports a metric to the sweep after every epoch, for trials that train with fit and fit_generator
+
+    def __init__(self, reporter, monitor='val_acc'):
+        super().__init__()
+        self.reporter = reporter
+        self.monitor = monitor
+
+    def on_epoch_end(self, epoch, logs=None):
+        logs = logs or {}
+        if self.monitor in logs and not self.reporter.report(epoch, logs[self.monitor]):
+            self.model.stop_training = True
+
+
+def run_trial(trial_func, trial_id, config, history, mode, grace_epochs, min_trials):
+    reporter = TrialReporter(trial_id, history, mode, grace_epochs, min_trials)
+    start_time = time.time()
+
+    result = {'trial': trial_id}
+    try:
+        metrics = trial_func(config, trial_arrays, reporter)
+        result['status'] = 'stopped' if reporter.stopped else 'completed'
+        result.update(metrics or {})
+    except Exception:
+        traceback.print_exc()
+        result['status'] = 'failed'
+
+    result['best'] = reporter.best
+    result['epochs'] = len(reporter.metrics)
+    result['time'] = time.time() - start_time
+    result.update(config)
+    return result
+
+
+def write_results(results_dir, results):
+    with open(os.path.join(results_dir, 'results.json'), 'w') as fp:
+        json.dump(results, fp, indent=2, default=str)
+
+    columns = []
+    for result in results:
+        columns.extend(name for name in result if name not in columns)
+
+    with open(os.path.join(results_dir, 'results.csv'), 'w', newline='') as fp:
+        writer = csv.DictWriter(fp, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(results)
+
+
+def run_sweep(trial_func, configs, arrays, results_dir, workers=2, threads_per_trial=None, mode='max',
+              grace_epochs=2, min_trials=3):
+    # Runs trial_func(config, arrays, reporter) for every config in a pool of workers processes. trial_func must be
+    # a module level function and should call reporter.report(epoch, metric) every epoch and stop when it returns
+    # False, SweepCallback does that for keras models. Results are sorted best first and written to results_dir.
+    if threads_per_trial is None:
+        threads_per_trial = max(1, os.cpu_count() // workers)
+
+    # Arrays that come from the dataset cache are shared as they are, others are written next to the results once
+    print(f'Sharing dataset with {len(configs)} trials...')
+    data_files = [get_shared_file(array, os.path.join(results_dir, f'sweep_data{i}.npy'))
+                  for i, array in enumerate(arrays)]
+
+    # Spawn instead of fork, a forked tensorflow session is not safe to use
+    ctx = get_context('spawn')
+    results = []
+    with ctx.Manager() as manager:
+        history = manager.dict()
+
+        # A new process per trial, so every trial starts with an empty keras graph
+        pool = ctx.Pool(workers, initializer=init_trial_worker, initargs=(data_files, threads_per_trial),
+                        maxtasksperchild=1)
+        pending = [pool.apply_async(run_trial, (trial_func, trial_id, config, history, mode, grace_epochs,
+                                                min_trials))
+                   for trial_id, config in enumerate(configs)]
+        pool.close()
+
+        for job in pending:
+            result = job.get()
+            results.append(result)
+            print(f'Trial {result["trial"]} {result["status"]} :: best = {result["best"]} :: '
+                  f'epochs = {result["epochs"]} :: {result["time"]:.0f}s')
+        pool.join()
+
+    scored = [result for result in results if result['best'] is not None]
+    scored.sort(key=lambda result: result['best'], reverse=mode == 'max')
+    results = scored + [result for result in results if result['best'] is None]
+    write_results(results_dir, results)
+
+    print('Sweep results:')
+    for result in results:
+        config = ' :: '.join(f'{name} = {result[name]}' for name in sorted(configs[result['trial']]))
+        print(f'  trial {result["trial"]} :: {result["status"]} :: best = {result["best"]} :: {config}')
+
+    return results
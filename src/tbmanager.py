@@ -1,25 +1,115 @@
 import math
+import queue
+import threading
+import time
 
+import numpy as np
 import tensorflow as tf
 
 
 class TensorboardManager:
+    # Values are buffered in memory and handed to a background thread every flush_interval_sec seconds or
+    # max_buffered values, which packs all values of a step into one event and flushes the writer once per batch
+    # of events instead of once per value.
 
-    def __init__(self, base_dir, number_of_batches):
+    def __init__(self, base_dir, number_of_batches, flush_interval_sec=10.0, max_buffered=1000):
         self.base_dir = base_dir
         self.number_of_batches = number_of_batches
+        self.flush_interval_sec = flush_interval_sec
+        self.max_buffered = max_buffered
         self.writer = tf.summary.FileWriter(logdir=base_dir)
-        self.var_dict = {}
+
+        self.buffer = []
+        self.last_flush = time.time()
+        self.step_start = {}
+
+        self.pending = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def get_step(self, epoch, batch):
+        return (epoch * self.number_of_batches) + batch
 
     def log_var(self, var_name, epoch, batch, value):
         if math.isnan(value):
             return
 
-        if var_name not in self.var_dict:
-            summary = tf.Summary()
-            summary.value.add(tag=var_name, simple_value=None)
-            self.var_dict[var_name] = summary
+        self.buffer.append(('scalar', self.get_step(epoch, batch), var_name, float(value)))
+        self.check_flush()
+
+    def log_histogram(self, var_name, epoch, batch, values, bins=64):
+        # Only the histogram is kept, so large arrays do not stay in memory until the next flush
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[np.isfinite(values)]
+        if values.size == 0:
+            return
+
+        counts, edges = np.histogram(values, bins=bins)
+        histogram = tf.HistogramProto(min=float(values.min()), max=float(values.max()), num=int(values.size),
+                                      sum=float(values.sum()), sum_squares=float(np.dot(values, values)))
+        histogram.bucket_limit.extend(edges[1:].tolist())
+        histogram.bucket.extend(counts.tolist())
+
+        self.buffer.append(('histogram', self.get_step(epoch, batch), var_name, histogram))
+        self.check_flush()
+
+    def start_step(self, name='step_time'):
+        self.step_start[name] = time.time()
+
+    def log_step_time(self, epoch, batch, name='step_time'):
+        # Logs the seconds since start_step, or since the previous log_step_time call with the same name
+        now = time.time()
+        if name in self.step_start:
+            self.log_var(name, epoch, batch, now - self.step_start[name])
+        self.step_start[name] = now
+
+    def check_flush(self):
+        if len(self.buffer) >= self.max_buffered or time.time() - self.last_flush >= self.flush_interval_sec:
+            self.flush()
+
+    def flush(self):
+        if len(self.buffer) > 0:
+            self.pending.put(self.buffer)
+            self.buffer = []
+        self.last_flush = time.time()
+
+    def run(self):
+        while True:
+            values = self.pending.get()
+            if values is None:
+                self.pending.task_done()
+                return
+
+            try:
+                self.write(values)
+            except Exception as e:
+                # Losing a few summaries is better than a dead writer thread leaving wait and close blocked
+                print(f'Failed to write summaries: {e}')
+            finally:
+                self.pending.task_done()
+
+    def write(self, values):
+        # Group values by step so each step becomes a single event
+        summaries = {}
+        for kind, step, var_name, value in values:
+            if step not in summaries:
+                summaries[step] = tf.Summary()
+
+            if kind == 'scalar':
+                summaries[step].value.add(tag=var_name, simple_value=value)
+            else:
+                summaries[step].value.add(tag=var_name, histo=value)
+
+        for step in sorted(summaries):
+            self.writer.add_summary(summaries[step], step)
+        self.writer.flush()
+
+    def wait(self):
+        self.flush()
+        self.pending.join()
 
-        summary = self.var_dict[var_name]
-        summary.value[0].simple_value = value
-        self.writer.add_summary(summary, (epoch * self.number_of_batches) + batch)
+    def close(self):
+        self.flush()
+        self.pending.put(None)
+        self.thread.join()
+        self.writer.close()
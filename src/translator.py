@@ -8,6 +8,7 @@ from keras.models import Sequential, load_model
 
 import utils
 from loadworker import load_worlds_with_minimaps
+from profiler import ProfilerCallback, StepProfiler
 
 
 def build_translator(size):
@@ -27,7 +28,7 @@ def build_translator(size):
     return model
 
 
-def train(epochs, batch_size, world_count, size, version_name=None):
+def train(epochs, batch_size, world_count, size, version_name=None, profile=False):
     cur_dir = os.getcwd()
     res_dir = os.path.abspath(os.path.join(cur_dir, '..', 'res'))
     all_models_dir = os.path.abspath(os.path.join(cur_dir, '..', 'models'))
@@ -81,6 +82,10 @@ def train(epochs, batch_size, world_count, size, version_name=None):
                                               write_grads=True)
 
     callback_list = [latest_h5_callback, latest_weights_callback, best_loss_callback, tb_callback]
+    if profile:
+        profiler = StepProfiler(True, f'{version_dir}\\profile.json')
+        callback_list.append(ProfilerCallback(profiler, f'{graph_version_dir}\\profile'))
+
     translator.fit(x_train, y_train, batch_size, epochs, callbacks=callback_list)
 
 
@@ -1,5 +1,5 @@
 from keras import backend as K
-from keras.layers import Input, Conv2D, UpSampling2D, LeakyReLU, BatchNormalization, Activation
+from keras.layers import Input, Conv2D, UpSampling2D, LeakyReLU, BatchNormalization, Activation, Lambda
 from keras.layers.merge import Concatenate
 from keras.models import Model
 from keras.optimizers import Adam
@@ -50,7 +50,12 @@ class PConvUnet:
 
         # INPUTS
         inputs_world = Input((128, 128, 10), name='inputs_world')
-        inputs_mask = Input((128, 128, 10), name='inputs_mask')
+        inputs_mask = Input((128, 128, None), name='inputs_mask')
+
+        # The mask is the same for every channel, so it is fed once and repeated inside the graph. Masks with 10
+        # equal channels, as fed before, still work, and weights saved before load unchanged since this layer has none.
+        world_mask = Lambda(lambda m: K.repeat_elements(m[:, :, :, :1], 10, axis=3),
+                            output_shape=lambda s: s[:3] + (10,))(inputs_mask)
 
         # ENCODER
         def encoder_layer(img_in, mask_in, filters, kernel_size, bn=True):
@@ -66,7 +71,7 @@ class PConvUnet:
 
             return conv2, mask2
 
-        e_conv1, e_mask1 = encoder_layer(inputs_world, inputs_mask, 64, 7, bn=False)
+        e_conv1, e_mask1 = encoder_layer(inputs_world, world_mask, 64, 7, bn=False)
         e_conv2, e_mask2 = encoder_layer(e_conv1, e_mask1, 128, 5)
         e_conv3, e_mask3 = encoder_layer(e_conv2, e_mask2, 256, 5)
         e_conv4, e_mask4 = encoder_layer(e_conv3, e_mask3, 512, 3)
@@ -92,7 +97,7 @@ class PConvUnet:
         d_conv10, d_mask10 = decoder_layer(d_conv9, d_mask9, e_conv3, e_mask3, 512, 3)
         d_conv11, d_mask11 = decoder_layer(d_conv10, d_mask10, e_conv2, e_mask2, 256, 5)
         d_conv12, d_mask12 = decoder_layer(d_conv11, d_mask11, e_conv1, e_mask1, 128, 5)
-        d_conv16, d_mask16 = decoder_layer(d_conv12, d_mask12, inputs_world, inputs_mask, 64, 7, bn=False)
+        d_conv16, d_mask16 = decoder_layer(d_conv12, d_mask12, inputs_world, world_mask, 64, 7, bn=False)
         outputs = Conv2D(10, 1, activation='sigmoid')(d_conv16)
 
         # Setup the model inputs / outputs
@@ -1,4 +1,5 @@
 import gzip
+import json
 import os
 import struct
 import zlib
@@ -14,6 +15,7 @@ from skimage.draw import line
 from playerio import *
 from playerio.initparse import get_world_data
 import blocks
+import maskgen
 
 
 def load_minimap_values(base_dir):
@@ -164,34 +166,30 @@ def random_mask_low(height, width, channels=11):
     return mask
 
 
-def mask_batch_high(batch):
-    masked = np.empty(batch.shape, dtype=np.int8)
-    masks = np.empty(batch.shape, dtype=np.int8)
+def apply_masks(batch, masks, out=None):
+    # Masks are (N, w, h, 1) and broadcast over the channels, holes are filled with 1
+    if out is None:
+        out = np.empty(batch.shape, dtype=batch.dtype)
 
-    batch_size = batch.shape[0]
-    for i in range(batch_size):
-        world_masked = np.copy(batch[i])
-        mask = random_mask_high(world_masked.shape[0], world_masked.shape[1], world_masked.shape[2])
-        world_masked[mask == 0] = 1
-        masked[i] = world_masked
-        masks[i] = mask
+    np.copyto(out, batch)
+    np.copyto(out, 1, where=masks == 0)
+    return out
 
-    return masked, masks
 
+def mask_batch_high(batch, mask_bank=None, out=None):
+    # Generate every mask of the batch at once, or sample them from a precomputed bank
+    batch_size = batch.shape[0]
+    if mask_bank is not None:
+        masks = mask_bank.sample(batch_size)
+    else:
+        masks = maskgen.random_masks_high(batch_size, batch.shape[1], batch.shape[2])
 
-def mask_batch_low(batch):
-    masked = np.empty(batch.shape, dtype=np.int8)
-    masks = np.empty(batch.shape, dtype=np.int8)
+    return apply_masks(batch, masks, out), masks
 
-    batch_size = batch.shape[0]
-    for i in range(batch_size):
-        world_masked = np.copy(batch[i])
-        mask = random_mask_low(world_masked.shape[0], world_masked.shape[1], world_masked.shape[2])
-        world_masked[mask == 0] = 1
-        masked[i] = world_masked
-        masks[i] = mask
 
-    return masked, masks
+def mask_batch_low(batch, out=None):
+    masks = maskgen.random_masks_low(batch.shape[0], batch.shape[1], batch.shape[2])
+    return apply_masks(batch, masks, out), masks
 
 
 def decode_world_sigmoid(block_backward, world_data):
@@ -421,9 +419,7 @@ def load_world_live(world_id, **kwargs):
         wd = np.empty((width, height), dtype=int)
 
         world_data = get_world_data(init_message)
-        for x in range(width):
-            for y in range(height):
-                wd[x, y] = world_data[x, y, 0].block_id
+        wd[:, :] = world_data.get_layer(0)
 
         init_lock.release()
 
@@ -715,6 +711,16 @@ def get_world_id(world_file):
 
 
 def get_latest_epoch(directory):
+    # Checkpoint manifests list the saved epochs, only fall back to scanning when there is none
+    manifest_file = os.path.join(directory, 'manifest.json')
+    if os.path.exists(manifest_file):
+        try:
+            with open(manifest_file, 'r') as fp:
+                manifest = json.load(fp)
+            return max([checkpoint['epoch'] for checkpoint in manifest['checkpoints']], default=-1)
+        except (IOError, ValueError, KeyError):
+            pass
+
     highest_epoch = -1
     for path in os.listdir(directory):
         full_path = os.path.join(directory, path)
@@ -768,15 +774,25 @@ def save_train_data(train_data, block_images, base_dir):
         save_world_preview(block_images, decoded_world, f'{base_dir}\\image{i}.png')
 
 
-def save_world_repo_previews(world_repo, output_dir):
+def save_world_repo_previews(world_repo, output_dir, world_cache=None, catalog=None):
     block_images = load_block_images()
 
     cur_dir = os.getcwd()
     repo_dir = f'{cur_dir}\\{world_repo}'
-    for world_name in os.listdir(repo_dir):
+
+    # The catalog already knows world sizes so only large enough worlds get opened
+    if catalog is not None:
+        world_names = catalog.query('width>=100, height>=100')
+    else:
+        world_names = os.listdir(repo_dir)
+
+    for world_name in world_names:
         world_file = f'{repo_dir}\\{world_name}'
         dest_file = f'{output_dir}\\{world_name}.png'
         if not os.path.exists(dest_file):
-            world_data = load_world_data_ver3(world_file)
+            if world_cache is not None:
+                world_data = world_cache.load(world_file)
+            else:
+                world_data = load_world_data_ver3(world_file)
             if world_data.shape[0] >= 100 and world_data.shape[1] >= 100:
                 save_world_preview(block_images, world_data, dest_file)
@@ -0,0 +1,117 @@
+import hashlib
+import os
+import time
+
+import numpy as np
+
+import utils
+
+
+def default_cache_dir(world_directory):
+    return os.path.abspath(os.path.join(world_directory, '..', 'world_cache'))
+
+
+class WorldCache:
+    # On disk cache of decoded block arrays so worlds only go through gzip and csv parsing once.
+    # Entries are keyed by (path, mtime, size) and the file mtime of an entry doubles as its last access time.
+
+    def __init__(self, cache_dir, max_bytes=2 * 1024 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def get_key(self, world_file):
+        stat = os.stat(world_file)
+        key_str = f'{os.path.abspath(world_file)}|{stat.st_mtime_ns}|{stat.st_size}'
+        return hashlib.sha1(key_str.encode('utf8')).hexdigest()
+
+    def get_entry_file(self, key):
+        return os.path.join(self.cache_dir, f'{key}.npy')
+
+    def get(self, world_file):
+        if not os.path.exists(world_file):
+            return None
+
+        entry_file = self.get_entry_file(self.get_key(world_file))
+        if not os.path.exists(entry_file):
+            return None
+
+        try:
+            world = np.load(entry_file)
+            os.utime(entry_file)
+        except (IOError, ValueError):
+            return None
+
+        return world.astype(int)
+
+    def put(self, world_file, world):
+        if world is None or not os.path.exists(world_file):
+            return
+
+        entry_file = self.get_entry_file(self.get_key(world_file))
+
+        # Write to a temporary file first so other processes never read a partial entry
+        temp_file = f'{entry_file}.{os.getpid()}.tmp'
+        try:
+            with open(temp_file, 'wb') as fp:
+                np.save(fp, world.astype(np.uint16))
+            os.replace(temp_file, entry_file)
+        except IOError:
+            print(f'Failed to cache world {world_file}')
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+
+    def load(self, world_file):
+        world = self.get(world_file)
+        if world is not None:
+            return world
+
+        world = utils.load_world_data_ver3(world_file)
+        self.put(world_file, world)
+        return world
+
+    def contains(self, world_file):
+        return os.path.exists(world_file) and os.path.exists(self.get_entry_file(self.get_key(world_file)))
+
+    def size(self):
+        total = 0
+        for entry in os.listdir(self.cache_dir):
+            if entry.endswith('.npy'):
+                total += os.path.getsize(os.path.join(self.cache_dir, entry))
+        return total
+
+    def evict(self):
+        # Remove least recently used entries until the cache fits inside the byte budget
+        entries = []
+        total = 0
+        for entry in os.listdir(self.cache_dir):
+            entry_file = os.path.join(self.cache_dir, entry)
+            if entry.endswith('.tmp') and time.time() - os.path.getmtime(entry_file) > 60 * 60:
+                # Left over from a process that died while writing
+                os.remove(entry_file)
+                continue
+
+            if entry.endswith('.npy'):
+                stat = os.stat(entry_file)
+                entries.append((stat.st_mtime, stat.st_size, entry_file))
+                total += stat.st_size
+
+        entries.sort()
+        evicted = 0
+        for mtime, size, entry_file in entries:
+            if total <= self.max_bytes:
+                break
+
+            try:
+                os.remove(entry_file)
+                total -= size
+                evicted += 1
+            except OSError:
+                pass
+
+        if evicted > 0:
+            print(f'Evicted {evicted} worlds from cache.')
+
+    def clear(self):
+        utils.delete_files_in_path(self.cache_dir)
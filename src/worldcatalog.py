@@ -0,0 +1,216 @@
+import json
+import os
+import re
+import sqlite3
+from multiprocessing import Pool, cpu_count
+
+import numpy as np
+
+import utils
+from worldcache import WorldCache, default_cache_dir
+
+# Columns that can be used in a query string, label is resolved through the labels table
+query_fields = ['id', 'filename', 'format', 'file_size', 'width', 'height', 'area', 'density', 'distinct_blocks',
+                'label']
+query_pattern = re.compile(r'^\s*([a-z_]+)\s*(>=|<=|!=|=|>|<)\s*(.+?)\s*$')
+
+
+def default_catalog_file(world_directory):
+    return os.path.abspath(os.path.join(world_directory, '..', 'world_catalog.db'))
+
+
+def get_world_format(filename):
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == '.eelvl':
+        return 'eelvl'
+    return 'world_ver3'
+
+
+def compute_world_metadata(args):
+    # Runs in a pool worker, returns None for files that can not be parsed. Any error is caught since a truncated or
+    # corrupt world would otherwise be raised again in update and stop the whole catalog update.
+    world_file, world_cache = args
+    world_format = get_world_format(world_file)
+
+    try:
+        if world_format == 'eelvl':
+            world = utils.load_world_eelvl(world_file)
+        elif world_cache is not None:
+            world = world_cache.load(world_file)
+        else:
+            world = utils.load_world_data_ver3(world_file)
+    except Exception as e:
+        print(f'Failed to index {os.path.basename(world_file)}: {e}')
+        return None
+
+    if world is None:
+        return None
+
+    stat = os.stat(world_file)
+    block_ids, block_counts = np.unique(world, return_counts=True)
+    area = world.shape[0] * world.shape[1]
+
+    # Keep a compact summary of the histogram, the 8 most common blocks and their share of the world
+    order = np.argsort(block_counts)[::-1][:8]
+    top_blocks = {int(block_ids[i]): round(float(block_counts[i]) / area, 4) for i in order}
+
+    return {
+        'id': utils.get_world_id(world_file),
+        'filename': os.path.basename(world_file),
+        'format': world_format,
+        'mtime': stat.st_mtime_ns,
+        'file_size': stat.st_size,
+        'width': int(world.shape[0]),
+        'height': int(world.shape[1]),
+        'area': int(area),
+        'density': float(np.count_nonzero(world)) / area,
+        'distinct_blocks': int(len(block_ids)),
+        'top_blocks': json.dumps(top_blocks)
+    }
+
+
+class WorldCatalog:
+    # SQLite index of per world metadata so loaders can select worlds without opening them
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self.connection = sqlite3.connect(db_file)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS worlds (id TEXT PRIMARY KEY, filename TEXT, format TEXT, '
+                                'mtime INTEGER, file_size INTEGER, width INTEGER, height INTEGER, area INTEGER, '
+                                'density REAL, distinct_blocks INTEGER, top_blocks TEXT)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS labels (id TEXT, label_name TEXT, label INTEGER, '
+                                'PRIMARY KEY (id, label_name))')
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def update(self, world_directory, world_cache=None, thread_count=None):
+        # Only worlds that are new or changed since the last update get parsed
+        known = {}
+        for world_id, mtime, file_size in self.connection.execute('SELECT id, mtime, file_size FROM worlds'):
+            known[world_id] = (mtime, file_size)
+
+        found = set()
+        pending = []
+        for name in os.listdir(world_directory):
+            world_file = os.path.join(world_directory, name)
+            if not os.path.isfile(world_file):
+                continue
+
+            world_id = utils.get_world_id(name)
+            found.add(world_id)
+            stat = os.stat(world_file)
+            if known.get(world_id, None) != (stat.st_mtime_ns, stat.st_size):
+                pending.append((world_file, world_cache))
+
+        # Drop worlds that no longer exist
+        removed = [(world_id,) for world_id in known if world_id not in found]
+        self.connection.executemany('DELETE FROM worlds WHERE id = ?', removed)
+
+        print(f'Indexing {len(pending)} worlds...')
+        if thread_count is None:
+            thread_count = max(cpu_count() - 1, 1)
+
+        indexed = 0
+        with Pool(thread_count) as pool:
+            for metadata in pool.imap_unordered(compute_world_metadata, pending, chunksize=16):
+                if metadata is None:
+                    continue
+
+                self.connection.execute('INSERT OR REPLACE INTO worlds VALUES (:id, :filename, :format, :mtime, '
+                                        ':file_size, :width, :height, :area, :density, :distinct_blocks, '
+                                        ':top_blocks)', metadata)
+                indexed += 1
+                if indexed % 1000 == 0:
+                    self.connection.commit()
+                    print(f'Indexed {indexed} of {len(pending)} worlds')
+
+        self.connection.commit()
+        print(f'Indexed {indexed} worlds, removed {len(removed)} worlds.')
+
+    def update_labels(self, res_dir, label_name):
+        label_dict = utils.load_label_dict(res_dir, label_name)
+        self.connection.execute('DELETE FROM labels WHERE label_name = ?', (label_name,))
+        self.connection.executemany('INSERT INTO labels VALUES (?, ?, ?)',
+                                    [(world_id, label_name, label) for world_id, label in label_dict.items()])
+        self.connection.commit()
+
+    def set_labels(self, label_name, labels):
+        # Adds or replaces only the given labels
+        self.connection.executemany('INSERT OR REPLACE INTO labels VALUES (?, ?, ?)',
+                                    [(world_id, label_name, label) for world_id, label in labels.items()])
+        self.connection.commit()
+
+    def get_metadata(self, world_id):
+        cursor = self.connection.execute('SELECT * FROM worlds WHERE id = ?', (world_id,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+
+        metadata = dict(zip([column[0] for column in cursor.description], row))
+        metadata['top_blocks'] = json.loads(metadata['top_blocks'])
+        return metadata
+
+    def count(self):
+        return self.connection.execute('SELECT COUNT(*) FROM worlds').fetchone()[0]
+
+    def query(self, query_str, label_name=None, columns='filename'):
+        # Query strings are comma separated comparisons, e.g. 'width>=100, label=1, density>0.4'
+        conditions = []
+        params = []
+        join = ''
+        for term in query_str.split(','):
+            if term.strip() == '':
+                continue
+
+            match = query_pattern.match(term)
+            if match is None:
+                raise ValueError(f'Invalid query term \'{term.strip()}\'.')
+
+            field, op, value = match.groups()
+            if field not in query_fields:
+                raise ValueError(f'Unknown query field \'{field}\'.')
+
+            try:
+                value = float(value) if '.' in value else int(value)
+            except ValueError:
+                value = value.strip('\'"')
+
+            if field == 'label':
+                if join == '':
+                    join = ' JOIN labels ON labels.id = worlds.id'
+                    if label_name is not None:
+                        conditions.append('labels.label_name = ?')
+                        params.append(label_name)
+                conditions.append(f'labels.label {op} ?')
+            else:
+                conditions.append(f'worlds.{field} {op} ?')
+            params.append(value)
+
+        sql = f'SELECT DISTINCT worlds.{columns} FROM worlds{join}'
+        if len(conditions) > 0:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+
+        return [row[0] for row in self.connection.execute(sql, params)]
+
+    def query_ids(self, query_str, label_name=None):
+        return self.query(query_str, label_name, columns='id')
+
+
+def main():
+    cur_dir = os.getcwd()
+    res_dir = os.path.abspath(os.path.join(cur_dir, '..', 'res'))
+    world_directory = f'{res_dir}\\worlds\\'
+
+    world_cache = WorldCache(default_cache_dir(world_directory))
+
+    catalog = WorldCatalog(default_catalog_file(world_directory))
+    catalog.update(world_directory, world_cache)
+    catalog.update_labels(res_dir, 'pro_labels_b')
+    print(f'Catalog contains {catalog.count()} worlds.')
+    catalog.close()
+
+
+if __name__ == '__main__':
+    main()